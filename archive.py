@@ -0,0 +1,316 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Long-term archive of spectrograms, reduced to logarithmic bands and quantized, in memory-mapped files"""
+
+import bisect
+import datetime
+import json
+import os
+import struct
+
+import numpy as np
+
+from levels import band_centers, band_edges
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+MAGIC = b'SPECARC1'
+PAGE_SIZE = 4096  # The header (the magic, its size, the length of the metadata and the metadata as JSON) fills pages
+DEFAULT_STEPS = {'u1': 0.5, 'u2': 0.01}  # dB per quantization step of each type of the stored levels
+# Level stored as 0 by default. With 8 bits, levels from about the noise of 16-bit samples to their full scale (90 dB
+# relative to a unit amplitude, as given by SpectrumAnalyzer) are kept.
+DEFAULT_DB_MIN = -30.
+
+
+def log_band_edges(count=120, fmin=20., fmax=20000.):
+    """Return the lower and upper edges of count bands of equal width in a logarithmic scale between fmin and fmax"""
+    edges = np.geomspace(fmin, fmax, count + 1)
+    return edges[:-1], edges[1:]
+
+
+def octave_band_edges(fraction=12, fmin=20., fmax=20000.):
+    """Return the lower and upper edges of the 1/fraction octave bands with mid-band frequencies in [fmin, fmax]"""
+    return band_edges(band_centers(fraction, fmin, fmax), fraction)
+
+
+def parse_bands(text, fmin=20., fmax=20000.):
+    """
+    Return the edges of the bands described by a text: "1/N" for 1/N octave bands, or "N" for N log-spaced bands.
+
+    Raises:
+        ValueError: If the text is not valid.
+    """
+    if text.startswith("1/"):
+        return octave_band_edges(int(text[2:]), fmin, fmax)
+    return log_band_edges(int(text), fmin, fmax)
+
+
+class BandReducer:
+    """
+    Reduction of spectra in dB to the mean level of a set of bands, e.g., logarithmic ones.
+
+    The bins of each band are found once, and the levels of all the bands are computed from a cumulative sum of the
+    power of the spectrum. Bands narrower than the bins take the level of the nearest bin.
+    """
+
+    def __init__(self, freqs, lower, upper):
+        """
+        Args:
+            freqs (np.ndarray): Frequencies of the bins of the spectra, increasing.
+            lower (np.ndarray): Lower edges of the bands.
+            upper (np.ndarray): Upper edges of the bands. Bands above the highest frequency are omitted.
+        """
+        keep = upper <= freqs[-1]
+        self.lower = np.asarray(lower, dtype=float)[keep]
+        self.upper = np.asarray(upper, dtype=float)[keep]
+        self.centers = np.sqrt(self.lower * self.upper)
+        low = np.searchsorted(freqs, self.lower)
+        high = np.searchsorted(freqs, self.upper)
+        nearest = np.clip(np.searchsorted(freqs, self.centers), 1, len(freqs) - 1)
+        nearest -= self.centers - freqs[nearest - 1] < freqs[nearest] - self.centers
+        empty = high <= low
+        self._low = np.where(empty, nearest, low)
+        self._high = np.where(empty, nearest + 1, high)
+        self._counts = self._high - self._low
+
+    def __call__(self, spectrum):
+        """Return the levels in dB of the bands of a spectrum in dB, or of the spectra in the last axis of an array"""
+        power = 10 ** (np.asarray(spectrum) / 10)
+        cumulative = np.cumsum(power, axis=-1)
+        cumulative = np.concatenate((np.zeros(cumulative.shape[:-1] + (1,)), cumulative), axis=-1)
+        with np.errstate(divide='ignore'):
+            return 10 * np.log10((cumulative[..., self._high] - cumulative[..., self._low]) / self._counts)
+
+
+def quantize(levels, dtype='u1', db_min=DEFAULT_DB_MIN, db_step=None):
+    """Return levels in dB as unsigned integers, db_min becoming 0 and each unit being db_step dB"""
+    dtype = np.dtype(dtype)
+    db_step = DEFAULT_STEPS[dtype.str[1:]] if db_step is None else db_step
+    codes = np.rint((np.nan_to_num(levels, nan=db_min, neginf=db_min) - db_min) / db_step)
+    return np.clip(codes, 0, np.iinfo(dtype).max).astype(dtype)
+
+
+def dequantize(codes, db_min=DEFAULT_DB_MIN, db_step=0.5):
+    """Return the levels in dB of quantized levels, as float32"""
+    return codes.astype(np.float32) * np.float32(db_step) + np.float32(db_min)
+
+
+def _record_dtype(bands, dtype):
+    """Type of the records of the file: the timestamp and the quantized level of each band"""
+    return np.dtype([('time', '<f8'), ('levels', np.dtype(dtype).newbyteorder('<'), (bands,))])
+
+
+def _header(metadata):
+    """Return the header of a file with the given metadata"""
+    text = json.dumps(metadata).encode()
+    size = -(-(16 + len(text)) // PAGE_SIZE) * PAGE_SIZE
+    return (MAGIC + struct.pack('<II', size, len(text)) + text).ljust(size, b'\0')
+
+
+def _read_header(file_name):
+    """Return the metadata of a file and the size of its header"""
+    with open(file_name, 'rb') as f:
+        start = f.read(16)
+        if len(start) < 16 or start[:8] != MAGIC:
+            raise ValueError("%s is not a spectrogram archive" % file_name)
+        size, length = struct.unpack('<II', start[8:])
+        return json.loads(f.read(length).decode()), size
+
+
+class SpectrogramRecorder:
+    """
+    Writer of a spectrogram archive.
+
+    Each spectrum is reduced to logarithmic bands and quantized to 8 or 16-bit levels, which with 1/12 octave bands
+    takes 128 bytes per spectrum instead of tens of kilobytes. The records, with their timestamp, are kept in a
+    preallocated chunk and appended to the file when it is full, so the file grows in a few large writes. An existing
+    archive with the same bands is continued. It can be a sink of a Pipeline with a 'spectrum' in dB.
+    """
+
+    def __init__(self, file_name, freqs, edges=None, dtype='u1', db_min=DEFAULT_DB_MIN, db_step=None, chunk_rows=100,
+                 channel=0):
+        """
+        Args:
+            file_name (str): Path to the archive.
+            freqs (np.ndarray): Frequencies of the bins of the spectra recorded.
+            edges: Lower and upper edges of the bands, see parse_bands. 1/12 octave bands if None.
+            dtype (str): 'u1' for 8-bit levels or 'u2' for 16-bit ones.
+            db_min (float): Level stored as 0. Lower levels are stored as 0 too.
+            db_step (float): dB per unit of the stored levels. See DEFAULT_STEPS for the default ones.
+            chunk_rows (int): Number of spectra written at once.
+            channel (int): Channel recorded from multichannel spectra.
+        """
+        lower, upper = octave_band_edges(12) if edges is None else edges
+        self.reducer = BandReducer(freqs, lower, upper)
+        self.dtype = np.dtype(dtype).str[1:]
+        self.db_min = db_min
+        self.db_step = DEFAULT_STEPS[self.dtype] if db_step is None else db_step
+        self.channel = channel
+        self.file_name = file_name
+        self.metadata = {'version': 1, 'dtype': self.dtype, 'db_min': self.db_min, 'db_step': self.db_step,
+                         'lower': self.reducer.lower.tolist(), 'upper': self.reducer.upper.tolist()}
+        self.record_dtype = _record_dtype(len(self.reducer.centers), self.dtype)
+        self._chunk = np.zeros(chunk_rows, dtype=self.record_dtype)
+        self._rows = 0  # Rows in the chunk
+        self._file = self._open()
+
+    def _open(self):
+        if os.path.exists(self.file_name) and os.path.getsize(self.file_name):
+            metadata, header_size = _read_header(self.file_name)
+            if metadata != json.loads(json.dumps(self.metadata)):
+                raise ValueError("%s has other bands or levels" % self.file_name)
+            f = open(self.file_name, 'r+b')
+            # A record cut by a crash is dropped
+            size = os.path.getsize(self.file_name)
+            f.truncate(size - (size - header_size) % self.record_dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            return f
+        f = open(self.file_name, 'wb')
+        f.write(_header(self.metadata))
+        f.flush()
+        return f
+
+    def add(self, spectrum, timestamp):
+        """Add a spectrum in dB measured at the given time"""
+        spectrum = np.asarray(spectrum)
+        if spectrum.ndim == 2:
+            spectrum = spectrum[self.channel]
+        record = self._chunk[self._rows]
+        record['time'] = timestamp
+        record['levels'] = quantize(self.reducer(spectrum), self.dtype, self.db_min, self.db_step)
+        self._rows += 1
+        if self._rows == len(self._chunk):
+            self.flush()
+
+    def __call__(self, measurement):
+        if 'spectrum' in measurement:
+            self.add(measurement['spectrum'], measurement['time'])
+
+    def flush(self):
+        """Append the spectra in the chunk to the file"""
+        if self._rows:
+            self._file.write(self._chunk[:self._rows].tobytes())
+            self._file.flush()
+            self._rows = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class SpectrogramArchive:
+    """
+    Reader of a spectrogram archive, memory-mapped.
+
+    Opening it only reads its header, and the spectra of a time range are found by a binary search of the timestamps,
+    so only the pages of the spectra read are loaded, whatever the size of the file.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.metadata, self.header_size = _read_header(file_name)
+        self.lower = np.array(self.metadata['lower'])
+        self.upper = np.array(self.metadata['upper'])
+        self.centers = np.sqrt(self.lower * self.upper)
+        self.db_min = self.metadata['db_min']
+        self.db_step = self.metadata['db_step']
+        self.record_dtype = _record_dtype(len(self.centers), self.metadata['dtype'])
+        self.records = np.zeros(0, dtype=self.record_dtype)
+        self.refresh()
+
+    def refresh(self):
+        """Map the spectra appended since the archive was opened"""
+        rows = (os.path.getsize(self.file_name) - self.header_size) // self.record_dtype.itemsize
+        if rows != len(self.records):
+            self.records = (np.memmap(self.file_name, dtype=self.record_dtype, mode='r', offset=self.header_size,
+                                      shape=(rows,)) if rows > 0 else np.zeros(0, dtype=self.record_dtype))
+        return len(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def start(self):
+        return float(self.records[0]['time']) if len(self) else None
+
+    @property
+    def end(self):
+        return float(self.records[-1]['time']) if len(self) else None
+
+    def index(self, timestamp):
+        """Return the index of the first spectrum at the timestamp or later"""
+        # bisect reads a few timestamps, while searchsorted would copy the whole strided column
+        return bisect.bisect_left(self.records['time'], timestamp)
+
+    def read(self, first, last, step=1):
+        """
+        Return the spectra from the index first to last (not included), taking one of every step.
+
+        Returns:
+            (np.ndarray, np.ndarray): Their timestamps and their levels in dB, of shape (spectra, bands).
+
+        """
+        records = self.records[first:last:step]
+        return np.array(records['time']), dequantize(records['levels'], self.db_min, self.db_step)
+
+    def range(self, start, end, max_rows=None):
+        """
+        Return the spectra from the timestamp start to end (not included), as in read.
+
+        If there are more than max_rows of them, evenly spaced ones are returned, so long ranges are read as fast as
+        short ones.
+        """
+        first, last = self.index(start), self.index(end)
+        step = 1 if max_rows is None else max(1, -(-(last - first) // max_rows))
+        return self.read(first, last, step)
+
+
+class ArchivePlot:
+    """
+    A span of a spectrogram archive, drawn as an image with the frequencies in a logarithmic scale.
+
+    Spans longer than rows spectra are drawn with evenly spaced ones, so any span is drawn reading at most rows of
+    them.
+    """
+    ticks = (31.5, 63, 125, 250, 500, 1000, 2000, 4000, 8000, 16000)  # Frequencies labelled
+
+    def __init__(self, place, canvas, archive, rows=600, dynamic_range=80., cmap='summer'):
+        """
+        Args:
+            place: The axes where the spectrogram is drawn.
+            canvas: The canvas of the figure.
+            archive (SpectrogramArchive): The archive shown.
+            rows (int): Maximum number of spectra drawn.
+            dynamic_range (float): Range of levels shown, in dB below the maximum of the span.
+            cmap: The colormap of the image.
+        """
+        self.place = place
+        self.canvas = canvas
+        self.archive = archive
+        self.rows = rows
+        self.dynamic_range = dynamic_range
+        bands = len(archive.centers)
+        self.image = place.imshow(np.zeros((1, bands), dtype=np.float32), origin='lower', aspect='auto',
+                                  interpolation='nearest', cmap=cmap, extent=(-0.5, bands - 0.5, 0, 1))
+        # Bands are equally spaced in the image, so the ticks are placed by interpolating in their centers
+        ticks = [f for f in self.ticks if archive.centers[0] <= f <= archive.centers[-1]]
+        place.set_xticks(np.interp(np.log(ticks), np.log(archive.centers), np.arange(bands)))
+        place.set_xticklabels(["%gk" % (f / 1000) if f >= 1000 else "%g" % f for f in ticks])
+        place.set_xlabel("frequency (Hz)")
+
+    def show(self, end, span):
+        """Draw the spectra of the span seconds before the timestamp end"""
+        times, levels = self.archive.range(end - span, end, self.rows)
+        if len(times):
+            self.image.set_data(levels)
+            self.image.set_extent((-0.5, levels.shape[1] - 0.5, times[0] - end, 0))
+            high = levels.max()
+            self.image.set_clim(high - self.dynamic_range, high)
+        else:
+            self.image.set_data(np.zeros((1, len(self.archive.centers)), dtype=np.float32))
+            self.image.set_extent((-0.5, len(self.archive.centers) - 0.5, -span, 0))
+        self.place.set_ylim(-span, 0)
+        self.place.set_ylabel("seconds before %s" % datetime.datetime.fromtimestamp(end).strftime("%Y-%m-%d %H:%M:%S"))
+        self.canvas.draw()
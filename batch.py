@@ -0,0 +1,241 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Analyze directories of WAV recordings in parallel, as the Listener would have analyzed them live"""
+
+import argparse
+import csv
+import os
+import struct
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from levels import BandAnalyzer, LevelStatistics
+from pipeline import Pipeline, level_stages
+from sonometer import Streak
+from spectral import SpectrumAnalyzer
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+SEGMENT_BLOCKS = 1000  # Blocks analyzed in each task of the pool
+
+
+def wav_layout(file_name):
+    """
+    Read the header of a 16-bit PCM WAV file.
+
+    Returns:
+        (int, int, int, int): The sampling rate, the number of channels, the offset of the samples in the file and the
+                              number of frames.
+
+    """
+    with open(file_name, 'rb') as f:
+        riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave_id != b'WAVE':
+            raise ValueError("%s is not a WAV file" % file_name)
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("%s has no data" % file_name)
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                f.seek(chunk_size - 16 + chunk_size % 2, 1)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError("%s has no format chunk" % file_name)
+                tag, channels, rate, _, _, bits = fmt
+                if tag not in (1, 0xFFFE) or bits != 16:
+                    raise ValueError("Only 16-bit PCM WAV files are supported")
+                offset = f.tell()
+                # Files being written might have a wrong size in the header
+                size = min(chunk_size, os.path.getsize(file_name) - offset)
+                return rate, channels, offset, size // (2 * channels)
+            else:
+                f.seek(chunk_size + chunk_size % 2, 1)
+
+
+def open_samples(file_name):
+    """
+    Return the sampling rate, the number of channels and the samples of a WAV file, memory-mapped.
+
+    The samples of multichannel files have shape (frames, channels), a view of the interleaved data in the file.
+    """
+    rate, channels, offset, frames = wav_layout(file_name)
+    shape = (frames, channels) if channels > 1 else (frames,)
+    if not frames:
+        return rate, channels, np.zeros(shape, dtype='<i2')
+    return rate, channels, np.memmap(file_name, dtype='<i2', mode='r', offset=offset, shape=shape)
+
+
+def block_count(frames, window, hop):
+    """Number of complete windows in a recording, as delivered by a Listener"""
+    return 0 if frames < window else (frames - window) // hop + 1
+
+
+def _stream_tail(samples, first, window, hop, size):
+    """Last size samples of the stream of windows fed to the analyzer before the window of index first"""
+    parts = []
+    k = first - 1
+    while k >= 0 and sum(len(p) for p in parts) < size:
+        parts.insert(0, samples[k * hop:k * hop + window])
+        k -= 1
+    return np.concatenate(parts)[-size:] if parts else samples[:0]
+
+
+def analyze_segment(file_name, interval, hop, first, last, fft_size=8192, spectrum=False):
+    """
+    Analyze the windows of index first to last (not included) of a WAV file.
+
+    Args:
+        file_name (str): Path to the WAV file.
+        interval (float): Seconds of audio in each window.
+        hop (float): Seconds between the starts of consecutive windows. None for no overlap.
+        first (int): Index of the first window.
+        last (int): Index after the last window.
+        fft_size (int): Samples in each frame of the spectrum.
+        spectrum (bool): Whether to compute the spectrum of each window.
+
+    Returns:
+        dict: Columns with the results of the windows. For multichannel files, they have an axis for the channels
+              after the one of the windows.
+
+    """
+    rate, channels, samples = open_samples(file_name)
+    window = int(rate * interval)
+    step = int(rate * hop) if hop else int(rate * interval)
+
+    band_analyzer = BandAnalyzer(rate, reference=32768.)
+    if first > 0:
+        # The analyzer carries samples between windows, so results do not depend on how the file is split
+        tail = _stream_tail(samples, first, window, step, band_analyzer.history_size)
+        band_analyzer.prime(tail, first * window)
+    spectrum_analyzer = SpectrumAnalyzer(rate, fft_size, output='db') if spectrum else None
+
+    n = last - first
+    shape = (n, channels) if channels > 1 else (n,)
+    columns = {'time': (first + np.arange(n)) * step / rate,
+               'intensity': np.empty(shape), 'A': np.full(shape, np.nan, dtype=np.float32),
+               'C': np.full(shape, np.nan, dtype=np.float32), 'Z': np.full(shape, np.nan, dtype=np.float32),
+               'third_octave': np.full(shape + (len(band_analyzer.centers[3]),), np.nan, dtype=np.float32)}
+    if spectrum:
+        columns['spectrum'] = np.empty(shape + (len(spectrum_analyzer.freqs),), dtype=np.float32)
+    pipeline = Pipeline(level_stages(band_analyzer, spectrum_analyzer), channels=channels)
+    for i, k in enumerate(range(first, last)):
+        measurement = pipeline(samples[k * step:k * step + window])  # A view of the mapped file
+        for key in ('intensity', 'A', 'C', 'Z', 'spectrum'):
+            if key in measurement:
+                columns[key][i] = measurement[key]
+        if 3 in measurement:
+            columns['third_octave'][i] = measurement[3]
+    return columns
+
+
+def summarize(columns, channel=0):
+    """
+    Return the Streak-style statistics of the intensity and the statistics of the A-weighted levels of a file.
+
+    For multichannel files, those of the given channel are returned.
+    """
+    intensity, a_levels = columns['intensity'], columns['A']
+    if intensity.ndim == 2:
+        intensity, a_levels = intensity[:, channel], a_levels[:, channel]
+    streak = Streak(max(len(intensity), 1), keep_data=False)
+    for i, y in enumerate(intensity):
+        if i == 0:
+            streak.add_first(0, y)
+        else:
+            streak.add(y)
+    levels = LevelStatistics()
+    for level in a_levels:
+        levels.add(float(level))
+    summary = {'blocks': len(streak), 'mean': streak.mean(), 'err': streak.err(), 'min': streak.min,
+               'max': streak.max}
+    for key, value in levels.summary().items():
+        if key != 'count':
+            summary['LA' + key[1:] if key.startswith('L') else key] = value
+    return summary
+
+
+def find_wavs(paths):
+    """Return the WAV files in the given files and directories, searched recursively"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, n) for n in sorted(names) if n.lower().endswith('.wav')]
+        else:
+            files.append(path)
+    return files
+
+
+def analyze_files(files, interval=0.3, hop=None, workers=None, spectrum=False, segment_blocks=SEGMENT_BLOCKS):
+    """
+    Analyze WAV files in a pool of processes, yielding the results of each file once complete.
+
+    Files are split in segments of windows, so a few long files also keep all the workers busy.
+
+    Yields:
+        (str, dict): The name of each file and the columns with the results of its windows.
+
+    """
+    tasks = []
+    for file_name in files:
+        rate, channels, _, frames = wav_layout(file_name)
+        n = block_count(frames, int(rate * interval), int(rate * hop) if hop else int(rate * interval))
+        tasks.append([(first, min(first + segment_blocks, n)) for first in range(0, n, segment_blocks)])
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [[pool.submit(analyze_segment, file_name, interval, hop, first, last, spectrum=spectrum)
+                    for first, last in segments] for file_name, segments in zip(files, tasks)]
+        for file_name, file_futures in zip(files, futures):
+            parts = [f.result() for f in file_futures]
+            if not parts:
+                yield file_name, None
+                continue
+            yield file_name, {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("paths", nargs="+", help="WAV files or directories with them")
+    parser.add_argument("--output", default="analysis", help="Directory where the results are written")
+    parser.add_argument("--interval", type=float, default=0.3, help="Seconds of audio per point")
+    parser.add_argument("--hop", type=float, help="Seconds between the starts of consecutive points")
+    parser.add_argument("--workers", type=int, help="Number of processes. All the cores by default.")
+    parser.add_argument("--spectrum", action="store_true", help="Also store the spectrum in dB of each point")
+    parser.add_argument("--no-summary", action="store_true", help="Do not write the summary of each file")
+    args = parser.parse_args()
+
+    files = find_wavs(args.paths)
+    os.makedirs(args.output, exist_ok=True)
+    start = time.perf_counter()
+    summaries = []
+    for file_name, columns in analyze_files(files, args.interval, args.hop, args.workers, args.spectrum):
+        if columns is None:
+            print("%s: shorter than the interval, skipped" % file_name, file=sys.stderr)
+            continue
+        base = os.path.splitext(os.path.relpath(file_name))[0].replace(os.sep, '_').lstrip('._')
+        centers = BandAnalyzer(wav_layout(file_name)[0]).centers[3]
+        np.savez(os.path.join(args.output, base + '.npz'), third_octave_centers=centers, **columns)
+        if not args.no_summary:
+            channels = columns['intensity'].shape[1] if columns['intensity'].ndim == 2 else 1
+            summaries += [(file_name, channel, summarize(columns, channel)) for channel in range(channels)]
+        print("%s: %d points" % (file_name, len(columns['time'])), file=sys.stderr)
+
+    if summaries:
+        with open(os.path.join(args.output, 'summary.csv'), 'w', newline='') as f:
+            writer = csv.writer(f)
+            keys = list(summaries[0][2])
+            writer.writerow(['file', 'channel'] + keys)
+            for file_name, channel, summary in summaries:
+                writer.writerow([file_name, channel] + ["" if summary[k] is None else summary[k] for k in keys])
+    print("%d files analyzed in %.1f s" % (len(files), time.perf_counter() - start), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Benchmark the analysis and render hot paths with synthetic audio and an offscreen canvas"""
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from threading import Thread
+
+import numpy as np
+import matplotlib
+
+matplotlib.use('Agg')
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from archive import BandReducer, octave_band_edges, quantize
+from freqmeter import Spectrogram, data_to_freq
+from history import HistoryPlot, LevelHistory
+from levels import BandAnalyzer
+from pipeline import BandStage, IntensityStage, PeakStage, Pipeline, data_to_intensity, measure
+from sonometer import IntensityPlot, Streak
+from server import MeasurementClient, MeasurementServer
+from spectral import SpectrumAnalyzer, ToneAnalyzer, interpolate_peak
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+RATE = 44100
+
+
+def synthetic_block(interval, rate=RATE, seed=0):
+    """Return the bytes of a block of int16 audio with a tone over white noise"""
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(rate * interval)) / rate
+    samples = 8000 * np.sin(2 * np.pi * 440 * t) + rng.normal(0, 2000, len(t))
+    return np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+
+
+def time_call(f, repeat):
+    """Return the median time of a call to f, in seconds"""
+    f()  # Warm up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def allocated_bytes(f):
+    """Return the peak of the memory allocated during a call to f, in bytes"""
+    f()  # Warm up caches
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        f()
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+
+
+def bench_analysis(intervals, repeat):
+    """Time each analysis of a block for several intervals"""
+    results = []
+    for interval in intervals:
+        data = synthetic_block(interval)
+        samples = np.frombuffer(data, np.int16)
+        analyzer = SpectrumAnalyzer(RATE, 8192, window='hann', output='db')
+        band_analyzer = BandAnalyzer(RATE, reference=32768.)
+        measure_analyzer = BandAnalyzer(RATE, reference=32768.)
+        # The same audio in 8 interleaved channels, all analyzed in one call
+        multichannel_data = np.repeat(samples, 8).tobytes()
+        multichannel_analyzer = BandAnalyzer(RATE, reference=32768.)
+        # The stages of the sonometer window, sharing a single decoding of the block
+        pipeline = Pipeline([IntensityStage(), PeakStage(), BandStage(BandAnalyzer(RATE, reference=32768.))])
+        # Eight target frequencies, evaluated without the whole spectrum, and the peak of a smaller one
+        tone_analyzer = ToneAnalyzer(RATE, 50. * np.arange(1, 9), output='db')
+        peak_analyzer = SpectrumAnalyzer(RATE, 4096, window='hann', output='db')
+        # A spectrum reduced to 1/12 octave bands and quantized, as archived
+        spectrum = analyzer(samples)
+        reducer = BandReducer(analyzer.freqs, *octave_band_edges(12))
+        analyses = [
+            ('data_to_intensity', lambda: data_to_intensity(data)),
+            ('data_to_freq', lambda: data_to_freq(data)),
+            ('spectrum', lambda: analyzer(samples)),
+            ('bands', lambda: band_analyzer(samples)),
+            ('measure', lambda: measure(data, measure_analyzer)),
+            ('measure_8_channels', lambda: measure(multichannel_data, multichannel_analyzer, channels=8)),
+            ('pipeline', lambda: pipeline(data)),
+            ('tones', lambda: tone_analyzer(samples)),
+            ('tones_8_channels', lambda: tone_analyzer(np.frombuffer(multichannel_data, np.int16).reshape(-1, 8))),
+            ('dominant_peak', lambda: interpolate_peak(peak_analyzer(samples), peak_analyzer.freqs)),
+            ('archive_reduction', lambda: quantize(reducer(spectrum))),
+        ]
+        for name, f in analyses:
+            seconds = time_call(f, repeat)
+            results.append({'benchmark': 'analysis', 'name': name, 'interval': interval,
+                            'seconds_per_block': seconds, 'allocated_bytes': allocated_bytes(f),
+                            'realtime_factor': interval / seconds, 'max_rate': RATE * interval / seconds})
+    return results
+
+
+def _streaks(count, points_max, length, rng):
+    streaks = []
+    for i in range(count):
+        s = Streak(points_max, keep_data=False)
+        s.add_first((i * 7) % points_max, rng.uniform(1e5, 2e5))
+        for _ in range(length - 1):
+            s.add(rng.uniform(1e5, 2e5))
+        streaks.append(s)
+    return streaks
+
+
+def bench_render(history_lengths, streak_counts, repeat):
+    """Time a frame of the intensity plot for several numbers of points and of saved streaks"""
+    results = []
+    rng = np.random.RandomState(0)
+    for points_max in history_lengths:
+        for streak_count in streak_counts:
+            figure = Figure(figsize=(5, 4), dpi=100)
+            canvas = FigureCanvasAgg(figure)
+            plot = IntensityPlot(figure.add_subplot(111), canvas, points_max)
+            # Saved streaks plus one being recorded
+            streaks = _streaks(streak_count, points_max, 20, rng) + _streaks(1, points_max, 2, rng)
+            plot.invalidate_streaks()
+            for _ in range(points_max):
+                plot.add(rng.uniform(1e5, 2e5))
+            plot.draw(streaks)
+
+            def frame():
+                value = rng.uniform(1e5, 2e5)
+                plot.add(value)
+                streaks[-1].add(value)
+                plot.draw(streaks)
+
+            def full_frame():
+                plot.invalidate_streaks()
+                plot.draw(streaks)
+
+            results.append({'benchmark': 'render', 'name': 'intensity_plot', 'points_max': points_max,
+                            'streaks': streak_count, 'seconds_per_frame': time_call(frame, repeat),
+                            'seconds_per_full_frame': time_call(full_frame, max(1, repeat // 10))})
+    return results
+
+
+def bench_spectrogram(depths, repeat, interval=0.3):
+    """Time a frame of the spectrogram for several depths"""
+    results = []
+    analyzer = SpectrumAnalyzer(RATE, 8192, window='hann', output='db')
+    levels = analyzer(np.frombuffer(synthetic_block(interval), np.int16))
+    for depth in depths:
+        figure = Figure(figsize=(5, 4), dpi=100)
+        canvas = FigureCanvasAgg(figure)
+        spectrogram = Spectrogram(figure.add_subplot(111), analyzer.freqs, depth, interval)
+        spectrogram.set_max_bin(600)
+
+        def frame():
+            spectrogram.add(levels)
+            canvas.draw()
+
+        results.append({'benchmark': 'render', 'name': 'spectrogram', 'depth': depth,
+                        'seconds_per_frame': time_call(frame, repeat)})
+    return results
+
+
+def bench_history(spans, repeat, interval=0.3, duration=7 * 86400):
+    """Time a frame of the history plot for several spans, over a history of the given duration in seconds"""
+    history = LevelHistory(decibels=True)
+    rng = np.random.RandomState(0)
+    start = time.time() - duration
+    for i, level in enumerate(rng.uniform(40, 60, int(duration / interval))):
+        history.add(level, start + i * interval)
+    figure = Figure(figsize=(5, 4), dpi=100)
+    canvas = FigureCanvasAgg(figure)
+    plot = HistoryPlot(figure.add_subplot(111), canvas, history)
+    results = []
+    for span in spans:
+        plot.set_span(span)
+
+        def frame():
+            plot.draw()
+            canvas.draw()
+
+        results.append({'benchmark': 'render', 'name': 'history', 'span': span, 'points': len(history),
+                        'seconds_per_frame': time_call(frame, repeat)})
+    return results
+
+
+def bench_server(client_counts, batch_sizes, count=20000):
+    """Publish measurements as fast as possible to loopback clients, timing the publication and counting deliveries"""
+    measurement = measure(synthetic_block(0.3), BandAnalyzer(RATE, reference=32768.))
+    results = []
+    for clients in client_counts:
+        for batch_size in batch_sizes:
+            server = MeasurementServer(port=0, batch_size=batch_size, queue_size=1024)
+            server.start()
+            received = [0] * clients
+            connections = [MeasurementClient(*server.address) for _ in range(clients)]
+
+            def receive(i):
+                for frame in connections[i].frames():
+                    received[i] += 1
+
+            threads = [Thread(target=receive, args=(i,), daemon=True) for i in range(clients)]
+            for t in threads:
+                t.start()
+            while len(server.subscribers) < clients:
+                time.sleep(0.01)
+            start = time.perf_counter()
+            for _ in range(count):
+                server.publish(measurement)
+            server.flush()
+            elapsed = time.perf_counter() - start
+            time.sleep(0.5)  # Let the clients receive what was sent
+            server.stop()
+            for t in threads:
+                t.join(1)
+            frames = -(-count // batch_size)
+            results.append({'benchmark': 'server', 'name': 'publish', 'clients': clients, 'batch_size': batch_size,
+                            'seconds_per_measurement': elapsed / count,
+                            'delivered': sum(received) / (frames * clients) if clients else 1.0})
+    return results
+
+
+def min_interval(analysis_results, name='measure'):
+    """Return the smallest interval whose analysis takes less than the interval itself"""
+    feasible = [r['interval'] for r in analysis_results if r['name'] == name and r['realtime_factor'] > 1]
+    return min(feasible) if feasible else None
+
+
+# Fields of the results describing the case measured, which identify it between runs
+PARAMETERS = ('benchmark', 'name', 'interval', 'points_max', 'streaks', 'depth', 'span', 'points', 'clients',
+              'batch_size')
+
+
+def _key(result):
+    return tuple((k, result[k]) for k in PARAMETERS if k in result)
+
+
+def compare(old, new):
+    """Print the ratio of the times of two runs, matching results by their parameters"""
+    old_results = {_key(r): r for r in old['results']}
+    for result in new['results']:
+        previous = old_results.get(_key(result))
+        if previous is None:
+            continue
+        for metric in ('seconds_per_block', 'seconds_per_frame', 'seconds_per_full_frame', 'seconds_per_measurement'):
+            if metric in result and metric in previous:
+                params = ", ".join("%s=%s" % (k, v) for k, v in _key(result) if k not in ('benchmark', 'name'))
+                print("%-18s %-30s %-22s %8.3fx" % (result['name'], params, metric, result[metric] / previous[metric]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", default="benchmark.json", help="File where the results are saved as JSON")
+    parser.add_argument("--compare", help="Results of a previous run to compare with")
+    parser.add_argument("--quick", action="store_true", help="Fewer repetitions and cases")
+    args = parser.parse_args()
+
+    repeat = 5 if args.quick else 50
+    intervals = [0.01, 0.1, 0.3] if args.quick else [0.005, 0.01, 0.02, 0.05, 0.1, 0.3, 1.0]
+    history_lengths = [80, 800] if args.quick else [80, 800, 8000]
+    streak_counts = [0, 10] if args.quick else [0, 10, 100]
+    depths = [200] if args.quick else [200, 1000]
+
+    results = bench_analysis(intervals, repeat)
+    results += bench_render(history_lengths, streak_counts, repeat)
+    results += bench_spectrogram(depths, repeat)
+    if args.quick:
+        results += bench_history([60, 3600, 86400], repeat, duration=86400)
+    else:
+        results += bench_history([60, 3600, 86400, 7 * 86400], max(1, repeat // 5))
+    results += bench_server([1, 8] if args.quick else [1, 8, 32], [1, 10])
+    run = {'metadata': {'date': datetime.datetime.now().isoformat(), 'python': sys.version.split()[0],
+                        'numpy': np.__version__, 'matplotlib': matplotlib.__version__,
+                        'platform': platform.platform(), 'rate': RATE},
+           'min_interval': min_interval(results),
+           'results': results}
+
+    for r in results:
+        if r['benchmark'] == 'server':
+            print("%-18s clients=%-3d batch=%-4d %10.2f us/measurement  %.0f%% of frames delivered" %
+                  (r['name'], r['clients'], r['batch_size'], r['seconds_per_measurement'] * 1e6,
+                   100 * r['delivered']))
+        elif r['benchmark'] == 'analysis':
+            print("%-18s interval=%-6g %10.1f us/block %10d B  x%.0f real time" %
+                  (r['name'], r['interval'], r['seconds_per_block'] * 1e6, r['allocated_bytes'], r['realtime_factor']))
+        else:
+            params = ", ".join("%s=%s" % (k, r[k]) for k in ('points_max', 'streaks', 'depth', 'span') if k in r)
+            print("%-18s %-26s %10.2f ms/frame" % (r['name'], params, r['seconds_per_frame'] * 1e3))
+    print("Smallest interval analyzed in real time: %s s" % run['min_interval'])
+
+    with open(args.output, 'w') as f:
+        json.dump(run, f, indent=1)
+    print("Results saved as %s" % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Preallocated buffers used to move audio data between threads"""
+
+import time
+
+import numpy as np
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+
+class BlockRing:
+    """
+    A ring of fixed-size blocks of bytes for a single producer and a single consumer.
+
+    The producer and the consumer each change only their own counter, so no lock is taken, not even to wake the
+    consumer: it polls the counters while the ring is empty. The producer never waits: when the ring is full the block
+    is dropped and counted as an overrun.
+    """
+
+    def __init__(self, block_bytes, capacity, poll_seconds=0.005):
+        """
+        Args:
+            block_bytes (int): Maximum size of a block.
+            capacity (int): Number of blocks the ring can hold.
+            poll_seconds (float): Time the consumer sleeps between checks of an empty ring, so the most a block can
+                                  wait before being taken out.
+        """
+        self.buffer = np.zeros((capacity, block_bytes), dtype=np.uint8)
+        self.lengths = np.zeros(capacity, dtype=np.int64)
+        self.timestamps = np.zeros(capacity)
+        self.latencies = np.full(capacity, np.nan)
+        self.last_timestamp = 0.0  # Timestamp of the last block taken out
+        self.last_latency = None  # Latency of the last block taken out, if known
+        self.capacity = capacity
+        self.head = 0  # Blocks written. Only changed by the producer.
+        self.tail = 0  # Blocks read. Only changed by the consumer.
+        self.overruns = 0  # Blocks dropped because the ring was full
+        self.closed = False
+        self.poll_seconds = poll_seconds
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def put(self, data, timestamp=0.0, latency=None):
+        """
+        Copy a block, its timestamp and its latency, if known, into the ring.
+
+        Returns:
+            bool: False, counting an overrun, if the ring is full.
+
+        """
+        if self.head - self.tail >= self.capacity:
+            self.overruns += 1
+            return False
+        slot = self.head % self.capacity
+        n = len(data)
+        self.buffer[slot, :n] = np.frombuffer(data, np.uint8)
+        self.lengths[slot] = n
+        self.timestamps[slot] = timestamp
+        self.latencies[slot] = np.nan if latency is None else latency
+        self.head += 1
+        return True
+
+    def get(self, timeout=None):
+        """
+        Take the oldest block out of the ring, waiting for it if needed.
+
+        Returns:
+            bytes: The block, or None if the ring was closed and is empty or the timeout expired.
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.head == self.tail:
+            if self.closed or (deadline is not None and time.monotonic() >= deadline):
+                return None
+            time.sleep(self.poll_seconds)
+        slot = self.tail % self.capacity
+        data = self.buffer[slot, :self.lengths[slot]].tobytes()
+        self.last_timestamp = self.timestamps[slot]
+        latency = self.latencies[slot]
+        self.last_latency = None if np.isnan(latency) else float(latency)
+        self.tail += 1
+        return data
+
+    def close(self):
+        """Stop the consumer once the ring is empty. Blocks already in the ring can still be read."""
+        self.closed = True
+
+
+class Windower:
+    """
+    Re-aggregate a stream of blocks of bytes into windows of a fixed size, possibly overlapping.
+
+    The sizes can be changed at any moment without losing the data already buffered.
+    """
+
+    def __init__(self, window_bytes, hop_bytes=None):
+        """
+        Args:
+            window_bytes (int): Size of each window.
+            hop_bytes (int): Distance between the starts of consecutive windows. None for no overlap.
+        """
+        self.buffer = bytearray()
+        self.window_bytes = None
+        self.hop_bytes = None
+        self.set_size(window_bytes, hop_bytes)
+
+    def set_size(self, window_bytes, hop_bytes=None):
+        if hop_bytes is None:
+            hop_bytes = window_bytes
+        if not 0 < hop_bytes <= window_bytes:
+            raise ValueError("The hop must be positive and not greater than the window")
+        self.window_bytes = window_bytes
+        self.hop_bytes = hop_bytes
+
+    def push(self, data):
+        """Add a block, returning the list of windows completed with it"""
+        self.buffer += data
+        windows = []
+        while len(self.buffer) >= self.window_bytes:
+            windows.append(bytes(self.buffer[:self.window_bytes]))
+            del self.buffer[:self.hop_bytes]
+        return windows
+
+    def clear(self):
+        del self.buffer[:]
@@ -0,0 +1,339 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Enumeration of the input devices in the background, and recovery of the streams of devices that fail"""
+
+import json
+import subprocess
+import sys
+import time
+from threading import Event, Lock, Thread
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+# Enumerates the PortAudio input devices of a host api (the default one if None) and prints them as JSON
+_SCAN_CODE = """
+import json, sys
+import pyaudio
+p = pyaudio.PyAudio()
+api = p.get_default_host_api_info()['index'] if sys.argv[1] == 'None' else int(sys.argv[1])
+devices = [p.get_device_info_by_host_api_device_index(api, i)
+           for i in range(p.get_host_api_info_by_index(api)['deviceCount'])]
+print(json.dumps([d for d in devices if d['maxInputChannels']]))
+p.terminate()
+"""
+
+
+def scan_portaudio(api=None, timeout=10.):
+    """
+    Return the input devices of a PortAudio host api, as dicts like those of PortAudioSource.device_list.
+
+    PortAudio only enumerates the devices when it is initialized, which cannot be done again while a stream is open, so
+    the scan runs in a new process. This way devices plugged in or removed since the start are seen.
+
+    Raises:
+        OSError: If the scan fails.
+    """
+    try:
+        result = subprocess.run([sys.executable, "-c", _SCAN_CODE, str(api)], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise OSError("Cannot enumerate the devices: timed out")
+    if result.returncode:
+        lines = result.stderr.decode(errors='replace').strip().splitlines()
+        raise OSError("Cannot enumerate the devices: %s" % (lines[-1] if lines else "error %d" % result.returncode))
+    try:
+        return json.loads(result.stdout.decode())
+    except ValueError as e:
+        raise OSError("Cannot enumerate the devices: %s" % e)
+
+
+def _keys(devices):
+    """Keys identifying the devices between scans, whose indexes can change. Repeated names are numbered."""
+    seen = {}
+    keys = []
+    for device in devices:
+        name = (device.get('hostApi'), device['name'])
+        seen[name] = seen.get(name, 0) + 1
+        keys.append(name + (seen[name],))
+    return keys
+
+
+class DeviceRegistry:
+    """
+    The input devices, enumerated in a background thread and cached.
+
+    Each scan starts a new process, so the devices are scanned when the registry starts, every period seconds and
+    whenever request_scan is called, e.g., by a StreamSupervisor after a failure. Devices plugged in or removed are
+    noticed without blocking the user interface or the capture. Functions added with
+    add_callback are called from the thread of the registry with the lists of devices added and removed, and version
+    increases with each change, so it can be polled from a user interface.
+    """
+
+    def __init__(self, scan=None, period=30.0, api=None, metrics=None):
+        """
+        Args:
+            scan: Function returning the list of input devices, as dicts with at least a 'name' and an 'index'.
+                  scan_portaudio in a new process if None.
+            period (float): Seconds between scans, or None to scan only at the start and when requested.
+            api (int): Index of the PortAudio host api scanned by default. The default one if None.
+            metrics (Metrics): Where the number of devices and scans are recorded, or None.
+        """
+        self.scan = (lambda: scan_portaudio(api)) if scan is None else scan
+        self.period = period
+        self.metrics = metrics
+        self.version = 0  # Number of changes found, the first scan included
+        self.error = None  # Error of the last scan, if it failed
+        self._devices = None  # Devices of the last scan, None until the first one is complete
+        self._callbacks = []
+        self._lock = Lock()
+        self._ready = Event()
+        self._scan_event = Event()
+        self._stop_event = Event()
+        self._thread = None
+
+    @property
+    def devices(self):
+        """List of the devices of the last scan, or None if the first scan has not finished"""
+        with self._lock:
+            return None if self._devices is None else list(self._devices)
+
+    def add_callback(self, callback):
+        """Call a function with the lists of the devices added and removed whenever they change"""
+        self._callbacks.append(callback)
+
+    def find(self, name):
+        """Return the device with the given name, None if it is missing or if the first scan has not finished"""
+        for device in self.devices or []:
+            if device['name'] == name:
+                return device
+        return None
+
+    def is_present(self, name):
+        """Return whether a device is present, or None if it is not known yet"""
+        if self.devices is None:
+            return None
+        return self.find(name) is not None
+
+    def wait(self, timeout=None):
+        """Wait for the first scan to finish, returning whether it did"""
+        return self._ready.wait(timeout)
+
+    def refresh(self):
+        """Scan the devices now, in the calling thread, calling the callbacks if they changed"""
+        try:
+            devices = self.scan()
+        except OSError as e:
+            self.error = e
+            self._ready.set()
+            return
+        self.error = None
+        with self._lock:
+            old = self._devices
+            self._devices = devices
+        if self.metrics is not None:
+            self.metrics.increment('device_scans_total')
+            self.metrics.set('devices', len(devices))
+        if old is None:
+            self.version += 1
+        else:
+            old_keys, new_keys = _keys(old), _keys(devices)
+            added = [d for d, k in zip(devices, new_keys) if k not in old_keys]
+            removed = [d for d, k in zip(old, old_keys) if k not in new_keys]
+            if added or removed or [d['index'] for d in old] != [d['index'] for d in devices]:
+                self.version += 1
+            if added or removed:
+                for callback in self._callbacks:
+                    callback(added, removed)
+        self._ready.set()
+
+    def request_scan(self):
+        """Scan the devices again in the background as soon as possible"""
+        self._scan_event.set()
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._scan_event.clear()
+            self.refresh()
+            self._scan_event.wait(self.period)
+
+    def start(self):
+        """Start scanning in the background. The first scan starts at once."""
+        if self._thread is not None:
+            return False
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop_event.set()
+        self._scan_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class StreamSupervisor:
+    """
+    Reopening of the stream of a live Listener when it fails.
+
+    The stream has failed when its source is no longer active or no block has arrived for stall_seconds, e.g., when a
+    USB microphone is unplugged. The supervisor then reopens it on the same device, retrying every retry_seconds, so the
+    gap in the data is bounded by the time the device is missing plus those two. With fallback, the default input
+    device is used while the device is missing, and the device is taken back as soon as the registry sees it again.
+    The callback of the listener is kept, so its consumers are not aware of the change. The registry is asked to scan
+    the devices every scan_seconds only while the device is missing.
+    """
+
+    def __init__(self, listener, registry=None, stall_seconds=2.0, retry_seconds=1.0, fallback=False,
+                 check_period=0.5, scan_seconds=5.0):
+        """
+        Args:
+            listener (Listener): The listener supervised, with a live source.
+            registry (DeviceRegistry): Devices present, to skip reopening missing ones. None to always try.
+            stall_seconds (float): Seconds without blocks after which the stream has failed.
+            retry_seconds (float): Seconds between attempts to reopen the stream.
+            fallback (bool): Whether to capture from the default input device while the device is missing.
+            check_period (float): Seconds between checks of the stream.
+            scan_seconds (float): Seconds between the scans requested while the device is missing.
+        """
+        self.listener = listener
+        self.registry = registry
+        self.stall_seconds = stall_seconds
+        self.retry_seconds = retry_seconds
+        self.fallback = fallback
+        self.check_period = check_period
+        self.scan_seconds = scan_seconds
+        self.device_name = self._current_device()  # Device to capture from, None for the default one
+        self.on_fallback = False  # Whether capturing from the default device while the device is missing
+        self._last_scan = None  # Time of the last scan requested
+        self._stop_event = Event()
+        self._thread = None
+
+    def _current_device(self):
+        """Name of the device of the source, None for the default one"""
+        source = self.listener.source
+        return None if getattr(source, 'device', None) is None else source.describe()
+
+    def failed(self):
+        """Return whether the stream of the listener has failed"""
+        listener = self.listener
+        if not listener.running:
+            return False
+        if not listener.source.is_active():
+            return True
+        return time.monotonic() - listener.last_block_time > self.stall_seconds
+
+    def _may_be_present(self):
+        """Whether the device might be present, i.e., unless the registry knows it is missing"""
+        if self.registry is None or self.device_name is None:
+            return True
+        return self.registry.is_present(self.device_name) is not False
+
+    def _request_scan(self):
+        """Ask the registry to scan the devices, at most every scan_seconds"""
+        now = time.monotonic()
+        if self.registry is not None and (self._last_scan is None or now - self._last_scan >= self.scan_seconds):
+            self._last_scan = now
+            self.registry.request_scan()
+
+    def _reopen(self, device_name):
+        try:
+            return self.listener.reopen(device_name)
+        except (OSError, ValueError):  # The device is present but cannot be opened yet
+            return False
+
+    def recover(self):
+        """Reopen the stream, retrying until it succeeds or the supervisor is stopped"""
+        listener = self.listener
+        metrics = listener.metrics
+        last_block_time = listener.last_block_time
+        metrics.increment('stream_failures_total')
+        print("Error: the stream of %s failed, reopening it" % (self.device_name or "the default device"),
+              file=sys.stderr)
+        self._last_scan = None  # The first scan is requested at once
+        while not self._stop_event.is_set() and not listener.closed:
+            self._request_scan()
+            if self._may_be_present() and self._reopen(self.device_name):
+                self.on_fallback = False
+                break
+            if self.fallback and self.device_name is not None and self._reopen(None):
+                self.on_fallback = True
+                break
+            self._stop_event.wait(self.retry_seconds)
+        else:
+            return
+        gap = time.monotonic() - last_block_time
+        metrics.increment('stream_recoveries_total')
+        metrics.set('last_stream_gap_seconds', gap)
+        print("Stream reopened on %s after %.1f s" %
+              ("the default device" if self.on_fallback or self.device_name is None else self.device_name, gap),
+              file=sys.stderr)
+
+    def _run(self):
+        while not self._stop_event.wait(self.check_period):
+            if self.failed():
+                self.recover()
+            elif not self.on_fallback and self.listener.running:
+                self.device_name = self._current_device()  # It might have been changed by the user
+            elif self.on_fallback and self.registry is not None:
+                self._request_scan()
+                if not self.registry.is_present(self.device_name):
+                    continue
+                # The device is back
+                if self._reopen(self.device_name):
+                    self.on_fallback = False
+                    self.listener.metrics.increment('device_switches_total')
+                elif not self.listener.running:
+                    self.recover()
+
+    def start(self):
+        if self._thread is not None:
+            return False
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def add_device_arguments(parser):
+    """Add the command line options of the recovery of failed streams to an argparse parser"""
+    parser.add_argument("--no-recover", action="store_true",
+                        help="Do not reopen the stream of a device that fails, e.g., when it is unplugged")
+    parser.add_argument("--fallback", action="store_true",
+                        help="Capture from the default input device while the selected one is missing")
+    parser.add_argument("--rescan", type=float, default=30.0, metavar="SECONDS",
+                        help="Seconds between scans of the devices, to list those plugged in or removed. They are also "
+                             "scanned when a stream fails. 0 to scan only then.")
+
+
+def start_registry(args, metrics=None):
+    """Start a DeviceRegistry of the api given in the command line arguments, returning it, or None with --no-recover"""
+    if args.no_recover:
+        return None
+    registry = DeviceRegistry(period=args.rescan or None, api=args.api, metrics=metrics)
+    registry.start()
+    return registry
+
+
+def start_supervision(args, listeners, registry=None):
+    """
+    Start supervising the live listeners as given in the command line arguments, returning the supervisors.
+
+    The registry, if given, is used to skip missing devices and to take back devices when they return.
+    """
+    if args.no_recover:
+        return []
+    supervisors = [StreamSupervisor(listener, registry, fallback=args.fallback) for listener in listeners
+                   if listener.source.live]
+    for supervisor in supervisors:
+        supervisor.start()
+    return supervisors
@@ -3,173 +3,245 @@
 
 """Listen to sound frequency using a microphone"""
 
-import time
-import threading
+import argparse
 
-import pyaudio  # pip install pyaudio
 import numpy as np
-import matplotlib
 
-matplotlib.use('TkAgg')
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
-from matplotlib import ticker
-
-from tkinter import *
-from tkinter.ttk import *
+from devices import add_device_arguments, start_registry, start_supervision
+from metrics import add_metrics_arguments, start_metrics_exporter
 
 __author__ = 'Dih5'
 __version__ = "0.1.0"
 
-chunk = 1024
-FORMAT = pyaudio.paInt16
-CHANNELS = 1
-
-RATE = 44100  # samples per second
-interval = 0.3  # seconds sampled for a point
-
-points_max = 40  # points kept in the plot
-
-recording = False  # Whether capturing data to take its mean
-
-streaks = []  # Saved streaks of data
-
-lock = threading.Lock()  # A lock for thread synchronization
-
-freq_matrix = []
-
-
-# FIXME: Using the lock leads to interlock death. When two threads ask for it no one returns, I don't know why
-class controlled_execution:
-    def __enter__(self):
-        # return lock.__enter__()
-        return
-
-    def __exit__(self, type, value, traceback):
-        # return lock.__exit__(type, value, traceback)
-        return
-
 
 def data_to_freq(data):
-    return np.abs(np.fft.rfft(np.fromstring(data, np.int16)))
-
-
-p = pyaudio.PyAudio()
-
-api_list = [p.get_host_api_info_by_index(x) for x in range(0, p.get_host_api_count())]
-selected_api = 0
-devices_in_api = api_list[selected_api]['deviceCount']
-print("Available api(s): ")
-print(api_list)
-
-recording_device_list = []
-for x in range(0, devices_in_api):
-    device = p.get_device_info_by_host_api_device_index(selected_api, x)
-    if device['maxInputChannels']:
-        recording_device_list.append(device)
-
-print("Available recording device(s): ")
-print(recording_device_list)
-
-root = Tk()
-root.wm_title("Sound frequency listener")
-figure = Figure(figsize=(5, 4), dpi=100)
-active_subplot = figure.add_subplot(111)
-
-
-# Create a tk.DrawingArea
-canvas = FigureCanvasTkAgg(figure, master=root)
-canvas.show()
-canvas.get_tk_widget().pack(side=TOP, fill=BOTH, expand=1)
-
-
-# Select device
-
-# def _change_device(*args):
-#     global audio_stream
-#     with controlled_execution():
-#         audio_stream.stop_stream()
-#         time.sleep(1)
-#         audio_stream.close()
-#         index = recording_device_list[cmbDevice.current()]['index']
-#         _clear_data()
-#         print("setting device " + str(index))
-#         audio_stream = p.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True,
-#                               frames_per_buffer=int(RATE * interval),
-#                               stream_callback=input_callback, input_device_index=index)
-#         audio_stream.start_stream()
-#
-#
-# varDevice = StringVar()
-# varDevice.set(p.get_default_input_device_info()['name'])
-# cmbDevice = Combobox(master=root, textvariable=varDevice, width=70)
-# device_cmb_list = [x['name'] for x in recording_device_list]
-# cmbDevice["values"] = device_cmb_list
-# cmbDevice.pack(side=BOTTOM)
-#
-# cmbDevice.bind("<<ComboboxSelected>>", _change_device)
-
-
-def _clear_data():
-    global freq_matrix
-    with controlled_execution():
-        freq_matrix = []
-
-
-frmOperations = Frame(master=root)
-frmOperations.pack(side=BOTTOM)
-
-buttonClearPoints = Button(master=frmOperations, text='Clear data', command=_clear_data)
-buttonClearPoints.pack(side=LEFT)
-
-# in rfft n input points produce n/2+1 complex points
-sldScale = Scale(master=root, to=RATE * interval / 2 + 1, orient=HORIZONTAL, length=600)
-sldScale.set(1000)
-sldScale.pack(side=BOTTOM)
-
-
-# To be called when audio is read
-def input_callback(in_data, frame_count, time_info, status_flags):
-    global active_subplot, canvas, streaks, colorbar
-    with controlled_execution():
-        active_subplot.clear()
-        freq_matrix.append(data_to_freq(in_data))
-        points_in_x = int(sldScale.get())
-        try:
-            contour_plot = active_subplot.contourf(np.fft.rfftfreq(int(interval * RATE), d=1. / RATE)[:points_in_x],
-                                               np.arange(0, len(freq_matrix), 1)*interval,
-                                               np.array(freq_matrix)[:, :points_in_x],
-                                               locator=ticker.LogLocator(),
-                                               cmap='summer')
-            active_subplot.set_ylabel("time (s)")
-            active_subplot.set_xlabel("frequency (Hz)")
-        except IndexError:
-            print("Warning: Tried to plot with no points. This may had happened if the data was cleaned.")
-        # figure.colorbar(contour_plot)
+    """Return the modulus of the transform of the whole block, with no window"""
+    return np.abs(np.fft.rfft(np.frombuffer(data, np.int16)))
+
+
+class Spectrogram:
+    """
+    A spectrogram kept in a preallocated ring buffer of fixed depth.
+
+    The buffer is the data of an image artist, so adding a spectrum writes a single row in place instead of redrawing
+    the whole history. Like the sonometer plot, rows are overwritten circularly and a red line marks the newest one.
+    """
+
+    def __init__(self, place, freqs, depth, interval, dynamic_range=80.0, cmap='summer'):
+        """
+        Args:
+            place: The axes where the spectrogram is drawn.
+            freqs (np.ndarray): Frequencies of the bins in each spectrum.
+            depth (int): Number of spectra kept.
+            interval (float): Seconds between consecutive spectra.
+            dynamic_range (float): Range of levels shown, in dB below the maximum found.
+            cmap: The colormap of the image.
+        """
+        self.place = place
+        self.freqs = freqs
+        self.depth = depth
+        self.interval = interval
+        self.dynamic_range = dynamic_range
+        self.current_pos = depth - 1
+        self.max_level = None
+        self.image = place.imshow(np.zeros((depth, len(freqs)), dtype=np.float32), origin='lower', aspect='auto',
+                                  interpolation='nearest', cmap=cmap,
+                                  extent=(freqs[0], freqs[-1], 0, depth * interval))
+        self.data = self.image.get_array()  # The ring buffer, owned by the image
+        self.cursor = place.axhline(0, color='red')
+        place.set_ylabel("time (s)")
+        place.set_xlabel("frequency (Hz)")
+
+    def add(self, levels):
+        """Add a new spectrum, in dB"""
+        self.add_many([levels])
+
+    def add_many(self, spectra):
+        """Add several spectra at once, in dB. Only the last depth of them are written."""
+        spectra = np.asarray(spectra)[-self.depth:]
+        n = len(spectra)
+        if not n:
+            return
+        positions = (self.current_pos + 1 + np.arange(n)) % self.depth
+        self.data.data[positions] = spectra
+        self.current_pos = positions[-1]
+        spectra_max = spectra.max()
+        if self.max_level is None or spectra_max > self.max_level:
+            self.max_level = spectra_max
+            self.image.set_clim(self.max_level - self.dynamic_range, self.max_level)
+        self.image.changed()
+        y = (self.current_pos + 0.5) * self.interval
+        self.cursor.set_ydata([y, y])
+
+    def clear(self):
+        self.data.data[:] = 0
+        self.current_pos = self.depth - 1
+        self.max_level = None
+        self.image.changed()
+        self.cursor.set_ydata([0, 0])
+
+    def set_max_bin(self, points_in_x):
+        """Show only the first bins of the spectra"""
+        points_in_x = min(max(points_in_x, 1), len(self.freqs) - 1)
+        self.place.set_xlim(self.freqs[0], self.freqs[points_in_x])
+
+
+class TrendPlot:
+    """
+    Time series of a few values, drawn as lines over the last points.
+
+    The values are kept in a preallocated array, the newest ones on the right, which is shifted in place when points
+    are added. Missing points are NaN, so they are not drawn.
+    """
+
+    def __init__(self, place, labels, depth, interval, ylabel=None):
+        """
+        Args:
+            place: The axes where the lines are drawn.
+            labels: Name of each series, shown in a legend if there are several.
+            depth (int): Number of points kept.
+            interval (float): Seconds between consecutive points.
+            ylabel (str): Label of the values.
+        """
+        self.place = place
+        self.values = np.full((depth, len(labels)), np.nan)
+        times = interval * (np.arange(depth) - depth + 1)  # Relative to the newest point
+        self.lines = place.plot(times, self.values)
+        place.set_xlim(times[0], 0)
+        place.set_xlabel("time (s)")
+        if ylabel is not None:
+            place.set_ylabel(ylabel)
+        if len(labels) > 1:
+            for line, label in zip(self.lines, labels):
+                line.set_label(label)
+            place.legend(loc='upper left', fontsize='small')
+
+    def add(self, values):
+        """Add a point with a value for each series"""
+        self.add_many([values])
+
+    def add_many(self, points):
+        """Add several points at once"""
+        points = np.asarray(points, dtype=float).reshape(-1, self.values.shape[1])[-len(self.values):]
+        n = len(points)
+        if not n:
+            return
+        self.values[:-n] = self.values[n:]
+        self.values[-n:] = points
+
+    def clear(self):
+        self.values[:] = np.nan
+
+    def draw(self):
+        """Update the lines and fit the vertical axis to the values kept"""
+        for line, series in zip(self.lines, self.values.T):
+            line.set_ydata(series)
+        finite = self.values[np.isfinite(self.values)]
+        if len(finite):
+            low, high = finite.min(), finite.max()
+            margin = max(0.05 * (high - low), 1.)
+            self.place.set_ylim(low - margin, high + margin)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--interval", type=float, default=0.3, help="Seconds sampled for each spectrum")
+    parser.add_argument("--fft-size", type=int,
+                        help="Samples in each frame of the spectral analysis (a power of two). 8192 by default, 4096 "
+                             "with --tones.")
+    parser.add_argument("--history", type=int, default=200, help="Spectra kept in the spectrogram")
+    parser.add_argument("--rate", type=int, default=44100, help="Sampling rate of the device")
+    parser.add_argument("--list-devices", action="store_true", help="Print the available recording devices and exit")
+    parser.add_argument("--device", type=int, help="Index of the input device, as given by --list-devices. It can "
+                                                   "also be changed in the window.")
+    parser.add_argument("--api", type=int, help="Index of the host api of the devices. The default one if not given.")
+    parser.add_argument("--channels", type=int, default=1, help="Channels captured from the device")
+    parser.add_argument("--channel", type=int, default=0, help="Channel analyzed")
+    parser.add_argument("--fps", type=float, default=20., help="Maximum frames per second of the spectrogram")
+    parser.add_argument("--tones", type=lambda s: [float(f) for f in s.split(",")], metavar="F1,F2,...",
+                        help="Track the levels of these frequencies in Hz and the dominant peak instead of showing the "
+                             "spectrogram")
+    parser.add_argument("--archive", metavar="FILE",
+                        help="Keep every spectrum, reduced to logarithmic bands, in this file (continued if it exists)")
+    parser.add_argument("--archive-bands", default="1/12", metavar="BANDS",
+                        help="Bands of the archive: 1/N for 1/N octave bands or N for N log-spaced bands between 20 Hz "
+                             "and 20 kHz")
+    parser.add_argument("--archive-bits", type=int, choices=(8, 16), default=8,
+                        help="Bits of the levels in the archive: 8 for 0.5 dB steps, 16 for 0.01 dB ones")
+    parser.add_argument("--open", metavar="FILE", help="Browse a spectrogram archive instead of capturing")
+    add_device_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    if args.archive is not None and args.tones:
+        parser.error("--archive needs the spectrogram, so it cannot be used with --tones")
+    if args.archive is not None:
+        from archive import parse_bands
 
         try:
-            canvas.draw()
-        except TclError:
-            print("Canvas is no longer available. Stopping input stream.")
-            # Might happen if callbacked before stream destruction
-            return None, pyaudio.paAbort
-        return None, pyaudio.paContinue
-
-
-# Stream file
-audio_stream = p.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=int(RATE * interval),
-                      stream_callback=input_callback)
-
-audio_stream.start_stream()
-
-root.mainloop()
-
-# If you put root.destroy() here, it will cause an error if
-# the window is closed with the window manager.
-
+            archive_edges = parse_bands(args.archive_bands)
+        except ValueError:
+            parser.error("invalid --archive-bands: %s" % args.archive_bands)
+
+    if args.open is not None:
+        from tkinter import Tk
+        from archive import SpectrogramArchive
+        from tkgui import ArchiveWindow
+
+        root = Tk()
+        root.withdraw()
+        window = ArchiveWindow(root, SpectrogramArchive(args.open), title=args.open)
+        window.protocol("WM_DELETE_WINDOW", root.destroy)
+        root.mainloop()
+        return
 
-audio_stream.stop_stream()
+    from sources import PortAudioSource
 
-audio_stream.close()
+    source = PortAudioSource(rate=args.rate, channels=args.channels, device=args.device, api=args.api)
+    if args.list_devices:
+        print("Available api(s): ")
+        print(source.list_api())
+        print("Available recording device(s): ")
+        print(source.device_list())
+        source.close()
+        return
 
-p.terminate()
+    # The devices are enumerated while the user interface is loaded, and again when the stream fails
+    registry = start_registry(args)
+
+    # The user interface is only imported when needed
+    from tkinter import Tk
+    from tkgui import FrequencyListener, ToneListener
+
+    root = Tk()
+    if args.tones:
+        # Only the peak is searched in the spectrum, so a smaller FFT is enough by default
+        app = ToneListener(root, freqs=args.tones, interval=args.interval, fft_size=args.fft_size or 4096,
+                           history_max=args.history, source=source, show_metrics=args.metrics, channel=args.channel,
+                           max_fps=args.fps)
+    else:
+        app = FrequencyListener(root, interval=args.interval, fft_size=args.fft_size or 8192, history_max=args.history,
+                                source=source, show_metrics=args.metrics, channel=args.channel, max_fps=args.fps,
+                                registry=registry)
+        if args.archive is not None:
+            from archive import SpectrogramRecorder
+
+            app.add_recorder(SpectrogramRecorder(args.archive, app.analyzer.freqs, archive_edges,
+                                                 dtype='u1' if args.archive_bits == 8 else 'u2'))
+    if registry is not None:
+        registry.metrics = app.listener.metrics
+    supervisors = start_supervision(args, [app.listener], registry)
+    exporter = start_metrics_exporter(args, app.listener.metrics)
+    app.mainloop()
+    for supervisor in supervisors:
+        supervisor.stop()
+    app.listener.terminate()
+    if not args.tones and app.recorder is not None:
+        app.recorder.close()
+    if registry is not None:
+        registry.stop()
+    if exporter is not None:
+        exporter.stop()
+
+
+if __name__ == "__main__":
+    main()
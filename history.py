@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Long-term history of the measurements, downsampled at several resolutions"""
+
+import time
+
+import numpy as np
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+RESOLUTIONS = (1., 10., 60., 600., 3600.)  # Seconds covered by each point of the downsampled levels
+
+
+class _Table:
+    """
+    Rows of floats in a preallocated array, which doubles its capacity when full.
+
+    Columns are stored contiguously, so they can be searched without copies.
+    """
+
+    def __init__(self, columns, capacity=1024):
+        self.array = np.empty((columns, capacity))
+        self.size = 0
+
+    def append(self, row):
+        if self.size == self.array.shape[1]:
+            array = np.empty((self.array.shape[0], 2 * self.size))
+            array[:, :self.size] = self.array[:, :self.size]
+            self.array = array
+        self.array[:, self.size] = row
+        self.size += 1
+
+    def columns(self):
+        return self.array[:, :self.size]
+
+
+class LevelHistory:
+    """
+    Every value measured, together with their minimum, maximum and mean in bins of fixed duration.
+
+    Each resolution keeps one row per bin, so a view of a long time span is drawn from a few precomputed points. Means
+    of values in dB are taken over their powers if decibels is set, giving the equivalent level of each bin.
+    """
+
+    def __init__(self, resolutions=RESOLUTIONS, decibels=False):
+        """
+        Args:
+            resolutions: Increasing durations of the bins of the downsampled levels, in seconds.
+            decibels (bool): Whether the values are levels in dB.
+        """
+        self.resolutions = tuple(resolutions)
+        self.decibels = decibels
+        self.raw = _Table(2)  # time, value
+        self.levels = [_Table(4) for _ in self.resolutions]  # time (center of the bin), min, max, mean
+        self._pending = [None] * len(self.resolutions)  # [bin, min, max, sum, count] of the bins not yet complete
+
+    def __len__(self):
+        return self.raw.size
+
+    def start_time(self):
+        return self.raw.array[0, 0] if self.raw.size else None
+
+    def end_time(self):
+        return self.raw.array[0, self.raw.size - 1] if self.raw.size else None
+
+    def add(self, value, timestamp=None):
+        """Add a value, measured now unless a timestamp is given. Non-finite values are ignored."""
+        if not np.isfinite(value):
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        self.raw.append((timestamp, value))
+        linear = 10 ** (value / 10) if self.decibels else value
+        for i, resolution in enumerate(self.resolutions):
+            b = int(timestamp // resolution)
+            pending = self._pending[i]
+            if pending is not None and pending[0] != b:
+                self.levels[i].append(self._bin_row(i))
+                pending = None
+            if pending is None:
+                self._pending[i] = [b, value, value, linear, 1]
+            else:
+                pending[1] = min(pending[1], value)
+                pending[2] = max(pending[2], value)
+                pending[3] += linear
+                pending[4] += 1
+
+    def _bin_row(self, i):
+        b, low, high, total, count = self._pending[i]
+        mean = total / count
+        if self.decibels:
+            mean = 10 * np.log10(mean)
+        return (b + 0.5) * self.resolutions[i], low, high, mean
+
+    def level_for(self, start, end, max_points=2000):
+        """Return the index of the finest resolution with at most max_points in [start, end), or None for raw data"""
+        times = self.raw.columns()[0]
+        if np.searchsorted(times, end) - np.searchsorted(times, start) <= max_points:
+            return None
+        for i, resolution in enumerate(self.resolutions):
+            if (end - start) / resolution <= max_points:
+                return i
+        return len(self.resolutions) - 1
+
+    def select(self, start, end, max_points=2000):
+        """
+        Return the points in a time range at the finest resolution giving at most max_points of them.
+
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray, np.ndarray): Times, minima, maxima and means of the points. For the
+                                                              raw data, the last three are the values.
+
+        """
+        level = self.level_for(start, end, max_points)
+        if level is None:
+            times, values = self.raw.columns()
+            first, last = np.searchsorted(times, (start, end))
+            values = values[first:last]
+            return times[first:last], values, values, values
+        columns = self.levels[level].columns()
+        if self._pending[level] is not None:
+            columns = np.column_stack((columns, self._bin_row(level)))
+        first, last = np.searchsorted(columns[0], (start, end))
+        columns = columns[:, first:last]
+        return columns[0], columns[1], columns[2], columns[3]
+
+
+class HistoryPlot:
+    """
+    A view of a LevelHistory in an axes, which can be zoomed with the mouse wheel and panned by dragging.
+
+    While following, the view ends at the last value. Panning to the past stops following, and it is resumed by panning
+    back to the end or calling follow.
+    """
+
+    def __init__(self, place, canvas, history, span=600., max_points=2000, color='C0'):
+        """
+        Args:
+            place: The axes where the history is drawn.
+            canvas: The canvas of the figure of the axes.
+            history (LevelHistory): The values drawn.
+            span (float): Seconds initially shown.
+            max_points (int): Maximum number of points drawn, which sets the resolution used.
+            color: Color of the mean line and the min-max band.
+        """
+        self.place = place
+        self.canvas = canvas
+        self.history = history
+        self.span = span
+        self.max_points = max_points
+        self.color = color
+        self.end = None  # End of the view, None to follow the last value
+        self.resolution = None  # Seconds per point drawn, None for raw data
+
+        self.mean_line, = place.plot([], [], '-', color=color)
+        self.band = None
+        place.xaxis.set_major_formatter(self._format_time)
+        self._drag = None  # (x pixel, end of the view) when the drag started
+        canvas.mpl_connect('scroll_event', self._on_scroll)
+        canvas.mpl_connect('button_press_event', self._on_press)
+        canvas.mpl_connect('motion_notify_event', self._on_motion)
+        canvas.mpl_connect('button_release_event', self._on_release)
+
+    @property
+    def dragging(self):
+        return self._drag is not None
+
+    def _format_time(self, x, pos=None):
+        return time.strftime("%H:%M:%S" if self.span < 86400 else "%d/%m\n%H:%M", time.localtime(x))
+
+    def view(self):
+        """Return the start and end of the view"""
+        end = self.end
+        if end is None:
+            end = self.history.end_time()
+            if end is None:
+                end = time.time()
+        return end - self.span, end
+
+    def follow(self):
+        self.end = None
+        self.draw()
+
+    def set_span(self, span):
+        """Show the given number of seconds, keeping the end of the view"""
+        self.span = min(max(span, 10.), 366 * 86400.)
+        self.draw()
+
+    def draw(self):
+        start, end = self.view()
+        level = self.history.level_for(start, end, self.max_points)
+        self.resolution = None if level is None else self.history.resolutions[level]
+        times, lows, highs, means = self.history.select(start, end, self.max_points)
+        self.mean_line.set_data(times, means)
+        if self.band is not None:
+            self.band.remove()
+            self.band = None
+        if self.resolution is not None:
+            self.band = self.place.fill_between(times, lows, highs, facecolor=self.color, alpha=0.3)
+        self.place.set_xlim(start, end)
+        if len(times):
+            low, high = np.min(lows), np.max(highs)
+            margin = (high - low) * 0.1 if high > low else max(abs(high) * 0.1, 1.0)
+            self.place.set_ylim(low - margin, high + margin)
+        self.canvas.draw_idle()
+
+    def _on_scroll(self, event):
+        if event.inaxes is not self.place:
+            return
+        start, end = self.view()
+        factor = 1.25 if event.button == 'down' else 0.8
+        # Keep the time under the pointer in place
+        new_end = event.xdata + (end - event.xdata) * factor
+        self.span = min(max(self.span * factor, 10.), 366 * 86400.)
+        last = self.history.end_time()
+        self.end = None if last is None or new_end >= last else new_end
+        self.draw()
+
+    def _on_press(self, event):
+        if event.inaxes is self.place and event.button == 1:
+            self._drag = (event.x, self.view()[1])
+
+    def _on_motion(self, event):
+        if self._drag is None or event.x is None:
+            return
+        x0, end0 = self._drag
+        width = self.place.bbox.width
+        new_end = end0 - (event.x - x0) * self.span / width
+        last = self.history.end_time()
+        self.end = None if last is None or new_end >= last else new_end
+        self.draw()
+
+    def _on_release(self, event):
+        self._drag = None
@@ -0,0 +1,323 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Frequency weighted levels, fractional octave band levels and their statistics"""
+
+import time
+from collections import deque
+
+import numpy as np
+
+from spectral import SpectrumAnalyzer
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+OCTAVE_RATIO = 10 ** 0.3  # Base-10 octave ratio used by IEC 61260
+
+
+def a_weighting(freqs):
+    """Return the A-weighting power gains (not in dB) at the given frequencies, as in IEC 61672"""
+    f2 = np.asarray(freqs, dtype=float) ** 2
+    r = 12194. ** 2 * f2 ** 2 / ((f2 + 20.6 ** 2) * np.sqrt((f2 + 107.7 ** 2) * (f2 + 737.9 ** 2)) * (f2 + 12194. ** 2))
+    return r ** 2 * 10 ** (2.00 / 10)
+
+
+def c_weighting(freqs):
+    """Return the C-weighting power gains (not in dB) at the given frequencies, as in IEC 61672"""
+    f2 = np.asarray(freqs, dtype=float) ** 2
+    r = 12194. ** 2 * f2 / ((f2 + 20.6 ** 2) * (f2 + 12194. ** 2))
+    return r ** 2 * 10 ** (0.06 / 10)
+
+
+def z_weighting(freqs):
+    """Return the Z-weighting (flat) power gains at the given frequencies"""
+    return np.ones(np.shape(freqs))
+
+
+WEIGHTINGS = {'A': a_weighting, 'C': c_weighting, 'Z': z_weighting}
+
+
+def band_centers(fraction=3, fmin=19., fmax=20000.):
+    """Return the exact mid-band frequencies of the 1/fraction octave bands between fmin and fmax"""
+    x_min = int(np.ceil(fraction * np.log(fmin / 1000.) / np.log(OCTAVE_RATIO) - 1e-9))
+    x_max = int(np.floor(fraction * np.log(fmax / 1000.) / np.log(OCTAVE_RATIO) + 1e-9))
+    return 1000. * OCTAVE_RATIO ** (np.arange(x_min, x_max + 1) / fraction)
+
+
+def band_edges(centers, fraction=3):
+    """Return the lower and upper edges of the bands with the given mid-band frequencies"""
+    factor = OCTAVE_RATIO ** (1 / (2 * fraction))
+    return centers / factor, centers * factor
+
+
+class BandAnalyzer:
+    """
+    Weighted levels and fractional octave band levels of a stream of blocks.
+
+    Every level comes from the same averaged spectrum of each block: weighted levels apply the weighting gains to its
+    bins and band levels add up the bins in each band, for all bands at once. The samples not yet covered by a complete
+    frame are kept for the next block, so no audio is lost at the block boundaries.
+
+    A band is only measured correctly if it spans at least min_bins bins, as the window spreads a tone over its
+    neighbouring bins. The low bands narrower than that are computed from the spectrum of a longer frame, with the last
+    low_fft_size samples of the stream, recomputed every eighth of it. Their levels are thus those of the last seconds
+    (1.4 s at 48 kHz), as a filter that narrow could not resolve less. Until the stream is that long, they are estimated
+    from the short spectrum. Bands too narrow even for the longest frame allowed are not reported.
+
+    Blocks of several channels, given as arrays of shape (samples, channels), are analyzed in a single call, and each
+    level becomes an array with a value per channel.
+    """
+
+    def __init__(self, rate, fft_size=4096, weightings=('A', 'C', 'Z'), fractions=(1, 3), fmin=19., fmax=20000.,
+                 reference=1.0, min_bins=4, max_fft_size=2 ** 17):
+        """
+        Args:
+            rate (float): Sampling rate in Hz.
+            fft_size (int): Samples in each frame of the spectral analysis. Must be a power of two.
+            weightings: Names of the frequency weightings computed, see WEIGHTINGS.
+            fractions: Fractions of octave of the band levels computed, e.g., 1 for octaves and 3 for third octaves.
+            fmin (float): Lowest mid-band frequency.
+            fmax (float): Highest mid-band frequency. Bands above the Nyquist frequency are omitted.
+            reference (float): Amplitude of the samples corresponding to 0 dB.
+            min_bins (float): Minimum width of a band, in bins of the spectrum it is computed from.
+            max_fft_size (int): Maximum samples in the frame of the low bands.
+        """
+        self.analyzer = SpectrumAnalyzer(rate, fft_size, window='hann', output='psd')
+        freqs = self.analyzer.freqs
+        self.bin_width = rate / fft_size
+        self.reference_power = reference ** 2
+
+        self.weightings = list(weightings)
+        self._gains = np.array([WEIGHTINGS[w](freqs) for w in self.weightings])
+
+        self.fractions = list(fractions)
+        edges = {}
+        for fraction in self.fractions:
+            centers = band_centers(fraction, fmin, fmax)
+            lower, upper = band_edges(centers, fraction)
+            keep = upper < rate / 2
+            edges[fraction] = centers[keep], lower[keep], upper[keep]
+
+        # The frame of the low bands is the shortest one resolving the narrowest band, if any band needs it
+        narrowest = min([np.min(upper - lower) for _, lower, upper in edges.values() if len(lower)] or [np.inf])
+        low_fft_size = fft_size
+        while low_fft_size < max_fft_size and narrowest < min_bins * rate / low_fft_size:
+            low_fft_size *= 2
+        self.low_analyzer = (SpectrumAnalyzer(rate, low_fft_size, window='hann', output='psd')
+                             if low_fft_size > fft_size else None)
+        self.history_size = low_fft_size  # Samples before a position needed to continue the analysis from it
+
+        self.centers = {}
+        self._band_bins = {}  # Bins of the short spectrum of each band, as indices in its cumulative sum
+        self._low_bands = {}  # Indices of the bands computed from the long spectrum, and their bins in it
+        for fraction, (centers, lower, upper) in edges.items():
+            width = upper - lower
+            if self.low_analyzer is not None:
+                low_width = rate / low_fft_size
+                keep = width >= min_bins * low_width
+                centers, lower, upper, width = centers[keep], lower[keep], upper[keep], width[keep]
+                narrow = np.flatnonzero(width < min_bins * self.bin_width)
+                low_freqs = self.low_analyzer.freqs
+                self._low_bands[fraction] = (narrow, np.searchsorted(low_freqs, lower[narrow]),
+                                             np.searchsorted(low_freqs, upper[narrow]))
+            self.centers[fraction] = centers
+            low, high = np.searchsorted(freqs, lower), np.searchsorted(freqs, upper)
+            # While the long spectrum is not available, bands with no bin of their own take the power of the nearest
+            # bin in their width
+            empty = high <= low
+            nearest = np.rint(centers / self.bin_width).astype(int)
+            low = np.where(empty, nearest, low)
+            high = np.where(empty, nearest + 1, high)
+            scale = np.where(empty, width / self.bin_width, 1.)
+            self._band_bins[fraction] = (low, high, scale)
+
+        self._pending = np.zeros(0)  # Samples waiting for a complete frame
+        self._history = None  # Last samples of the stream, for the long spectrum
+        self._since_low = 0  # Samples added since the long spectrum was computed
+        self._low_cumulative = None  # Cumulative sum of the last long spectrum, as mean squares
+
+    def reset(self):
+        self._pending = np.zeros(0)
+        self._history = None
+        self._since_low = 0
+        self._low_cumulative = None
+
+    def prime(self, tail, position):
+        """
+        Continue the analysis of a stream from its middle, as if all its previous samples had been analyzed.
+
+        Args:
+            tail: The last samples before the position, at least history_size of them if there are so many.
+            position (int): Number of samples of the stream before the position.
+
+        """
+        fft_size, hop = self.analyzer.fft_size, self.analyzer.hop
+        count = 0 if position < fft_size else (position - fft_size) // hop + 1
+        pending = position - count * hop  # Samples not yet covered by a frame, always fewer than fft_size
+        self._pending = np.asarray(tail[len(tail) - pending:], dtype=float) if pending else np.zeros(0)
+        self._history = np.array(tail[-self.history_size:], dtype=float) if len(tail) else None
+        self._since_low = self.history_size  # Computed again with the first frame
+        self._low_cumulative = None
+
+    def _to_db(self, mean_square):
+        with np.errstate(divide='ignore'):
+            return 10 * np.log10(mean_square / self.reference_power)
+
+    def _update_history(self, samples):
+        """Keep the last samples for the long spectrum, computing it again every eighth of its frame"""
+        size = self.low_analyzer.fft_size
+        if self._history is None:
+            self._history = np.zeros((0,) + np.shape(samples)[1:])
+        self._history = np.concatenate((self._history, samples))[-size:]
+        self._since_low += len(samples)
+        if len(self._history) == size and (self._low_cumulative is None or self._since_low >= size // 8):
+            power = self.low_analyzer(self._history) * (self.low_analyzer.rate / size)
+            cumulative = np.cumsum(power, axis=-1)
+            self._low_cumulative = np.concatenate((np.zeros(cumulative.shape[:-1] + (1,)), cumulative), axis=-1)
+            self._since_low = 0
+
+    def __call__(self, samples):
+        """
+        Analyze a new block of samples.
+
+        Returns:
+            dict: Levels in dB keyed by weighting name, and arrays of band levels keyed by fraction of octave, for the
+                  frames completed with this block. None if no frame was completed. For blocks of several channels,
+                  the levels are arrays with a value per channel and the band levels have shape (channels, bands).
+
+        """
+        if self.low_analyzer is not None:
+            self._update_history(samples)
+        fft_size, hop = self.analyzer.fft_size, self.analyzer.hop
+        if len(self._pending):
+            samples = np.concatenate((self._pending, samples))
+        if len(samples) < fft_size:
+            self._pending = np.array(samples, dtype=float)
+            return None
+        count = (len(samples) - fft_size) // hop + 1
+        psd = self.analyzer(samples[:(count - 1) * hop + fft_size])
+        self._pending = np.array(samples[count * hop:], dtype=float)
+
+        power = psd * self.bin_width  # Mean square in each bin, for each channel in the first axis
+        results = dict(zip(self.weightings, self._to_db(self._gains.dot(power.T))))
+        cumulative = np.cumsum(power, axis=-1)
+        cumulative = np.concatenate((np.zeros(cumulative.shape[:-1] + (1,)), cumulative), axis=-1)
+        for fraction in self.fractions:
+            low, high, scale = self._band_bins[fraction]
+            levels = (cumulative[..., high] - cumulative[..., low]) * scale
+            if self._low_cumulative is not None:
+                bands, low, high = self._low_bands[fraction]
+                levels[..., bands] = self._low_cumulative[..., high] - self._low_cumulative[..., low]
+            results[fraction] = self._to_db(levels)
+        return results
+
+
+PERCENTILES = (10, 50, 90)  # Exceedance levels in the summaries
+
+
+class LevelStatistics:
+    """
+    Running statistics of a sequence of levels in dB: equivalent continuous level (Leq), Lmax, Lmin and percentile
+    exceedance levels (e.g., L10 is the level exceeded 10% of the time).
+
+    Percentiles come from a histogram of fixed bins, so memory does not grow with the number of levels.
+    """
+
+    def __init__(self, resolution=0.1, low=-160., high=160.):
+        """
+        Args:
+            resolution (float): Width of the bins of the histogram, in dB.
+            low (float): Lowest level in the histogram. Lower levels are counted in the first bin.
+            high (float): Highest level in the histogram. Higher levels are counted in the last bin.
+        """
+        self.resolution = resolution
+        self.low = low
+        self.histogram = np.zeros(int(np.ceil((high - low) / resolution)), dtype=np.int64)
+        self.count = 0
+        self.energy = 0.0  # Sum of the powers of the levels
+        self.max = None
+        self.min = None
+
+    def _bin(self, level):
+        return min(max(int((level - self.low) / self.resolution), 0), len(self.histogram) - 1)
+
+    def add(self, level):
+        if not np.isfinite(level):
+            return
+        self.histogram[self._bin(level)] += 1
+        self.count += 1
+        self.energy += 10 ** (level / 10)
+        self.max = level if self.max is None else max(self.max, level)
+        self.min = level if self.min is None else min(self.min, level)
+
+    def leq(self):
+        return 10 * np.log10(self.energy / self.count) if self.count else None
+
+    def lmax(self):
+        return self.max
+
+    def lmin(self):
+        return self.min
+
+    def percentile(self, p):
+        """Return the level exceeded p percent of the time, up to the resolution of the histogram"""
+        if not self.count:
+            return None
+        cumulative = np.cumsum(self.histogram)
+        i = int(np.searchsorted(cumulative, (100 - p) / 100 * self.count))
+        return self.low + (min(i, len(self.histogram) - 1) + 0.5) * self.resolution
+
+    def summary(self):
+        """Return a dict with the count, Leq, Lmax, Lmin and the percentile levels in PERCENTILES"""
+        summary = {'count': self.count, 'Leq': self.leq(), 'Lmax': self.lmax(), 'Lmin': self.lmin()}
+        for p in PERCENTILES:
+            summary['L%d' % p] = self.percentile(p)
+        return summary
+
+
+class RollingLevelStatistics(LevelStatistics):
+    """The statistics of the levels measured in the last seconds, given by a window"""
+
+    def __init__(self, window, resolution=0.1, low=-160., high=160.):
+        """
+        Args:
+            window (float): Duration of the window in seconds.
+        """
+        super().__init__(resolution=resolution, low=low, high=high)
+        self.window = window
+        self.entries = deque()  # (time, level) of the levels in the window
+
+    def add(self, level, timestamp=None):
+        if not np.isfinite(level):
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        self.entries.append((timestamp, level))
+        self.histogram[self._bin(level)] += 1
+        self.count += 1
+        self.energy += 10 ** (level / 10)
+        self.expire(timestamp)
+
+    def expire(self, now=None):
+        """Forget the levels out of the window"""
+        if now is None:
+            now = time.time()
+        while self.entries and self.entries[0][0] <= now - self.window:
+            _, level = self.entries.popleft()
+            self.histogram[self._bin(level)] -= 1
+            self.count -= 1
+            self.energy -= 10 ** (level / 10)
+        if not self.count:
+            self.energy = 0.0  # Do not accumulate rounding errors
+
+    def _occupied_bins(self):
+        return np.flatnonzero(self.histogram)
+
+    def lmax(self):
+        bins = self._occupied_bins()
+        return self.low + (bins[-1] + 0.5) * self.resolution if len(bins) else None
+
+    def lmin(self):
+        bins = self._occupied_bins()
+        return self.low + (bins[0] + 0.5) * self.resolution if len(bins) else None
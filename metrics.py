@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Counters and latency histograms of the hot paths, and their export"""
+
+import json
+import os
+import time
+from threading import Lock, Thread, Event
+
+import numpy as np
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+# Upper bounds of the latency buckets in seconds, from 0.1 ms to 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class Histogram:
+    """Counts of observations in buckets of fixed bounds, as Prometheus histograms"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        Args:
+            bounds: Increasing upper bounds of the buckets. A last bucket without bound is added.
+        """
+        self.bounds = np.array(bounds, dtype=float)
+        self.counts = np.zeros(len(bounds) + 1, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[np.searchsorted(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding the q quantile (0 <= q <= 1), or None if empty"""
+        if not self.count:
+            return None
+        i = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+        return min(float(self.bounds[i]), self.max) if i < len(self.bounds) else self.max
+
+
+class Metrics:
+    """
+    A thread-safe registry of counters, gauges and histograms.
+
+    Counters only grow, gauges hold the last value set and histograms count observations in buckets. Names are created
+    the first time they are used.
+    """
+
+    def __init__(self, prefix='sonometer'):
+        """
+        Args:
+            prefix (str): Prefix of the names of the metrics when exported.
+        """
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.start_time = time.time()
+        self._lock = Lock()
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def to_dict(self):
+        """Return a snapshot of all the metrics as a dict of plain types"""
+        with self._lock:
+            histograms = {}
+            for name, h in self.histograms.items():
+                histograms[name] = {'count': h.count, 'sum': h.sum, 'max': h.max, 'p50': h.quantile(0.5),
+                                    'p99': h.quantile(0.99), 'bounds': h.bounds.tolist(), 'buckets': h.counts.tolist()}
+            return {'time': time.time(), 'uptime': time.time() - self.start_time, 'counters': dict(self.counters),
+                    'gauges': dict(self.gauges), 'histograms': histograms}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        snapshot = self.to_dict()
+        p = self.prefix + "_"
+        lines = ["# TYPE %suptime_seconds gauge" % p, "%suptime_seconds %r" % (p, snapshot['uptime'])]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines += ["# TYPE %s%s counter" % (p, name), "%s%s %r" % (p, name, value)]
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines += ["# TYPE %s%s gauge" % (p, name), "%s%s %r" % (p, name, float(value))]
+        for name, h in sorted(snapshot['histograms'].items()):
+            lines.append("# TYPE %s%s histogram" % (p, name))
+            cumulative = np.cumsum(h['buckets'])
+            for bound, count in zip(h['bounds'], cumulative):
+                lines.append('%s%s_bucket{le="%r"} %d' % (p, name, bound, count))
+            lines.append('%s%s_bucket{le="+Inf"} %d' % (p, name, h['count']))
+            lines += ["%s%s_sum %r" % (p, name, h['sum']), "%s%s_count %d" % (p, name, h['count'])]
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Return a short human readable description of the metrics, e.g., for an overlay"""
+        snapshot = self.to_dict()
+        lines = []
+        for name, h in sorted(snapshot['histograms'].items()):
+            if h['count']:
+                lines.append("%s: p50 %.1f ms  p99 %.1f ms  max %.1f ms" %
+                             (name, h['p50'] * 1e3, h['p99'] * 1e3, h['max'] * 1e3))
+        counters = ["%s %d" % item for item in sorted(snapshot['counters'].items())]
+        gauges = ["%s %.3g" % item for item in sorted(snapshot['gauges'].items())]
+        if counters:
+            lines.append("  ".join(counters))
+        if gauges:
+            lines.append("  ".join(gauges))
+        return "\n".join(lines)
+
+
+class MetricsExporter:
+    """Periodic writer of the metrics to a file, e.g., for the textfile collector of the Prometheus node exporter"""
+
+    def __init__(self, metrics, file_name, output_format='prometheus', period=10.0):
+        """
+        Args:
+            metrics (Metrics): The metrics exported.
+            file_name (str): Path to the file, which is replaced atomically on each write.
+            output_format (str): 'prometheus' for the text exposition format or 'json'.
+            period (float): Seconds between writes.
+        """
+        if output_format not in ('prometheus', 'json'):
+            raise ValueError("Unknown format: %s" % output_format)
+        self.metrics = metrics
+        self.file_name = file_name
+        self.output_format = output_format
+        self.period = period
+        self._stop_event = Event()
+        self._thread = None
+
+    def write(self):
+        text = self.metrics.to_prometheus() if self.output_format == 'prometheus' else self.metrics.to_json() + "\n"
+        temporary = self.file_name + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(text)
+        os.replace(temporary, self.file_name)  # Readers never see a partial file
+
+    def _run(self):
+        while not self._stop_event.wait(self.period):
+            self.write()
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the periodic writes, writing the metrics a last time"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+
+def add_metrics_arguments(parser):
+    """Add the command line options of the metrics to an argparse parser"""
+    parser.add_argument("--metrics", action="store_true", help="Show the metrics of the processing over the plot. "
+                                                               "F2 toggles them.")
+    parser.add_argument("--metrics-file", help="File where the metrics are written periodically")
+    parser.add_argument("--metrics-format", choices=["prometheus", "json"], default="prometheus",
+                        help="Format of the metrics file")
+    parser.add_argument("--metrics-period", type=float, default=10.0, help="Seconds between writes of the metrics")
+
+
+def start_metrics_exporter(args, metrics):
+    """Start exporting the metrics as given in the command line arguments, returning the exporter or None"""
+    if not args.metrics_file:
+        return None
+    exporter = MetricsExporter(metrics, args.metrics_file, args.metrics_format, args.metrics_period)
+    exporter.start()
+    return exporter
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Analysis of the blocks of audio as a pipeline of metric stages, whose results are delivered to sinks"""
+
+import time
+
+import numpy as np
+
+from spectral import interpolate_peak
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+
+def to_channels(data, channels=1):
+    """Return the samples of a block of interleaved 16-bit PCM, as a view of shape (frames, channels) if multichannel"""
+    samples = np.frombuffer(data, np.int16)
+    return samples.reshape(-1, channels) if channels > 1 else samples
+
+
+def intensity(samples):
+    """Return the norm of the samples, or an array with the norm of each channel if multichannel"""
+    if samples.ndim == 2:
+        samples = samples.astype(float)
+        return np.sqrt(np.einsum('ij,ij->j', samples, samples))  # Much faster than norm along an axis
+    return np.linalg.norm(samples, 2)
+
+
+def data_to_intensity(data, channels=1):
+    """Return the norm of the samples of a block, or an array with the norm of each channel if multichannel"""
+    return intensity(to_channels(data, channels))
+
+
+class Stage:
+    """
+    A metric computed from each block of audio.
+
+    Stages are called with the samples of the block, as given by to_channels, and return a dict with the values they
+    add to the measurement, or None if they have nothing to add for that block. Any function doing so can also be
+    used as a stage.
+    """
+
+    def __call__(self, samples):
+        raise NotImplementedError
+
+
+class IntensityStage(Stage):
+    """The norm of the samples, as 'intensity'. It is the RMS times the square root of the number of samples."""
+
+    def __call__(self, samples):
+        return {'intensity': intensity(samples)}
+
+
+class PeakStage(Stage):
+    """The largest absolute sample, as 'peak', in dB relative to the reference"""
+
+    def __init__(self, reference=32768.):
+        self.reference = reference
+
+    def __call__(self, samples):
+        # Done with the extremes so the most negative sample does not overflow when negated
+        peak = np.maximum(samples.max(axis=0), -samples.min(axis=0).astype(float))
+        with np.errstate(divide='ignore'):
+            return {'peak': 20 * np.log10(peak / self.reference)}
+
+
+class BandStage(Stage):
+    """The weighted and band levels of a BandAnalyzer, once it completes a frame"""
+
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+
+    def __call__(self, samples):
+        return self.analyzer(samples)
+
+
+class SpectrumStage(Stage):
+    """The spectrum of a SpectrumAnalyzer, as 'spectrum'"""
+
+    def __init__(self, analyzer, channel=None):
+        """
+        Args:
+            analyzer (SpectrumAnalyzer): The analyzer of the samples.
+            channel (int): Channel analyzed if multichannel. None for all of them.
+        """
+        self.analyzer = analyzer
+        self.channel = channel
+
+    def __call__(self, samples):
+        if samples.ndim == 2 and self.channel is not None:
+            samples = samples[:, self.channel]
+        return {'spectrum': self.analyzer(samples)}
+
+
+class ToneStage(Stage):
+    """The levels of the target frequencies of a ToneAnalyzer, as 'tones'"""
+
+    def __init__(self, analyzer, channel=None):
+        """
+        Args:
+            analyzer (ToneAnalyzer): The analyzer of the samples.
+            channel (int): Channel analyzed if multichannel. None for all of them.
+        """
+        self.analyzer = analyzer
+        self.channel = channel
+
+    def __call__(self, samples):
+        if samples.ndim == 2 and self.channel is not None:
+            samples = samples[:, self.channel]
+        return {'tones': self.analyzer(samples)}
+
+
+class DominantStage(Stage):
+    """
+    The frequency and level of the highest peak of the spectrum, as 'dominant_frequency' and 'dominant_level'.
+
+    The peak is interpolated between the bins of the spectrum, see interpolate_peak in spectral.
+    """
+
+    def __init__(self, analyzer, channel=None):
+        """
+        Args:
+            analyzer (SpectrumAnalyzer): The analyzer of the samples, with output in dB.
+            channel (int): Channel analyzed if multichannel. None for all of them.
+        """
+        self.analyzer = analyzer
+        self.channel = channel
+
+    def __call__(self, samples):
+        if samples.ndim == 2 and self.channel is not None:
+            samples = samples[:, self.channel]
+        frequency, level = interpolate_peak(self.analyzer(samples), self.analyzer.freqs)
+        return {'dominant_frequency': frequency, 'dominant_level': level}
+
+
+class Pipeline:
+    """
+    The analysis of the blocks of audio of a Listener.
+
+    Each block is decoded once into an array sharing the memory of the block. The stages compute their metrics from
+    it, and the measurement they build (a dict, also with the 'time' when it was taken) is passed to every sink, e.g.,
+    a writer, a server or a recorder. The pipeline is called with the blocks, so it can be the callback of a Listener.
+    Stages and sinks run in the thread of the listener.
+    """
+
+    def __init__(self, stages=(), sinks=(), channels=1):
+        """
+        Args:
+            stages: Stages computing the measurements, in order.
+            sinks: Functions called with each measurement.
+            channels (int): Number of interleaved channels in the blocks.
+        """
+        self.stages = list(stages)
+        self.sinks = list(sinks)
+        self.channels = channels
+
+    def add_stage(self, stage):
+        self.stages.append(stage)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def __call__(self, data):
+        """Analyze a block of audio, given as bytes, passing the measurement to the sinks and returning it"""
+        samples = to_channels(data, self.channels)
+        measurement = {'time': time.time()}
+        for stage in self.stages:
+            values = stage(samples)
+            if values is not None:
+                measurement.update(values)
+        for sink in self.sinks:
+            sink(measurement)
+        return measurement
+
+
+def level_stages(band_analyzer=None, spectrum_analyzer=None):
+    """Return the stages of the usual measurements: the intensity and, if analyzers are given, the levels"""
+    stages = [IntensityStage()]
+    if band_analyzer is not None:
+        stages.append(BandStage(band_analyzer))
+    if spectrum_analyzer is not None:
+        stages.append(SpectrumStage(spectrum_analyzer))
+    return stages
+
+
+def measure(in_data, band_analyzer=None, spectrum_analyzer=None, channels=1):
+    """
+    Return a dict with the time, the intensity and, if an analyzer is given and completes a frame, the levels.
+
+    If a SpectrumAnalyzer is given, its result is added as 'spectrum'. If there are several channels, all of them are
+    analyzed at once and each value becomes an array with the values of the channels in its first axis (see
+    select_channel in storage).
+    """
+    return Pipeline(level_stages(band_analyzer, spectrum_analyzer), channels=channels)(in_data)
@@ -0,0 +1,304 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Recording of the raw audio of a Listener, continuously and in clips around loud events"""
+
+import datetime
+import os
+import struct
+import time
+import wave
+from threading import Thread
+
+import numpy as np
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+
+def _wav_header(rate, channels, data_bytes):
+    """Header of a 16-bit PCM WAV file with the given number of bytes of samples"""
+    return WAV_HEADER.pack(b'RIFF', 36 + data_bytes, b'WAVE', b'fmt ', 16, 1, channels, rate, rate * channels * 2,
+                           channels * 2, 16, b'data', data_bytes)
+
+
+def _unique_name(directory, prefix, timestamp, extension):
+    """A file name with the prefix and the date and time, which is not in use"""
+    t = datetime.datetime.fromtimestamp(timestamp).strftime("%y%m%d%H%M%S")
+    file_name = os.path.join(directory, '%s%s%s' % (prefix, t, extension))
+    n = 1
+    while os.path.exists(file_name):
+        file_name = os.path.join(directory, '%s%s_%d%s' % (prefix, t, n, extension))
+        n += 1
+    return file_name
+
+
+class MappedWavWriter:
+    """
+    Continuous recording of 16-bit PCM into WAV files of a fixed duration.
+
+    Each file is created with its full size and memory-mapped, so writing a block is a single copy into the mapping,
+    with no allocation nor system call. A new file is started when one is full. When closed, the last file is cut to
+    the audio actually written.
+    """
+
+    def __init__(self, prefix='audio', directory='.', rate=44100, channels=1, seconds=3600.):
+        """
+        Args:
+            prefix (str): Start of the names of the files. The date and time of creation is appended.
+            directory (str): Directory where the files are written.
+            rate (int): Sampling rate in Hz.
+            channels (int): Number of interleaved channels.
+            seconds (float): Duration of each file.
+        """
+        self.prefix = prefix
+        self.directory = directory
+        self.rate = rate
+        self.channels = channels
+        self.capacity = max(1, int(seconds * rate)) * channels * 2  # Bytes of samples in each file
+        self.files = []  # Names of the files written
+        self._map = None
+        self._position = 0  # Bytes written in the current file
+
+    def _open(self):
+        file_name = _unique_name(self.directory, self.prefix, time.time(), '.wav')
+        with open(file_name, 'wb') as f:
+            f.write(_wav_header(self.rate, self.channels, self.capacity))
+            f.truncate(WAV_HEADER.size + self.capacity)
+        self._map = np.memmap(file_name, dtype=np.uint8, mode='r+', offset=WAV_HEADER.size, shape=(self.capacity,))
+        self._position = 0
+        self.files.append(file_name)
+
+    def _close_file(self):
+        """Release the mapping and fit the file to the audio written"""
+        if self._map is None:
+            return
+        self._map.flush()
+        self._map = None
+        if self._position < self.capacity:
+            with open(self.files[-1], 'r+b') as f:
+                f.write(_wav_header(self.rate, self.channels, self._position))
+                f.truncate(WAV_HEADER.size + self._position)
+
+    def write(self, data):
+        """Add a block of samples, given as bytes"""
+        source = np.frombuffer(data, np.uint8)  # A view, not a copy
+        offset = 0
+        while offset < len(source):
+            if self._map is None:
+                self._open()
+            n = min(len(source) - offset, self.capacity - self._position)
+            self._map[self._position:self._position + n] = source[offset:offset + n]
+            self._position += n
+            offset += n
+            if self._position == self.capacity:
+                self._close_file()
+
+    def close(self):
+        self._close_file()
+
+
+class AudioRing:
+    """The last samples of a stream, in a preallocated circular buffer"""
+
+    def __init__(self, capacity):
+        """
+        Args:
+            capacity (int): Number of samples kept.
+        """
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        self.total = 0  # Samples written since the start
+
+    def write(self, data):
+        samples = np.frombuffer(data, np.int16)  # A view, not a copy
+        capacity = len(self.buffer)
+        if len(samples) > capacity:
+            self.total += len(samples) - capacity
+            samples = samples[-capacity:]
+        start = self.total % capacity
+        first = min(len(samples), capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:len(samples) - first] = samples[first:]
+        self.total += len(samples)
+
+    def read(self, start, end):
+        """Return a copy of the samples from the index start to end (not included), counted since the start"""
+        if start < self.total - len(self.buffer) or end > self.total:
+            raise ValueError("The samples are not in the ring")
+        return np.take(self.buffer, np.arange(start, end) % len(self.buffer))
+
+
+class EventRecorder:
+    """
+    Clips of audio around loud events.
+
+    The last seconds of audio are kept in an AudioRing. When a level reaches the threshold, a clip is saved with the
+    audio from pre seconds before until post seconds after the last level above the threshold, so that a long event
+    makes a single clip (split if longer than max_seconds). The samples of a clip are copied when it is complete, and
+    written to disk in a thread of their own.
+    """
+
+    def __init__(self, rate=44100, channels=1, threshold=-20., pre=5., post=5., max_seconds=60., prefix='event',
+                 directory='.', metrics=None):
+        """
+        Args:
+            rate (int): Sampling rate in Hz.
+            channels (int): Number of interleaved channels.
+            threshold (float): Level starting an event.
+            pre (float): Seconds saved before the end of the block whose level reached the threshold.
+            post (float): Seconds saved after the last level above the threshold.
+            max_seconds (float): Maximum duration of a clip.
+            prefix (str): Start of the names of the clips. The date and time of the start of the clip is appended.
+            directory (str): Directory where the clips are written.
+            metrics (Metrics): Where the number of clips and of clips that could not be written is recorded, or None.
+        """
+        self.rate = rate
+        self.channels = channels
+        self.threshold = threshold
+        self.pre = int(pre * rate) * channels
+        self.post = int(post * rate) * channels
+        self.max_samples = int(max(max_seconds, pre + post) * rate) * channels
+        self.prefix = prefix
+        self.directory = directory
+        self.metrics = metrics
+        # Room for a whole clip, plus some margin for the block completing it
+        self.ring = AudioRing(self.max_samples + int(max(10., post) * rate) * channels)
+        self.clips = []  # Names of the clips saved
+        self._event = None  # [start, end] of the event in progress, as indices in the ring
+        self._threads = []
+
+    def write(self, data):
+        """Add a block of samples, given as bytes, saving the clip in progress if it is complete"""
+        self.ring.write(data)
+        if self._event is not None:
+            start, end = self._event
+            stop = min(end, start + self.max_samples)
+            if self.ring.total >= stop:
+                self._save(start, stop)
+                self._event = [stop, end] if end > stop else None
+
+    def check(self, level):
+        """
+        Check a level measured with the last block, starting or extending an event if it reaches the threshold.
+
+        With several channels, the level is an array and the event starts when any of them reaches the threshold.
+        """
+        if level is None or not np.max(level) >= self.threshold:
+            return
+        end = self.ring.total + self.post
+        if self._event is None:
+            self._event = [max(0, self.ring.total - self.pre), end]
+        else:
+            self._event[1] = end
+
+    def _save(self, start, end):
+        seconds_ago = (self.ring.total - start) / self.channels / self.rate
+        file_name = _unique_name(self.directory, self.prefix, time.time() - seconds_ago, '.wav')
+        self.clips.append(file_name)
+        # Copied now, as the ring might wrap before the thread reads it
+        samples = self.ring.read(start, end)
+        self._threads = [t for t in self._threads if t.is_alive()]
+        thread = Thread(target=self._write_clip, args=(file_name, samples))
+        thread.start()
+        self._threads.append(thread)
+        if self.metrics is not None:
+            self.metrics.increment('clips_total')
+
+    def _write_clip(self, file_name, samples):
+        try:
+            with wave.open(file_name, 'wb') as w:
+                w.setnchannels(self.channels)
+                w.setsampwidth(2)
+                w.setframerate(self.rate)
+                w.writeframes(samples.tobytes())
+        except OSError as e:
+            print("Error: cannot write the clip %s: %s" % (file_name, e))
+            if self.metrics is not None:
+                self.metrics.increment('clip_failures_total')
+
+    def close(self):
+        """Save the event in progress with the audio available and wait for the clips to be written"""
+        if self._event is not None:
+            start = self._event[0]
+            self._event = None
+            if self.ring.total > start:
+                self._save(start, self.ring.total)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+
+class Recorder:
+    """
+    The raw audio recording of a Listener: continuous to WAV files, clips around events or both.
+
+    The recorder taps the blocks of the listener before they are windowed, so overlapping windows are not recorded
+    twice. Events are checked with the measurements, passed to check.
+    """
+
+    def __init__(self, listener, prefix=None, file_seconds=3600., threshold=None, pre=5., post=5., clip_prefix='event',
+                 weighting='A', directory='.'):
+        """
+        Args:
+            listener (Listener): The listener whose audio is recorded.
+            prefix (str): Start of the names of the files of the continuous recording. None not to record continuously.
+            file_seconds (float): Duration of each file of the continuous recording.
+            threshold (float): Level in dB saving a clip, see EventRecorder. None not to save clips.
+            pre (float): Seconds saved before an event.
+            post (float): Seconds saved after an event.
+            clip_prefix (str): Start of the names of the clips.
+            weighting (str): Key of the level in the measurements compared with the threshold.
+            directory (str): Directory where the files are written.
+        """
+        rate, channels = listener.rate, listener.channels
+        self.writer = None
+        self.events = None
+        self.weighting = weighting
+        if prefix is not None:
+            self.writer = MappedWavWriter(prefix, directory, rate, channels, file_seconds)
+        if threshold is not None:
+            self.events = EventRecorder(rate, channels, threshold, pre, post, prefix=clip_prefix, directory=directory,
+                                        metrics=listener.metrics)
+        listener.taps.append(self.write)
+
+    def write(self, data):
+        if self.writer is not None:
+            self.writer.write(data)
+        if self.events is not None:
+            self.events.write(data)
+
+    def check(self, measurement):
+        if self.events is not None:
+            self.events.check(measurement.get(self.weighting))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.events is not None:
+            self.events.close()
+
+
+def add_recording_arguments(parser):
+    """Add the command line options of the recording to an argparse parser"""
+    parser.add_argument("--record", metavar="PREFIX", help="Record the audio continuously in WAV files whose names "
+                                                           "start with PREFIX")
+    parser.add_argument("--record-minutes", type=float, default=60., help="Minutes of audio in each recorded file")
+    parser.add_argument("--trigger", type=float, metavar="DB",
+                        help="Save a clip of the audio when the A-weighted level reaches DB dBFS")
+    parser.add_argument("--pre", type=float, default=5., help="Seconds saved in a clip before the trigger")
+    parser.add_argument("--post", type=float, default=5., help="Seconds saved in a clip after the trigger")
+
+
+def start_recording(args, listener, suffix=""):
+    """
+    Start recording as given in the command line arguments, returning the Recorder or None.
+
+    The suffix is added to the prefixes of the files, to tell apart the recordings of several listeners.
+    """
+    if args.record is None and args.trigger is None:
+        return None
+    prefix = None if args.record is None else args.record + suffix
+    return Recorder(listener, prefix, args.record_minutes * 60, args.trigger, args.pre, args.post,
+                    clip_prefix='event' + suffix)
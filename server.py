@@ -0,0 +1,312 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Publication of the measurements to many subscribers over the network, in a compact binary format"""
+
+import argparse
+import socket
+import struct
+from collections import deque
+from threading import Condition, Lock, Thread
+
+import numpy as np
+
+from storage import select_channel
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+# A frame is a header followed by a batch of records:
+# - Header: magic b'SN', format version, frame kind, number of bytes of the rest of the frame, number of records.
+# - Record: time (float64, seconds since the epoch), device (uint16), channel (uint8), intensity, LA, LC and LZ
+#   (float32, NaN if not measured), number of third octave band levels (uint16), and those levels (float32).
+# Everything is little-endian. A multichannel measurement is sent as a record per channel.
+MAGIC = b'SN'
+VERSION = 2
+KIND_MEASUREMENTS = 1
+HEADER = struct.Struct('<2sBBIH')
+RECORD = struct.Struct('<dHBffffH')
+MAX_DATAGRAM = 65507  # Largest UDP payload
+
+
+def encode_frame(measurements):
+    """Return the bytes of a frame with a batch of measurements, as given by measure"""
+    parts = []
+    count = 0
+    for measurement in measurements:
+        channels = np.ndim(measurement['intensity'])
+        for channel in range(len(measurement['intensity']) if channels else 1):
+            m = select_channel(measurement, channel)
+            bands = np.asarray(m.get(3, ()), dtype='<f4')
+            parts.append(RECORD.pack(m['time'], m.get('device', 0), channel, m['intensity'], m.get('A', np.nan),
+                                     m.get('C', np.nan), m.get('Z', np.nan), len(bands)))
+            parts.append(bands.tobytes())
+            count += 1
+    payload = b''.join(parts)
+    return HEADER.pack(MAGIC, VERSION, KIND_MEASUREMENTS, len(payload), count) + payload
+
+
+def decode_frame(frame):
+    """Return the list of measurements in a frame. Levels not measured are omitted."""
+    magic, version, kind, size, count = HEADER.unpack_from(frame)
+    if magic != MAGIC or version != VERSION or kind != KIND_MEASUREMENTS:
+        raise ValueError("Not a frame of measurements")
+    measurements = []
+    offset = HEADER.size
+    for _ in range(count):
+        t, device, channel, intensity, a, c, z, band_count = RECORD.unpack_from(frame, offset)
+        offset += RECORD.size
+        m = {'time': t, 'device': device, 'channel': channel, 'intensity': intensity}
+        for name, level in (('A', a), ('C', c), ('Z', z)):
+            if not np.isnan(level):
+                m[name] = level
+        if band_count:
+            m[3] = np.frombuffer(frame, '<f4', band_count, offset).astype(float)
+            offset += 4 * band_count
+        measurements.append(m)
+    return measurements
+
+
+class FrameDecoder:
+    """Split a stream of bytes, received in arbitrary pieces, into frames"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes, returning the list of frames completed with them"""
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= HEADER.size:
+            size = HEADER.size + HEADER.unpack_from(self.buffer)[3]
+            if len(self.buffer) < size:
+                break
+            frames.append(bytes(self.buffer[:size]))
+            del self.buffer[:size]
+        return frames
+
+
+class _Subscriber:
+    """A connected client, with a bounded queue of frames sent from a thread of its own"""
+
+    def __init__(self, sock, address, queue_size):
+        self.sock = sock
+        self.address = address
+        self.queue_size = queue_size
+        self.queue = deque()
+        self.dropped = 0  # Frames discarded because the client was too slow
+        self.closed = False
+        self._condition = Condition()
+        self._thread = Thread(target=self._send, daemon=True)
+        self._thread.start()
+
+    def push(self, frame):
+        """Queue a frame, discarding the oldest one if the queue is full. It never blocks on the network."""
+        with self._condition:
+            if len(self.queue) >= self.queue_size:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(frame)
+            self._condition.notify()
+
+    def _send(self):
+        while True:
+            with self._condition:
+                while not self.queue and not self.closed:
+                    self._condition.wait()
+                if self.closed:
+                    return
+                # Everything waiting is sent at once
+                data = b''.join(self.queue)
+                self.queue.clear()
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+                return
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class MeasurementServer:
+    """
+    Publisher of measurements to the clients connected by TCP and, optionally, to a UDP multicast group.
+
+    Measurements are encoded once per batch and the same frame is queued for every client. Each client has a bounded
+    queue emptied by a thread of its own, so a slow client loses its oldest frames instead of delaying the others or
+    the capture.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8765, queue_size=64, batch_size=1, multicast=None, multicast_ttl=1,
+                 metrics=None):
+        """
+        Args:
+            host (str): Address where clients are accepted. Use '0.0.0.0' to accept them from other machines.
+            port (int): TCP port. 0 to choose a free one, given by address once started.
+            queue_size (int): Maximum number of frames waiting to be sent to each client.
+            batch_size (int): Number of measurements in each frame.
+            multicast: (group, port) where the frames are also sent by UDP multicast, or None.
+            multicast_ttl (int): Number of hops the multicast datagrams can cross.
+            metrics (Metrics): Where the counts of frames and clients are recorded, or None.
+        """
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.multicast = multicast
+        self.multicast_ttl = multicast_ttl
+        self.metrics = metrics
+
+        self.subscribers = []
+        self.frames = 0  # Frames published
+        self._subscribers_lock = Lock()
+        self._batch = []
+        self._socket = None
+        self._udp_socket = None
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._socket.getsockname() if self._socket is not None else None
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen()
+        if self.multicast is not None:
+            self._udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self._udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+        self._thread = Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self._socket.accept()
+            except OSError:  # The server was stopped
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._subscribers_lock:
+                self.subscribers.append(_Subscriber(sock, address, self.queue_size))
+
+    def publish(self, measurement):
+        """Add a measurement to the batch, sending it when complete. It is meant to be called from the callback."""
+        self._batch.append(measurement)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send the measurements in the batch, even if it is not complete"""
+        if not self._batch:
+            return
+        frame = encode_frame(self._batch)
+        self._batch = []
+        with self._subscribers_lock:
+            self.subscribers = [s for s in self.subscribers if not s.closed]
+            subscribers = list(self.subscribers)
+        for s in subscribers:
+            s.push(frame)
+        if self._udp_socket is not None and len(frame) <= MAX_DATAGRAM:
+            try:
+                self._udp_socket.sendto(frame, self.multicast)
+            except OSError:
+                pass
+        self.frames += 1
+        if self.metrics is not None:
+            self.metrics.increment('server_frames_total')
+            self.metrics.set('server_clients', len(subscribers))
+            self.metrics.set('server_dropped_frames', sum(s.dropped for s in subscribers))
+
+    def stop(self):
+        self.flush()
+        if self._socket is not None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)  # Wakes the accepting thread
+            except OSError:
+                pass
+            self._socket.close()
+            self._socket = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._subscribers_lock:
+            for s in self.subscribers:
+                s.close()
+            self.subscribers = []
+        if self._udp_socket is not None:
+            self._udp_socket.close()
+            self._udp_socket = None
+
+
+class MeasurementClient:
+    """Receiver of the measurements published by a MeasurementServer. Iterating over it yields the measurements."""
+
+    def __init__(self, host='127.0.0.1', port=8765, multicast=False):
+        """
+        Args:
+            host (str): Address of the server or, if multicast, the multicast group.
+            port (int): TCP port of the server or UDP port of the multicast group.
+            multicast (bool): Whether to receive the multicast datagrams instead of connecting by TCP.
+        """
+        self.multicast = multicast
+        if multicast:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(('', port))
+            membership = struct.pack('4sl', socket.inet_aton(host), socket.INADDR_ANY)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.decoder = FrameDecoder()
+
+    def frames(self):
+        """Yield the frames received, until the connection is closed"""
+        while True:
+            try:
+                data = self.sock.recv(MAX_DATAGRAM if self.multicast else 1 << 16)
+            except OSError:
+                return
+            if not data:
+                return
+            if self.multicast:
+                yield data
+            else:
+                yield from self.decoder.feed(data)
+
+    def __iter__(self):
+        for frame in self.frames():
+            yield from decode_frame(frame)
+
+    def close(self):
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the measurements published by a sonometer server")
+    parser.add_argument("--host", default="127.0.0.1", help="Address of the server, or multicast group")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the server or of the multicast group")
+    parser.add_argument("--multicast", action="store_true", help="Receive the multicast datagrams")
+    args = parser.parse_args()
+
+    client = MeasurementClient(args.host, args.port, args.multicast)
+    try:
+        for m in client:
+            print("%.3f %d:%d %.6g %s" % (m['time'], m['device'], m['channel'], m['intensity'],
+                                          " ".join("L%s %.1f" % (w, m[w]) for w in ('A', 'C', 'Z') if w in m)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
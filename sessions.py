@@ -0,0 +1,385 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Local store of the measuring sessions, their streaks and their measurements, in an SQLite database"""
+
+import argparse
+import datetime
+import sqlite3
+import time
+from threading import Lock
+
+import numpy as np
+
+from storage import select_channel
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    start_time REAL NOT NULL,
+    end_time REAL,
+    device TEXT,
+    rate INTEGER,
+    channels INTEGER,
+    interval REAL,
+    hop REAL,
+    label TEXT
+);
+CREATE TABLE IF NOT EXISTS streaks (
+    id INTEGER PRIMARY KEY,
+    session INTEGER NOT NULL REFERENCES sessions(id),
+    start_time REAL NOT NULL,
+    end_time REAL,
+    channel INTEGER NOT NULL,
+    device TEXT,
+    rate INTEGER,
+    interval REAL,
+    hop REAL,
+    label TEXT,
+    count INTEGER,
+    mean REAL,
+    err REAL,
+    laeq REAL
+);
+CREATE INDEX IF NOT EXISTS streaks_start ON streaks(start_time);
+CREATE TABLE IF NOT EXISTS measurements (
+    session INTEGER NOT NULL,
+    streak INTEGER,
+    channel INTEGER NOT NULL,
+    time REAL NOT NULL,
+    intensity REAL,
+    la REAL,
+    lc REAL,
+    lz REAL,
+    peak REAL
+);
+CREATE INDEX IF NOT EXISTS measurements_time ON measurements(time);
+CREATE INDEX IF NOT EXISTS measurements_streak ON measurements(streak, channel, time) WHERE streak IS NOT NULL;
+"""
+
+# Columns of the measurements table for each key of the measurements
+COLUMNS = {'time': 'time', 'intensity': 'intensity', 'A': 'la', 'C': 'lc', 'Z': 'lz', 'peak': 'peak'}
+
+_MAX_PARAMETERS = 500  # Streaks queried in each statement, below the limit of parameters of SQLite
+
+
+def _to_float(value):
+    return None if value is None or not np.isfinite(value) else float(value)
+
+
+class SessionStore:
+    """
+    Sessions, streaks and measurements kept in an SQLite database, with no server.
+
+    A session is a run of the sonometer with a source, a streak is a sequence of points recorded together in it. Their
+    metadata is kept with them, and each measurement is stored with its session, its channel and its streak, if any.
+    Measurements are indexed by time and by streak, so a time range or a set of streaks is read without scanning the
+    rest. They are buffered and inserted in batches, each one in a single transaction, so storing them costs little in
+    the thread of the listener. The store can be shared by several threads.
+    """
+
+    def __init__(self, path='sessions.db', batch_size=100, batch_seconds=5.0):
+        """
+        Args:
+            path (str): Path to the database, created if it does not exist.
+            batch_size (int): Number of measurements buffered before inserting them.
+            batch_seconds (float): Maximum time a measurement is buffered before inserting it.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")  # Readers do not block the writer
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = Lock()
+        self._buffer = []
+        self._buffer_start = None
+
+    def _insert(self, table, values):
+        with self.lock, self.connection:
+            cursor = self.connection.execute("INSERT INTO %s (%s) VALUES (%s)" %
+                                             (table, ", ".join(values), ", ".join("?" * len(values))),
+                                             list(values.values()))
+        return cursor.lastrowid
+
+    def start_session(self, device=None, rate=None, channels=1, interval=None, hop=None, label=None, start=None):
+        """
+        Start a session, returning its id.
+
+        Args:
+            device (str): Description of the source of the audio.
+            rate (int): Sampling rate in Hz.
+            channels (int): Number of channels measured.
+            interval (float): Seconds sampled per point.
+            hop (float): Seconds between the starts of consecutive points. None for no overlap.
+            label (str): Free text describing the session.
+            start (float): Timestamp of the start. Now if not given.
+        """
+        return self._insert('sessions', {'start_time': time.time() if start is None else start, 'device': device,
+                                         'rate': rate, 'channels': channels, 'interval': interval, 'hop': hop,
+                                         'label': label})
+
+    def end_session(self, session, end=None):
+        """Write the measurements buffered and set the end of a session, now unless a timestamp is given"""
+        self.flush()
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE sessions SET end_time = ? WHERE id = ?",
+                                    (time.time() if end is None else end, session))
+
+    def start_streak(self, session, channel=0, interval=None, hop=None, label=None, start=None):
+        """
+        Start a streak in a session, returning its id.
+
+        The device and the rate are those of the session, as are the interval and the hop unless given.
+
+        Args:
+            session (int): Id of the session.
+            channel (int): Channel the streak is recorded from.
+            interval (float): Seconds sampled per point.
+            hop (float): Seconds between the starts of consecutive points. None for no overlap.
+            label (str): Free text describing the streak.
+            start (float): Timestamp of the start. Now if not given.
+        """
+        with self.lock:
+            device, rate, session_interval, session_hop = self.connection.execute(
+                "SELECT device, rate, interval, hop FROM sessions WHERE id = ?", (session,)).fetchone()
+        if interval is None:
+            interval, hop = session_interval, session_hop
+        return self._insert('streaks', {'session': session, 'start_time': time.time() if start is None else start,
+                                        'channel': channel, 'device': device, 'rate': rate, 'interval': interval,
+                                        'hop': hop, 'label': label})
+
+    def end_streak(self, streak_id, streak=None, end=None):
+        """
+        Write the measurements buffered and set the end of a streak.
+
+        Args:
+            streak_id (int): Id of the streak.
+            streak (Streak): The recorded streak, whose statistics are stored for quick comparisons.
+            end (float): Timestamp of the end. Now if not given.
+        """
+        self.flush()
+        values = {'end_time': time.time() if end is None else end}
+        if streak is not None:
+            values.update(count=len(streak), mean=_to_float(streak.mean()), err=_to_float(streak.err()),
+                          laeq=_to_float(streak.levels.summary()['Leq']))
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE streaks SET %s WHERE id = ?" % ", ".join("%s = ?" % k for k in values),
+                                    list(values.values()) + [streak_id])
+
+    def write(self, measurement, session, streak=None):
+        """
+        Add a measurement of a session, and of a streak if given.
+
+        Multichannel measurements are stored as a row per channel.
+        """
+        if np.ndim(measurement['intensity']) == 0:
+            rows = [(session, streak, 0, measurement)]
+        else:
+            rows = [(session, streak, channel, select_channel(measurement, channel))
+                    for channel in range(len(measurement['intensity']))]
+        rows = [(session, streak, channel, m['time'], _to_float(m['intensity']), _to_float(m.get('A')),
+                 _to_float(m.get('C')), _to_float(m.get('Z')), _to_float(m.get('peak')))
+                for session, streak, channel, m in rows]
+        with self.lock:
+            if not self._buffer:
+                self._buffer_start = time.monotonic()
+            self._buffer += rows
+            full = (len(self._buffer) >= self.batch_size or
+                    time.monotonic() - self._buffer_start >= self.batch_seconds)
+        if full:
+            self.flush()
+
+    def sink(self, session, streak=None):
+        """Return a function writing the measurements it is called with, e.g., a sink of a Pipeline"""
+        return lambda measurement: self.write(measurement, session, streak)
+
+    def flush(self):
+        """Insert the buffered measurements"""
+        with self.lock:
+            rows = self._buffer
+            self._buffer = []
+            if not rows:
+                return
+            with self.connection:
+                self.connection.executemany("INSERT INTO measurements (session, streak, channel, time, intensity, la, "
+                                            "lc, lz, peak) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _select(self, query, parameters=()):
+        with self.lock:
+            cursor = self.connection.execute(query, parameters)
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def sessions(self):
+        """Return the sessions, as dicts with their metadata, from the oldest"""
+        return self._select("SELECT * FROM sessions ORDER BY start_time")
+
+    def streaks(self, session=None, start=None, end=None, last=None):
+        """
+        Return the streaks as dicts with their metadata and statistics, from the oldest.
+
+        Args:
+            session (int): Only the streaks of this session. None for all of them.
+            start (float): Only the streaks starting at this timestamp or later. None for no limit.
+            end (float): Only the streaks starting before this timestamp. None for no limit.
+            last (int): Only this number of the most recent ones. None for all of them.
+        """
+        conditions, parameters = [], []
+        for condition, value in (("session = ?", session), ("start_time >= ?", start), ("start_time < ?", end)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        query = "SELECT * FROM streaks" + (" WHERE " + " AND ".join(conditions) if conditions else "")
+        query += " ORDER BY start_time DESC" + (" LIMIT %d" % last if last is not None else "")
+        return self._select(query, parameters)[::-1]
+
+    def _arrays(self, query, parameters, columns):
+        with self.lock:
+            rows = self.connection.execute(query, parameters).fetchall()
+        array = np.array(rows, dtype=float).reshape(-1, len(columns))  # NULL becomes NaN
+        return {key: array[:, i] for i, key in enumerate(columns)}
+
+    def measurements(self, start=None, end=None, session=None, channel=0, columns=('time', 'intensity', 'A')):
+        """
+        Return the measurements of a time range.
+
+        Args:
+            start (float): Timestamp of the first measurement. None for no limit.
+            end (float): Timestamp after the last measurement. None for no limit.
+            session (int): Only the measurements of this session. None for all of them.
+            channel (int): Channel of the measurements.
+            columns: Keys of the values returned, from those in COLUMNS.
+
+        Returns:
+            dict: An array with the values of each column, ordered by time. Missing values are NaN.
+
+        """
+        conditions, parameters = ["channel = ?"], [channel]
+        for condition, value in (("time >= ?", start), ("time < ?", end), ("session = ?", session)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        query = "SELECT %s FROM measurements WHERE %s ORDER BY time" % (", ".join(COLUMNS[c] for c in columns),
+                                                                        " AND ".join(conditions))
+        return self._arrays(query, parameters, columns)
+
+    def streak_measurements(self, streaks, columns=('time', 'intensity', 'A')):
+        """
+        Return the measurements of a set of streaks, read with a single query for up to hundreds of them.
+
+        Only the measurements of the channel each streak was recorded from are returned.
+
+        Args:
+            streaks: Ids of the streaks, or dicts as given by the streaks method.
+            columns: Keys of the values returned, from those in COLUMNS.
+
+        Returns:
+            list: A dict like those returned by measurements for each streak, in the order given.
+
+        """
+        ids = [s['id'] if isinstance(s, dict) else s for s in streaks]
+        selected = ", ".join("m." + COLUMNS[c] for c in columns)
+        found = {}
+        for first in range(0, len(ids), _MAX_PARAMETERS):
+            chunk = ids[first:first + _MAX_PARAMETERS]
+            query = ("SELECT m.streak, %s FROM measurements m JOIN streaks s ON m.streak = s.id AND m.channel = "
+                     "s.channel WHERE m.streak IN (%s) ORDER BY m.streak, m.time" %
+                     (selected, ", ".join("?" * len(chunk))))
+            data = self._arrays(query, chunk, ('streak',) + tuple(columns))
+            streak_ids = data.pop('streak').astype(int)
+            unique, starts = np.unique(streak_ids, return_index=True)  # Rows are sorted by streak
+            for i, streak_id in enumerate(unique):
+                stop = starts[i + 1] if i + 1 < len(starts) else len(streak_ids)
+                found[streak_id] = {key: values[starts[i]:stop] for key, values in data.items()}
+        empty = {key: np.empty(0) for key in columns}
+        return [found.get(streak_id, empty) for streak_id in ids]
+
+
+class ComparisonPlot:
+    """
+    The levels of many streaks over the time since their start, drawn as a single collection of lines.
+
+    The newest streak is highlighted, older ones fade, so a streak can be compared with hundreds of past ones at the
+    cost of drawing one artist.
+    """
+
+    def __init__(self, place, canvas, column='A'):
+        """
+        Args:
+            place: The axes where the streaks are drawn.
+            canvas: The canvas of the figure.
+            column (str): Key of the values drawn, from those in COLUMNS.
+        """
+        from matplotlib.collections import LineCollection
+
+        self.place = place
+        self.canvas = canvas
+        self.column = column
+        self.lines = LineCollection([], linewidths=1.)
+        place.add_collection(self.lines)
+        place.set_xlabel("time since the start of the streak (s)")
+
+    def set_streaks(self, series):
+        """Draw the streaks, given as dicts of arrays with the time and the column, from the oldest"""
+        segments = [np.column_stack((s['time'] - s['time'][0], s[self.column])) for s in series if len(s['time'])]
+        alphas = np.linspace(0.15, 0.6, len(segments)) if segments else []
+        colors = [(0.2, 0.4, 0.8, alpha) for alpha in alphas]
+        if colors:
+            colors[-1] = (0.8, 0.1, 0.1, 1.)  # The newest one
+        self.lines.set_segments(segments)
+        self.lines.set_color(colors)
+        if segments:
+            points = np.concatenate(segments)
+            points = points[np.isfinite(points).all(axis=1)]
+            if len(points):
+                self.place.set_xlim(0, max(points[:, 0].max(), 1.))
+                low, high = points[:, 1].min(), points[:, 1].max()
+                margin = max(0.05 * (high - low), 1.)
+                self.place.set_ylim(low - margin, high + margin)
+        self.canvas.draw()
+
+
+def _format_time(timestamp):
+    return "" if timestamp is None else datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _format_number(value, pattern="%.4g"):
+    return "-" if value is None else pattern % value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List the sessions and streaks of a store")
+    parser.add_argument("path", nargs="?", default="sessions.db", help="Path to the database")
+    parser.add_argument("--session", type=int, help="List only the streaks of this session")
+    args = parser.parse_args()
+
+    with SessionStore(args.path) as store:
+        if args.session is None:
+            for s in store.sessions():
+                print("Session %d: %s - %s  %s  %s Hz  %s channel(s)  %s" %
+                      (s['id'], _format_time(s['start_time']), _format_time(s['end_time']), s['device'] or "",
+                       s['rate'], s['channels'], s['label'] or ""))
+        for s in store.streaks(args.session):
+            print("  Streak %d (session %d, channel %d): %s  %s points  mean %s ± %s  LAeq %s  %s" %
+                  (s['id'], s['session'], s['channel'], _format_time(s['start_time']), _format_number(s['count'], "%d"),
+                   _format_number(s['mean']), _format_number(s['err']), _format_number(s['laeq'], "%.1f"),
+                   s['label'] or ""))
+
+
+if __name__ == "__main__":
+    main()
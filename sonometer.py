@@ -3,217 +3,282 @@
 
 """Listen to sound intensity using a microphone"""
 
-import datetime
-import csv
-from threading import Lock
+import time
 
-import pyaudio  # pacman -S portaudio && pip install pyaudio
-import numpy as np
-import matplotlib
+_start_time = time.perf_counter()  # To measure the start-up time
+
+import argparse
+import os
+import sys
+from threading import Event, Lock, RLock, Thread, current_thread
 
-matplotlib.use('TkAgg')
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
+import numpy as np
 
-from tkinter import *
-from tkinter.ttk import *
+from buffers import BlockRing, Windower
+from devices import add_device_arguments, start_registry, start_supervision
+from levels import BandAnalyzer, LevelStatistics
+from metrics import Metrics, add_metrics_arguments, start_metrics_exporter
+from pipeline import Pipeline, level_stages
+from recorder import add_recording_arguments, start_recording
+from sources import PortAudioSource, WavSource, RawSource
+from storage import MeasurementWriter
 
 __author__ = 'Dih5'
 __version__ = "0.1.0"
 
+# The user interface is in tkgui, which is only imported when needed, so that matplotlib and Tk are neither loaded nor
+# required when running headless
+_gui_names = ('TkListener', 'CreateToolTip', 'IntensityListener')
+
+
+def __getattr__(name):
+    if name in _gui_names:
+        import tkgui
+        return getattr(tkgui, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
 class Listener:
-    def __init__(self, interval, chunk=1024, data_type=pyaudio.paInt16, channels=1, rate=44100):
-        self.interval = interval
+    def __init__(self, interval, chunk=1024, data_type=None, channels=1, rate=44100, source=None,
+                 buffer_seconds=5.0, hop=None, metrics=None):
+        """
+        Args:
+            interval (float): Seconds of audio in each window delivered to the callback.
+            chunk (int): Frames in each block read from a live source. Windows are built from these blocks, so the
+                         device is never reopened to change the interval.
+            source (AudioSource): The source of the audio. If None, the default PortAudio input device is used.
+            buffer_seconds (float): Seconds of audio a live source can get ahead of the callback before blocks are
+                                    dropped.
+            hop (float): Seconds between the starts of consecutive windows. None for no overlap.
+            metrics (Metrics): Where the timings and counts of the processing are recorded. A new one if None.
+        """
+        if source is None:
+            source = PortAudioSource(rate=rate, channels=channels, data_type=data_type)
         self.chunk = chunk
         self.data_type = data_type
-        self.channels = channels
-        self.rate = rate
-
-        self.p = pyaudio.PyAudio()
-        self.selected_api = 0  # TODO: This is a fixed selection
-        self.selected_device = None
-        self.audio_stream = None
-        self.to_stop = False  # Whether to stop after next callback
-
-        self.lock = Lock()
+        self.source = source
+        self.channels = source.channels
+        self.rate = source.rate
+        self.buffer_seconds = buffer_seconds
+        self.metrics = Metrics() if metrics is None else metrics
+        self.window_time = None  # perf_counter time when the audio of the window being delivered was captured
+        self.taps = []  # Functions called with every block of audio as captured, before building the windows
+
+        self.interval = None
+        self.hop = None
+        self.window_sizes = None  # Sizes in bytes of the windows and of the hop
+        self.set_interval(interval, hop)
+
+        self.running = False
+        self.ring = None  # Blocks of a live source waiting for the worker
+        self.worker = None
+        self.last_block_time = None  # monotonic time when the last block of a live source arrived
+        self.closed = False  # Whether terminated, so it must not be started again
+        self._callback = None  # Callback given to start
+        self._control = RLock()  # Starting and stopping can be requested from several threads
+        self._published = {}  # Counts of the source and the ring already added to the metrics
+
+    @property
+    def selected_device(self):
+        return getattr(self.source, "device", None)
+
+    @selected_device.setter
+    def selected_device(self, device):
+        self.source.device = device
+
+    @property
+    def overruns(self):
+        """Number of blocks dropped because the callback could not keep up with a live source"""
+        return self.ring.overruns if self.ring is not None else 0
 
     def list_api(self):
         """Return the list of available apis"""
-        return [self.p.get_host_api_info_by_index(x) for x in range(0, self.p.get_host_api_count())]
+        return self.source.list_api()
 
     def device_list(self, api=None):
-        """Return the list of input devices in the given api"""
-        if api is None:
-            api = self.selected_api
-        devices_in_api = self.list_api()[api]['deviceCount']
-        recording_device_list = []
-        for x in range(0, devices_in_api):
-            device = self.p.get_device_info_by_host_api_device_index(api, x)
-            if device['maxInputChannels']:
-                recording_device_list.append(device)
-        return recording_device_list
+        """Return the list of input devices in the given api, as enumerated when the source was created or reset"""
+        return self.source.device_list(api)
 
-    def start(self, callback):
-        def wrapped_callback(in_data, frame_count, time_info, status_flags):
-            with self.lock:
-                callback(in_data)
-                if self.to_stop:
-                    self.to_stop = False
-                    return None, pyaudio.paComplete
-                else:
-                    return None, pyaudio.paContinue
-
-        if self.audio_stream is not None:
-            return False
-        if self.selected_device is not None:
-            self.audio_stream = self.p.open(format=self.data_type, channels=self.channels, rate=self.rate, input=True,
-                                            frames_per_buffer=int(self.rate * self.interval),
-                                            stream_callback=wrapped_callback, input_device_index=self.selected_device)
-        else:
-            self.audio_stream = self.p.open(format=self.data_type, channels=self.channels, rate=self.rate, input=True,
-                                            frames_per_buffer=int(self.rate * self.interval),
-                                            stream_callback=wrapped_callback)
-
-        self.audio_stream.start_stream()
-        return True
+    def change_device(self, device):
+        """
+        Capture from another device of the source, resuming with the same callback if running.
 
-    def stop(self):
-        if self.audio_stream is None:
-            return False
-        # If sampling time is too small, this might remain locked.
-        # A timeout is used just in case
-        if self.lock.acquire(blocking=True, timeout=max(self.interval * 2, 1.0)):
-            self.to_stop = True
-            self.audio_stream.close()
-            self.audio_stream = None
-            return True
-        else:
-            return False
+        The capture is stopped and started again from the calling thread, so it must not hold any lock the callback
+        waits for.
+        """
+        with self._control:
+            running = self.running
+            self.stop()
+            self.source.device = device
+            if running:
+                self.start(self._callback)
+
+    def reopen(self, device_name=None):
+        """
+        Capture again with the callback given to start, from the device with the given name or the default one.
 
-    def terminate(self):
-        self.stop()
-        self.p.terminate()
-
-
-class TkListener(Frame):
-    def __init__(self, plot_f, data_f=lambda x: x, interval=0.3, master=None, title="TkListener"):
-        super().__init__(master=master)
-        self.master.title(title)
-        self.pack()
-        self.figure = Figure(figsize=(5, 4), dpi=100)
-        self.active_subplot = self.figure.add_subplot(111)
-        self.plot_f = plot_f
-        self.data_f = data_f
-        self.data = []
-        self.lock = Lock()
+        The devices are enumerated again first, and found by name because their indexes can change when they are
+        plugged in again. It can be used after the stream has failed.
 
-        # Create a tk.DrawingArea
-        self.canvas = FigureCanvasTkAgg(self.figure, master=self)
-        self.canvas.show()
-        self.canvas.get_tk_widget().pack(side=TOP, fill=BOTH, expand=1)
+        Returns:
+            bool: Whether the device was found. If not, the capture is left stopped.
 
-        self.listener = Listener(interval)
-        self.listener.start(self.callback)
+        Raises:
+            OSError: If the device cannot be opened. The capture is left stopped.
 
-        self.after(100, self.update_plot)
+        """
+        with self._control:
+            if self.closed:
+                return False
+            self.stop()
+            self.source.reset()
+            device = None
+            if device_name is not None:
+                device = self.source.find_device(device_name)
+                if device is None:
+                    return False
+            self.source.device = device
+            self.start(self._callback)
+            return True
 
-    def restart_listener(self, interval):
-        if not self.listener.stop():
-            return False
+    def set_interval(self, interval, hop=None):
+        """Change the length of the windows and their hop. It can be called while running, taking effect at once."""
+        frame_bytes = self.channels * self.source.sample_width
+        window_frames = max(1, int(self.rate * interval))
+        hop_frames = window_frames if hop is None else max(1, int(self.rate * hop))
+        if hop_frames > window_frames:
+            raise ValueError("The hop must not be greater than the interval")
+        self.interval = interval
+        self.hop = hop
+        self.window_sizes = (window_frames * frame_bytes, hop_frames * frame_bytes)
 
-        self.listener = Listener(interval)
-        self.listener.start(self.callback)
-        return True
+    def _windowed(self, callback):
+        """
+        Wrap the callback so it receives windows built from the blocks given to the wrapper, timing each call.
 
-    def callback(self, in_data):
-        with self.lock:
-            self.data.append(self.data_f(in_data))
+        The wrapper takes the perf_counter time when the block was captured, which is now if not given.
+        """
+        sizes = self.window_sizes
+        windower = Windower(*sizes)
+        metrics = self.metrics
+        bytes_per_second = self.rate * self.channels * self.source.sample_width
+
+        def windowed_callback(data, capture_time=None):
+            nonlocal sizes
+            if self.window_sizes is not sizes:
+                sizes = self.window_sizes
+                windower.set_size(*sizes)
+            self.window_time = time.perf_counter() if capture_time is None else capture_time
+            for tap in self.taps:
+                tap(data)
+            for window in windower.push(data):
+                start = time.perf_counter()
+                callback(window)
+                end = time.perf_counter()
+                metrics.observe('analysis_seconds', end - start)
+                metrics.observe('capture_to_analysis_seconds', end - self.window_time)
+                # Fraction of the real time spent in the callback. Above 1 the processing falls behind.
+                metrics.set('analysis_load', (end - start) * bytes_per_second / sizes[1])
+                metrics.increment('windows_total')
+
+        return windowed_callback
+
+    def _source_frames(self):
+        """Frames in each block read from a non-live source"""
+        return self.window_sizes[1] // (self.channels * self.source.sample_width)
+
+    def _publish_status(self, ring):
+        """Add to the metrics the counts of the source and the ring, which their threads change without locks"""
+        counts = {'input_overflows_total': self.source.overflows, 'input_underflows_total': self.source.underflows,
+                  'blocks_dropped_total': ring.overruns}
+        for name, count in counts.items():
+            new = count - self._published.get(name, 0)
+            if new > 0:
+                self.metrics.increment(name, new)
+            self._published[name] = count
+        if ring.last_latency is not None:
+            self.metrics.observe('callback_latency_seconds', ring.last_latency)
+        self.metrics.set('queue_depth', len(ring))
+
+    def _work(self, callback):
+        """Feed the callback with the blocks in the ring until it is closed, publishing the status of the stream"""
+        ring = self.ring
+        while True:
+            data = ring.get()
+            if data is None:
+                self._publish_status(ring)
+                return
+            self._publish_status(ring)
+            callback(data, ring.last_timestamp)
 
-    def update_plot(self):
-        """The callback function used to update the plot"""
-        with self.lock:
-            data = self.data
-            self.data = []
-        if data:
-            for new_data in data:
-                self.plot_f(new_data, self.active_subplot)
-            self.canvas.draw()
-        self.after(100, self.update_plot)
+    def start(self, callback):
+        """
+        Start feeding the callback with the audio windows.
 
+        With a live source the audio thread only copies the blocks into a ring, and the callback runs in a worker
+        thread of its own. Other sources run the callback in their own thread.
+        """
+        with self._control:
+            if self.running:
+                return False
+            self._callback = callback
+            if self.source.live:
+                self.ring = BlockRing(self.chunk * self.channels * self.source.sample_width,
+                                      max(4, int(np.ceil(self.buffer_seconds * self.rate / self.chunk))))
+                ring = self.ring
+                source = self.source
+                # The ring starts with no overruns, while the counts of the source go on
+                self._published = {'input_overflows_total': source.overflows,
+                                   'input_underflows_total': source.underflows}
+
+                def produce(in_data):
+                    # Run in the audio thread: no locks, the metrics are published by the worker. An overrun, counted
+                    # by the ring, must not stop the source.
+                    self.last_block_time = time.monotonic()
+                    ring.put(in_data, time.perf_counter(), source.latency)
+
+                self.worker = Thread(target=self._work, args=(self._windowed(callback),), daemon=True)
+                self.worker.start()
+                self.last_block_time = time.monotonic()
+                try:
+                    self.source.start(produce, self.chunk)
+                except Exception:
+                    # The device cannot be opened. The worker would wait forever.
+                    self.ring.close()
+                    self.worker.join()
+                    self.worker = None
+                    raise
+            else:
+                self.source.start(self._windowed(callback), self._source_frames())
+            self.running = True
+            return True
 
-# Tooltip for tk (taken from https://github.com/Dih5/xpecgen)
-class CreateToolTip(object):
-    """
-    A tooltip for a given widget.
-    """
+    def run(self, callback):
+        """Feed the whole source to the callback in the calling thread, as fast as the source allows"""
+        if self.running:
+            return False
+        self.source.run(self._windowed(callback), self._source_frames())
+        return True
 
-    # Based on the content from this post:
-    # http://stackoverflow.com/questions/3221956/what-is-the-simplest-way-to-make-tooltips-in-tkinter
+    def stop(self):
+        """Stop the source, waiting for the callback to process the blocks already captured"""
+        with self._control:
+            if not self.running:
+                return False
+            self.source.stop()
+            if self.worker is not None:
+                self.ring.close()
+                if self.worker is not current_thread():
+                    self.worker.join()
+                self.worker = None
+            self.running = False
+            return True
 
-    def __init__(self, widget, text, color="#ffe14c"):
-        """
-        Create a tooltip for an existent widget.
-        Args:
-            widget: The widget the tooltip is applied to.
-            text (str): The text of the tooltip.
-            color: The color of the tooltip.
-        """
-        self.waittime = 500  # miliseconds
-        self.wraplength = 180  # pixels
-        self.widget = widget
-        self.text = text
-        self.color = color
-        self.widget.bind("<Enter>", self.enter)
-        self.widget.bind("<Leave>", self.leave)
-        self.widget.bind("<ButtonPress>", self.leave)
-        self.id = None
-        self.tw = None
-
-    def enter(self, event=None):
-        self.schedule()
-
-    def leave(self, event=None):
-        self.unschedule()
-        self.hidetip()
-
-    def schedule(self):
-        self.unschedule()
-        self.id = self.widget.after(self.waittime, self.showtip)
-
-    def unschedule(self):
-        id = self.id
-        self.id = None
-        if id:
-            self.widget.after_cancel(id)
-
-    def showtip(self, event=None):
-        x, y, cx, cy = self.widget.bbox("insert")
-        x += self.widget.winfo_rootx() + 25
-        y += self.widget.winfo_rooty() + 20
-        # creates a toplevel window
-        self.tw = Toplevel(self.widget)
-        # Leaves only the label and removes the app window
-        self.tw.wm_overrideredirect(True)
-        self.tw.wm_geometry("+%d+%d" % (x, y))
-        label = Label(self.tw, text=self.text, justify='left',
-                      background=self.color, relief='solid', borderwidth=1,
-                      wraplength=self.wraplength)
-        label.pack(ipadx=1)
-
-    def hidetip(self):
-        tw = self.tw
-        self.tw = None
-        if tw:
-            tw.destroy()
-
-
-# Specific intensity logic
-# From this point code could be moved to a new file to avoid repetition in freqmeter.py
-
-
-def data_to_intensity(data):
-    return np.linalg.norm(np.fromstring(data, np.int16), 2)
+    def terminate(self):
+        with self._control:
+            self.closed = True
+            self.stop()
+            self.source.close()
 
 
 lock = Lock()
@@ -228,227 +293,484 @@ class controlled_execution:
 
 
 class Streak:
-    def __init__(self, points_max):
+    """
+    A sequence of points recorded together.
+
+    Its statistics are kept in running accumulators (Welford's algorithm for the mean and variance), so they cost the
+    same whatever the length of the streak. Storing the points themselves in data is optional.
+    """
+
+    def __init__(self, points_max, keep_data=True):
         self.start_x = None
         self.end_x = None
         self.data = []
+        self.keep_data = keep_data
         self.points_max = points_max
-        pass
+        self.levels = LevelStatistics()  # Statistics of the weighted levels of the points
+        self._reset()
+
+    def _reset(self):
+        self.count = 0
+        self._mean = 0.0
+        self._m2 = 0.0  # Sum of squared deviations from the mean
+        self.min = None
+        self.max = None
+        self.energy = 0.0  # Sum of the squared points
 
     def __len__(self):
-        return len(self.data)
+        return self.count
+
+    def _accumulate(self, y):
+        self.count += 1
+        delta = y - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (y - self._mean)
+        self.min = y if self.min is None else min(self.min, y)
+        self.max = y if self.max is None else max(self.max, y)
+        self.energy += y * y
+        if self.keep_data:
+            self.data.append(y)
 
     def add_first(self, start_x, start_y):
         self.start_x = start_x
         self.end_x = start_x
-        self.data = [start_y]
+        self.data = []
+        self._reset()
+        self._accumulate(start_y)
 
     def add(self, y):
-        if len(self.data) < self.points_max:
+        if len(self) < self.points_max:
             self.end_x = (self.end_x + 1) % self.points_max
-        self.data.append(y)
+        self._accumulate(y)
 
     def mean(self):
-        return np.mean(self.data) if len(self) > 0 else 0
+        return self._mean if len(self) > 0 else 0
+
+    def var(self):
+        """Sample variance of the points"""
+        return self._m2 / (self.count - 1) if len(self) > 1 else 0
 
     def err(self):
-        return np.std(self.data, ddof=1) / np.sqrt(len(self.data)) if len(self) > 1 else 0
+        return np.sqrt(self.var() / self.count) if len(self) > 1 else 0
 
-    def plot(self, place, color='green', labeled=True):
+    def leq(self):
+        """Equivalent level of the points in dB, i.e., the level of their mean energy"""
+        return 10 * np.log10(self.energy / self.count) if self.energy > 0 else -np.inf
+
+    def add_level(self, level):
+        """Add the weighted level in dB measured with the last point"""
+        self.levels.add(level)
+
+    def plot(self, place, color='green', labeled=True, animated=False):
+        """Draw the streak mean and its error band, returning the created artists"""
         if len(self) < 2:
-            return
+            return []
         mean = self.mean()
         err = self.err()
         points_max = self.points_max
         if len(self) >= points_max:  # Covers all plot
-            place.plot([0, points_max - 1], [mean, mean], '-', color=color)
-            place.fill_between([0, points_max - 1], [mean - err, mean - err], [mean, mean], facecolor=color,
-                               alpha=0.5)
-            place.fill_between([0, points_max - 1], [mean, mean], [mean + err, mean + err], facecolor=color,
-                               alpha=0.5)
+            artists = self._band(place, [0, points_max - 1], mean, err, color)
             if labeled:
-                place.text(points_max / 2, mean + err, u"%.2f ± %.2f" % (mean, err))
+                artists.append(place.text(points_max / 2, mean + err, u"%.2f ± %.2f" % (mean, err)))
         elif self.end_x > self.start_x:  # No anomalies
-            place.plot([self.start_x, self.end_x], [mean, mean], '-', color=color)
-            place.fill_between([self.start_x, self.end_x], [mean - err, mean - err], [mean, mean],
-                               facecolor=color, alpha=0.5)
-            place.fill_between([self.start_x, self.end_x], [mean, mean], [mean + err, mean + err],
-                               facecolor=color, alpha=0.5)
+            artists = self._band(place, [self.start_x, self.end_x], mean, err, color)
             if labeled:
-                place.text(self.start_x, mean + err, u"%.2f ± %.2f" % (mean, err))
+                artists.append(place.text(self.start_x, mean + err, u"%.2f ± %.2f" % (mean, err)))
         elif self.end_x < self.start_x:  # Wraps circularly
-            place.plot([0, self.end_x], [mean, mean], '-', color=color)
-            place.fill_between([0, self.end_x], [mean - err, mean - err], [mean, mean],
-                               facecolor=color, alpha=0.5)
-            place.fill_between([0, self.end_x], [mean, mean], [mean + err, mean + err],
-                               facecolor=color, alpha=0.5)
-            place.plot([self.start_x, points_max - 1], [mean, mean], '-', color=color)
-            place.fill_between([self.start_x, points_max - 1], [mean - err, mean - err], [mean, mean],
-                               facecolor=color, alpha=0.5)
-            place.fill_between([self.start_x, points_max - 1], [mean, mean], [mean + err, mean + err],
-                               facecolor=color, alpha=0.5)
+            artists = self._band(place, [0, self.end_x], mean, err, color)
+            artists += self._band(place, [self.start_x, points_max - 1], mean, err, color)
             if labeled:
-                place.text(0, mean + err, u"%.2f ± %.2f" % (mean, err))
+                artists.append(place.text(0, mean + err, u"%.2f ± %.2f" % (mean, err)))
+        else:
+            artists = []
+        for artist in artists:
+            artist.set_animated(animated)
+        return artists
+
+    @staticmethod
+    def _band(place, x, mean, err, color):
+        artists = place.plot(x, [mean, mean], '-', color=color)
+        artists.append(place.fill_between(x, [mean - err, mean - err], [mean, mean], facecolor=color, alpha=0.5))
+        artists.append(place.fill_between(x, [mean, mean], [mean + err, mean + err], facecolor=color, alpha=0.5))
+        return artists
+
 
+class IntensityPlot:
+    """
+    The last points measured, drawn circularly in an axes together with the means of the streaks.
+
+    Artists are persistent. The points and the streak being recorded are animated and blitted over a cached background
+    holding the axes and the saved streaks, which is only drawn again when the streaks or the limits change.
+    """
 
-class IntensityListener(TkListener):
-    def __init__(self, master=None, points_max=80, interval=0.3):
-        super().__init__(plot_f=self.intensity_plot, interval=interval, master=master, title="Sonometer")
+    def __init__(self, place, canvas, points_max):
+        """
+        Args:
+            place: The axes where the points are drawn.
+            canvas: The canvas of the figure of the axes.
+            points_max (int): Number of points kept in the plot.
+        """
+        self.place = place
+        self.canvas = canvas
+        self.points_max = points_max
         self.current_pos = 0
-        self.points_max = points_max  # points kept in the plot
-
-        self.recording = False  # Whether a streak is being recorded
-
-        self.streaks = []  # Saved streaks of data
-
-        self.intensity_data = [0] * self.points_max
-
-        # Add specific controls
-
-        self.varStatus = StringVar()
-        self.varStatus.set("Sonometer started")
-        self.lblStatus = Label(master=self, textvariable=self.varStatus)
-        self.lblStatus.pack(side=BOTTOM)
-
-        self.frmOperations = Frame(master=self)
-        self.frmOperations.pack(side=BOTTOM)
-
-        self.buttonClearPoints = Button(master=self.frmOperations, text='Clear points', command=self.clear_points)
-        self.buttonClearPoints.pack(side=LEFT)
-
-        self.buttonClearStreaks = Button(master=self.frmOperations, text='Clear streaks', command=self.clear_streaks)
-        self.buttonClearStreaks.pack(side=LEFT)
-
-        self.buttonStartStreak = Button(master=self.frmOperations, text='Start streak', command=self.start_streak)
-        self.buttonStartStreak.pack(side=LEFT)
-
-        self.buttonStopStreak = Button(master=self.frmOperations, text='Stop streak', command=self.stop_streak,
-                                       state=DISABLED)
-        self.buttonStopStreak.pack(side=LEFT)
-
-        self.buttonCapture = Button(master=self.frmOperations, text='Plot capture', command=self.plot_capture)
-        self.buttonCapture.pack(side=LEFT)
-        self.ttpCapture = CreateToolTip(self.buttonCapture,
-                                        "Save the plot in pdf format.")
-
-        self.frmConfig = Frame(master=self)
-        self.frmConfig.pack(side=BOTTOM)
-
-        self.frmInterval = LabelFrame(master=self.frmConfig, text="Sampling per point (s)")
-        self.frmInterval.pack(side=LEFT)
-        self.varInterval = DoubleVar()
-        self.varInterval.set(self.listener.interval)
-        self.txtInterval = Entry(master=self.frmInterval, textvariable=self.varInterval)
-        self.buttonInterval = Button(master=self.frmInterval, text='Update', command=self.change_interval)
-        self.txtInterval.pack(side=TOP)
-        self.buttonInterval.pack(side=TOP)
-        self.ttpInterval = CreateToolTip(self.buttonInterval,
-                                         "Change the sampling time per point to the number above.\nMust be > 0.1 s.")
-
-        self.frmStreakLen = LabelFrame(master=self.frmConfig, text="Streak max points")
-        self.frmStreakLen.pack(side=LEFT)
-        self.varStreakLen = IntVar()
-        self.varStreakLen.set(0)
-        self.txtStreakLen = Entry(master=self.frmStreakLen, textvariable=self.varStreakLen)
-        self.txtStreakLen.pack(side=TOP)
-        self.ttpStreakLen = CreateToolTip(self.txtStreakLen,
-                                          "Stop the streak when this number of points is reached. 0 for no automatic stop.")
-
-        self.varStreakToCsv = BooleanVar()
-        self.varStreakToCsv.set(True)
-        self.chkStreakToCsv = Checkbutton(master=self.frmStreakLen, text="Save streaks", variable=self.varStreakToCsv)
-        self.chkStreakToCsv.pack(side=BOTTOM)
-        self.ttpStreakToCsv = CreateToolTip(self.chkStreakToCsv,
-                                            "If on, the streak will be saved as a csv when completed.")
-
-    def change_interval(self):
-        new_interval = self.varInterval.get()
-        if new_interval == self.listener.interval:
-            self.varStatus.set("Selected interval has not changed")
-            return False
-        if new_interval < 0.1:
-            self.varStatus.set("Too small sampling ignored (min. 0.1).")
-            self.varInterval.set(0.1)
-            return False
-        max_retries = 3
-        while max_retries > 0:
-            max_retries -= 1
-            if self.restart_listener(new_interval):
-                self.varStatus.set("Sampling interval set to %g" % new_interval)
-                return True
-        self.varStatus.set("Unable to change the interval.")
-        return False
-
-    def clear_points(self):
-        with controlled_execution():
-            self.current_pos = 0
-            self.intensity_data = [0] * self.points_max
-
-    def clear_streaks(self):
-        with controlled_execution():
-            self.streaks = []
-
-    def start_streak(self):
-        with controlled_execution():
-            self.streaks.append(Streak(self.points_max))
-            self.recording = True
-            self.buttonStopStreak["state"] = "normal"
-            self.buttonStartStreak["state"] = "disabled"
-            self.buttonClearPoints["state"] = "disabled"
-            self.buttonClearStreaks["state"] = "disabled"
-
-    def stop_streak(self):
-        with controlled_execution():
-            self.recording = False
-            self.buttonStartStreak["state"] = "normal"
-            self.buttonStopStreak["state"] = "disabled"
-            self.buttonClearPoints["state"] = "enabled"
-            self.buttonClearStreaks["state"] = "enabled"
-            if self.varStreakToCsv.get():
-                t = datetime.datetime.now().strftime("%S%M%H%d%m%y")
-                file_name = 'data%s.csv' % t
-                with open(file_name, 'w', newline='') as csvfile:
-                    writer = csv.writer(csvfile, delimiter=',')
-                    writer.writerow(self.streaks[-1].data)
-                self.varStatus.set("Data saved as %s" % file_name)
-
-    def plot_capture(self):
-        with controlled_execution():
-            t = datetime.datetime.now().strftime("%S%M%H%d%m%y")
-            file_name = "sound" + t + ".pdf"
-            self.figure.savefig(file_name)
-            self.varStatus.set("Plot saved as " + file_name)
-
-    def intensity_plot(self, in_data, plot):
+        self.data = np.zeros(points_max)
+
+        self.points_line, = place.plot(np.arange(points_max), self.data, 'o', animated=True)
+        self.cursor_line, = place.plot([self.current_pos], [0], 'ro', animated=True)
+        place.set_autoscale_on(False)
+        place.ticklabel_format(style='sci', axis='y', scilimits=(0, 0))
+        self.saved_streak_artists = []
+        self.saved_streaks_range = None  # (min, max) of the bands of the saved streaks
+        self.current_streak_artists = []
+        self.current_streak_len = 0  # Length of the streak when its artists were created
+        self.streaks_changed = False  # Whether the saved streaks must be drawn again
+        self.background = None
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+    def add(self, value):
+        """Add a new point, returning its position"""
         self.current_pos += 1
         self.current_pos %= self.points_max
-        self.intensity_data[self.current_pos] = data_to_intensity(in_data)
-        plot.clear()
-        plot.plot(self.intensity_data, 'o')
-        plot.plot([self.current_pos], [self.intensity_data[self.current_pos]], 'ro')
-        if self.recording:
-            if not self.streaks:
-                print("Error: tried to record with no streak object")
-            else:
-                if len(self.streaks[-1]) == 0:
-                    self.streaks[-1].add_first(self.current_pos, self.intensity_data[self.current_pos])
-                else:
-                    self.streaks[-1].add(self.intensity_data[self.current_pos])
-                if 0 < self.varStreakLen.get() < len(self.streaks[-1]):
-                    self.stop_streak()
+        self.data[self.current_pos] = value
+        return self.current_pos
+
+    def clear(self):
+        self.current_pos = 0
+        self.data[:] = 0
+
+    def invalidate_streaks(self):
+        """Mark the list of streaks as changed, so the saved streaks are drawn again"""
+        self.streaks_changed = True
+
+    def draw(self, streaks):
+        """Update the artists and draw them, redrawing the background only if it has changed"""
+        self.points_line.set_ydata(self.data)
+        self.cursor_line.set_data([self.current_pos], [self.data[self.current_pos]])
+
+        full_draw = self.background is None
+        if self.streaks_changed:
+            self.streaks_changed = False
+            self._draw_saved_streaks(streaks)
+            self.current_streak_len = 0
+            full_draw = True
+        if streaks and len(streaks[-1]) != self.current_streak_len:
+            self.current_streak_len = len(streaks[-1])
+            for artist in self.current_streak_artists:
+                artist.remove()
+            self.current_streak_artists = streaks[-1].plot(self.place, animated=True)
+        elif not streaks and self.current_streak_artists:
+            for artist in self.current_streak_artists:
+                artist.remove()
+            self.current_streak_artists = []
+        if self._update_limits(streaks):
+            full_draw = True
+
+        if full_draw:
+            self.canvas.draw()  # The background is taken in _on_draw
+        else:
+            self.canvas.restore_region(self.background)
+            self._draw_animated()
+            self.canvas.blit(self.place.bbox)
+
+    def savefig(self, figure, file_name):
+        """Save the figure with the plot, which needs the animated artists to be drawn as regular ones"""
+        animated = self._animated_artists()
+        for artist in animated:
+            artist.set_animated(False)
+        try:
+            figure.savefig(file_name)
+        finally:
+            for artist in animated:
+                artist.set_animated(True)
+        self.background = None
+
+    def _draw_saved_streaks(self, streaks):
+        """Create the artists of all but the last streak"""
+        for artist in self.saved_streak_artists:
+            artist.remove()
+        self.saved_streak_artists = []
+        self.saved_streaks_range = None
+        for s in streaks[:-1]:
+            self.saved_streak_artists += s.plot(self.place, 'yellow')
+            if len(s) > 1:
+                self.saved_streaks_range = self._join_ranges(self.saved_streaks_range,
+                                                             (s.mean() - s.err(), s.mean() + s.err()))
+
+    @staticmethod
+    def _join_ranges(a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return min(a[0], b[0]), max(a[1], b[1])
+
+    def _update_limits(self, streaks):
+        """Rescale the y axis if the data does not fit or fills too little of it. Return whether it was rescaled."""
+        low, high = np.min(self.data), np.max(self.data)
+        data_range = self._join_ranges((low, high), self.saved_streaks_range)
+        if streaks and len(streaks[-1]) > 1:
+            s = streaks[-1]
+            data_range = self._join_ranges(data_range, (s.mean() - s.err(), s.mean() + s.err()))
+        low, high = data_range
+        margin = (high - low) * 0.1 if high > low else max(abs(high) * 0.1, 1.0)
+        bottom, top = self.place.get_ylim()
+        if low >= bottom and high <= top and (high - low + 2 * margin) > (top - bottom) / 3:
+            return False
+        self.place.set_ylim(low - margin, high + margin)
+        return True
+
+    def _animated_artists(self):
+        return [self.points_line, self.cursor_line] + self.current_streak_artists
+
+    def _draw_animated(self):
+        for artist in self._animated_artists():
+            self.place.draw_artist(artist)
+
+    def _on_draw(self, event):
+        """Keep the static part of the plot after every full draw, also when the window is resized"""
+        if event is not None and event.canvas is not self.canvas:
+            return
+        self.background = self.canvas.copy_from_bbox(self.place.bbox)
+        self._draw_animated()
+
+
+def _parse_sources(args):
+    """Build the audio sources selected in the command line arguments, one per device"""
+    if args.wav:
+        return [WavSource(args.wav, realtime=not args.fast)]
+    if args.raw:
+        return [RawSource(rate=args.rate, channels=args.channels, realtime=not args.fast)]
+    return [PortAudioSource(rate=args.rate, channels=args.channels, device=device, api=args.api)
+            for device in args.device or [None]]
 
-        if self.streaks:
-            for s in self.streaks[:-1]:
-                s.plot(plot, 'yellow')
-            self.streaks[-1].plot(plot)
 
-        plot.ticklabel_format(style='sci', axis='y', scilimits=(0, 0))
+def _list_devices(source):
+    """Print the host apis and the input devices of a PortAudioSource"""
+    for api in source.list_api():
+        print("Api %d: %s%s" % (api['index'], api['name'], " (selected)" if api['index'] == source.selected_api
+                                else ""))
+        for device in source.device_list(api['index']):
+            print("    Device %d: %s (%d channels, %d Hz)" % (device['index'], device['name'],
+                                                             device['maxInputChannels'],
+                                                             device['defaultSampleRate']))
+
+
+def run_headless(listeners, output, output_format='csv', duration=None, sinks=()):
+    """
+    Write the measurements of the audio of one or more listeners, without any user interface.
+
+    Live listeners run at the same time, each one in its own thread, so a slow or stalled device does not hold back
+    the others. With several listeners each measurement has a 'device' key with the index of its listener. If the
+    reader of the output goes away, e.g., head, it stops quietly.
+
+    Args:
+        listeners: The listeners providing the audio.
+        output: Text stream where the measurements are written, or None not to write them.
+        output_format (str): 'csv' or 'json' (one object per line, also with the band levels).
+        duration (float): Seconds to run with a live source. None to run until interrupted.
+        sinks: Functions also called with each measurement, e.g., to publish it.
+
+    """
+    channels = max(listener.channels for listener in listeners)
+    several = len(listeners) > 1
+    writer = MeasurementWriter(output, output_format, channels, several) if output is not None else None
+    output_lock = Lock()  # The pipelines of the listeners share the writer and the sinks
+    closed = Event()  # Set when the output is a pipe closed by its reader
+
+    def output_sink(measurement):
+        with output_lock:
+            if closed.is_set():
+                return
+            if writer is not None:
+                try:
+                    writer.write(measurement)
+                except BrokenPipeError:
+                    closed.set()
+                    for listener in listeners:
+                        if not listener.source.live:
+                            listener.source.stop()  # Ends its run. Live ones are terminated by the calling thread.
+                    return
+            for sink in sinks:
+                sink(measurement)
+
+    def make_pipeline(index, listener):
+        stages = level_stages(BandAnalyzer(listener.rate, reference=32768.))
+        if several:
+            stages.append(lambda samples: {'device': index})
+        return Pipeline(stages, [output_sink], listener.channels)
+
+    print("Ready in %.3f s" % (time.perf_counter() - _start_time), file=sys.stderr)
+    try:
+        if not any(listener.source.live for listener in listeners):
+            for i, listener in enumerate(listeners):
+                if closed.is_set():
+                    break
+                listener.run(make_pipeline(i, listener))
+        else:
+            for i, listener in enumerate(listeners):
+                listener.start(make_pipeline(i, listener))
+            closed.wait(duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for listener in listeners:
+            listener.terminate()
+    if closed.is_set() and output is sys.stdout:
+        # The text left in the buffer would fail again when flushed at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
 
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--interval", type=float, default=0.3, help="Seconds sampled per point")
+    parser.add_argument("--points", type=int, default=80, help="Points kept in the plot")
+    parser.add_argument("--wav", help="Read the audio from a 16-bit PCM WAV file instead of the microphone")
+    parser.add_argument("--raw", action="store_true",
+                        help="Read raw 16-bit little-endian PCM from the standard input, with the channels given by "
+                             "--channels interleaved")
+    parser.add_argument("--rate", type=int, default=44100, help="Sampling rate of the raw input or of the devices")
+    parser.add_argument("--channels", type=int, default=1, help="Channels captured from each device or in the raw "
+                                                               "input")
+    parser.add_argument("--device", type=int, action="append",
+                        help="Index of an input device, as given by --list-devices. Repeat it to capture from several "
+                             "devices at once in headless mode.")
+    parser.add_argument("--api", type=int, help="Index of the host api of the devices. The default one if not given.")
+    parser.add_argument("--list-devices", action="store_true", help="Print the available recording devices and exit")
+    parser.add_argument("--channel", type=int, default=0, help="Channel shown in the plot")
+    parser.add_argument("--fps", type=float, default=20., help="Maximum frames per second of the plot")
+    parser.add_argument("--fast", action="store_true",
+                        help="Replay files or pipes as fast as possible instead of in real time")
+    parser.add_argument("--headless", action="store_true",
+                        help="Write the measurements instead of showing them. Tk and matplotlib are not used.")
+    parser.add_argument("--output", help="File where the measurements are written in headless mode. Standard "
+                                         "output by default.")
+    parser.add_argument("--format", choices=["csv", "json"], default="csv",
+                        help="Format of the measurements in headless mode")
+    parser.add_argument("--duration", type=float, help="Seconds to run in headless mode with a live source")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="Publish the measurements to the clients connecting to this TCP port. In headless mode "
+                             "they are then only written if --output is given.")
+    parser.add_argument("--bind", default="127.0.0.1",
+                        help="Address where clients are accepted. Use 0.0.0.0 to accept them from other machines.")
+    parser.add_argument("--multicast", metavar="GROUP:PORT", help="Also publish to a UDP multicast group")
+    parser.add_argument("--batch", type=int, default=1, help="Measurements sent in each published frame")
+    parser.add_argument("--store", metavar="DATABASE",
+                        help="Keep the session, its streaks and its measurements in this SQLite database")
+    add_recording_arguments(parser)
+    add_device_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    if args.list_devices:
+        source = PortAudioSource(api=args.api)
+        _list_devices(source)
+        source.close()
+        return
+    if args.device and len(args.device) > 1 and not args.headless:
+        parser.error("Several devices can only be used in headless mode")
+
+    server = None
+    if args.serve is not None:
+        from server import MeasurementServer
+
+        multicast = None
+        if args.multicast:
+            group, port = args.multicast.rsplit(":", 1)
+            multicast = (group, int(port))
+        server = MeasurementServer(args.bind, args.serve, batch_size=args.batch, multicast=multicast)
+        server.start()
+
+    store = None
+    if args.store is not None:
+        from sessions import SessionStore
+
+        store = SessionStore(args.store)
+
+    if args.headless:
+        metrics = Metrics()
+        listeners = [Listener(args.interval, source=source, metrics=metrics) for source in _parse_sources(args)]
+        exporter = start_metrics_exporter(args, metrics)
+        recorders = [start_recording(args, listener, "dev%d_" % i if len(listeners) > 1 else "")
+                     for i, listener in enumerate(listeners)]
+        recorders = [recorder for recorder in recorders if recorder is not None]
+        sinks = []
+        if server is not None:
+            server.metrics = metrics
+            sinks.append(server.publish)
+        if recorders:
+            def check(measurement):
+                recorders[measurement.get('device', 0)].check(measurement)
+
+            sinks.append(check)
+        if store is not None:
+            sessions = [store.start_session(listener.source.describe(), listener.rate, listener.channels,
+                                            listener.interval, listener.hop) for listener in listeners]
+
+            def keep(measurement):
+                store.write(measurement, sessions[measurement.get('device', 0)])
+
+            sinks.append(keep)
+        # Streams of devices that fail, e.g., when unplugged, are reopened
+        registry = None
+        if any(listener.source.live for listener in listeners):
+            registry = start_registry(args, metrics)
+        supervisors = start_supervision(args, listeners, registry)
+        try:
+            if args.output:
+                with open(args.output, 'a', newline='') as output:
+                    run_headless(listeners, output, args.format, args.duration, sinks)
+            else:
+                run_headless(listeners, None if server is not None else sys.stdout, args.format, args.duration,
+                             sinks)
+        finally:
+            for supervisor in supervisors:
+                supervisor.stop()
+            if registry is not None:
+                registry.stop()
+            for recorder in recorders:
+                recorder.close()
+            if exporter is not None:
+                exporter.stop()
+            if server is not None:
+                server.stop()
+            if store is not None:
+                for session in sessions:
+                    store.end_session(session)
+                store.close()
+        return
+
+    from tkinter import Tk
+    from tkgui import IntensityListener
+
     root = Tk()
-    app = IntensityListener(root, interval=0.3, points_max=80)
+    app = IntensityListener(root, interval=args.interval, points_max=args.points, source=_parse_sources(args)[0],
+                            show_metrics=args.metrics, channel=args.channel, max_fps=args.fps, store=store)
+    exporter = start_metrics_exporter(args, app.listener.metrics)
+    recorder = start_recording(args, app.listener)
+    if server is not None:
+        server.metrics = app.listener.metrics
+        app.pipeline.add_sink(server.publish)
+    if recorder is not None:
+        app.pipeline.add_sink(recorder.check)
+    registry = None
+    if app.listener.source.live:
+        registry = start_registry(args, app.listener.metrics)
+    supervisors = start_supervision(args, [app.listener], registry)
     app.mainloop()
+    for supervisor in supervisors:
+        supervisor.stop()
+    app.listener.terminate()
+    if registry is not None:
+        registry.stop()
+    if recorder is not None:
+        recorder.close()
+    if exporter is not None:
+        exporter.stop()
+    if server is not None:
+        server.stop()
+    if store is not None:
+        store.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,321 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Sources of audio data that can feed a Listener"""
+
+import sys
+import time
+import wave
+from threading import Thread, Event, current_thread
+
+import numpy as np
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+
+class AudioSource:
+    """
+    Base class for the sources of audio used by a Listener.
+
+    A source delivers consecutive blocks of 16-bit PCM as raw bytes by calling a callback with them. The callback
+    returns False to ask the source to stop. Non-live sources deliver the blocks from a thread of their own, as fast as
+    they can be produced unless realtime is set.
+    """
+    live = False  # Whether the source is driven by a clock out of our control
+
+    def __init__(self, rate=44100, channels=1, realtime=False):
+        """
+        Args:
+            rate (int): Sampling rate in Hz.
+            channels (int): Number of interleaved channels.
+            realtime (bool): Whether to pace the delivery of blocks to the sampling rate.
+        """
+        self.rate = rate
+        self.channels = channels
+        self.sample_width = 2
+        self.realtime = realtime
+        # Status of the stream, changed only by the thread delivering the blocks, without any lock. The Listener
+        # publishes it to its metrics from its own thread.
+        self.overflows = 0  # Blocks delivered after some input was lost
+        self.underflows = 0
+        self.latency = None  # Seconds from the capture of the last block to its delivery, if known
+        self._thread = None
+        self._stop_event = Event()
+
+    def list_api(self):
+        """Return the list of available apis"""
+        return []
+
+    def device_list(self, api=None):
+        """Return the list of input devices in the given api"""
+        return []
+
+    def default_device(self):
+        """Return the index of the device used when none is selected, or None if the source has no devices"""
+        return None
+
+    def describe(self):
+        """Return a short description of where the audio comes from, e.g., to store it with the measurements"""
+        return type(self).__name__
+
+    def find_device(self, name):
+        """Return the index of the input device with the given name, or None if there is none"""
+        for device in self.device_list():
+            if device['name'] == name:
+                return device['index']
+        return None
+
+    def reset(self):
+        """Enumerate the devices again, e.g., after some were plugged in or removed. The source must be stopped."""
+
+    def read(self, frames):
+        """Return the bytes of the next block of frames, or an empty bytes object if the source is exhausted"""
+        raise NotImplementedError
+
+    def run(self, callback, frames_per_buffer):
+        """Deliver the blocks to the callback in the calling thread until the source is exhausted or stopped"""
+        period = frames_per_buffer / self.rate
+        next_time = time.monotonic() + period
+        while not self._stop_event.is_set():
+            data = self.read(frames_per_buffer)
+            if not data:
+                break
+            if self.realtime:
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time += period
+            if callback(data) is False:
+                break
+
+    def start(self, callback, frames_per_buffer):
+        """Start delivering the blocks to the callback in a background thread"""
+        if self.is_active():
+            return False
+        self._stop_event.clear()
+        self._thread = Thread(target=self.run, args=(callback, frames_per_buffer), daemon=True)
+        self._thread.start()
+        return True
+
+    def is_active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def stop(self):
+        """Stop delivering blocks, waiting for the block in progress"""
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def close(self):
+        """Stop the source and free its resources"""
+        self.stop()
+
+
+class PortAudioSource(AudioSource):
+    """
+    A sound card, read using PortAudio.
+
+    Each source opens a stream of its own, delivered by PortAudio from its own thread, so several sources capture
+    from different devices at the same time without blocking one another. Multichannel devices deliver their channels
+    interleaved in each block.
+    """
+    live = True
+
+    def __init__(self, rate=44100, channels=1, data_type=None, device=None, api=None):
+        """
+        Args:
+            rate (int): Sampling rate in Hz.
+            channels (int): Number of channels captured.
+            data_type: PortAudio sample format. 16-bit integers if None.
+            device (int): Index of the input device, as in the 'index' of device_list. The default device if None.
+            api (int): Index of the host api whose devices are listed. The default one if None.
+        """
+        import pyaudio  # pacman -S portaudio && pip install pyaudio
+
+        super().__init__(rate=rate, channels=channels, realtime=True)
+        self._pyaudio = pyaudio
+        self.data_type = pyaudio.paInt16 if data_type is None else data_type
+        self.p = pyaudio.PyAudio()
+        self.selected_api = self.p.get_default_host_api_info()['index'] if api is None else api
+        self.device = device
+        self.audio_stream = None
+        self._devices = {}  # Input devices of each api, enumerated once
+
+    def list_api(self):
+        return [self.p.get_host_api_info_by_index(x) for x in range(0, self.p.get_host_api_count())]
+
+    def device_list(self, api=None):
+        if api is None:
+            api = self.selected_api
+        if api not in self._devices:
+            devices_in_api = self.p.get_host_api_info_by_index(api)['deviceCount']
+            recording_device_list = []
+            for x in range(0, devices_in_api):
+                device = self.p.get_device_info_by_host_api_device_index(api, x)
+                if device['maxInputChannels']:
+                    recording_device_list.append(device)
+            self._devices[api] = recording_device_list
+        return list(self._devices[api])
+
+    def default_device(self):
+        return self.p.get_host_api_info_by_index(self.selected_api)['defaultInputDevice']
+
+    def reset(self):
+        """
+        Enumerate the devices again, initializing PortAudio again.
+
+        PortAudio only enumerates the devices when it is first initialized in the process, so new devices are not seen
+        while other sources have streams open, although devices keeping their index can still be reopened.
+        """
+        self.stop()
+        self._devices = {}
+        self.p.terminate()
+        self.p = self._pyaudio.PyAudio()
+
+    def describe(self):
+        device = self.default_device() if self.device is None else self.device
+        try:
+            return self.p.get_device_info_by_index(device)['name']
+        except (IOError, ValueError):
+            return "device %s" % device
+
+    def start(self, callback, frames_per_buffer):
+        pyaudio = self._pyaudio
+
+        def stream_callback(in_data, frame_count, time_info, status_flags):
+            # Only plain counters here: the audio thread must not wait for the locks of the metrics
+            if status_flags & pyaudio.paInputOverflow:
+                self.overflows += 1
+            if status_flags & pyaudio.paInputUnderflow:
+                self.underflows += 1
+            # Time since the first sample was captured. Some host apis do not report the capture time.
+            adc_time = time_info.get('input_buffer_adc_time', 0)
+            self.latency = time_info['current_time'] - adc_time if adc_time > 0 else None
+            if callback(in_data) is False:
+                return None, pyaudio.paComplete
+            return None, pyaudio.paContinue
+
+        if self.audio_stream is not None:
+            return False
+        kwargs = {}
+        if self.device is not None:
+            kwargs["input_device_index"] = self.device
+        self.audio_stream = self.p.open(format=self.data_type, channels=self.channels, rate=self.rate, input=True,
+                                        frames_per_buffer=frames_per_buffer, stream_callback=stream_callback, **kwargs)
+        self.audio_stream.start_stream()
+        return True
+
+    def is_active(self):
+        try:
+            return self.audio_stream is not None and self.audio_stream.is_active()
+        except OSError:  # The device is gone
+            return False
+
+    def stop(self):
+        if self.audio_stream is not None:
+            try:
+                self.audio_stream.close()
+            except OSError:  # The device is gone
+                pass
+            self.audio_stream = None
+
+    def close(self):
+        self.stop()
+        self.p.terminate()
+
+
+class WavSource(AudioSource):
+    """A 16-bit PCM WAV file"""
+
+    def __init__(self, file_name, realtime=False, loop=False):
+        """
+        Args:
+            file_name (str): Path to the WAV file.
+            realtime (bool): Whether to pace the delivery of blocks to the sampling rate.
+            loop (bool): Whether to start over when the end of the file is reached.
+        """
+        self.file_name = file_name
+        self.loop = loop
+        self.wav = wave.open(file_name, 'rb')
+        if self.wav.getsampwidth() != 2:
+            self.wav.close()
+            raise ValueError("Only 16-bit PCM WAV files are supported")
+        super().__init__(rate=self.wav.getframerate(), channels=self.wav.getnchannels(), realtime=realtime)
+
+    def read(self, frames):
+        data = self.wav.readframes(frames)
+        if not data and self.loop and self.wav.getnframes() > 0:
+            self.wav.rewind()
+            data = self.wav.readframes(frames)
+        return data
+
+    def describe(self):
+        return self.file_name
+
+    def close(self):
+        super().close()
+        self.wav.close()
+
+
+class GeneratorSource(AudioSource):
+    """A synthetic signal computed with NumPy"""
+
+    def __init__(self, signal, rate=44100, duration=None, realtime=False):
+        """
+        Args:
+            signal (callable): Function mapping an array of times in seconds to samples in [-1, 1].
+            rate (int): Sampling rate in Hz.
+            duration (float): Seconds of signal to produce. None for an endless source.
+            realtime (bool): Whether to pace the delivery of blocks to the sampling rate.
+        """
+        super().__init__(rate=rate, channels=1, realtime=realtime)
+        self.signal = signal
+        self.total_frames = None if duration is None else int(duration * rate)
+        self.position = 0
+
+    def read(self, frames):
+        if self.total_frames is not None:
+            frames = min(frames, self.total_frames - self.position)
+            if frames <= 0:
+                return b''
+        t = (self.position + np.arange(frames)) / self.rate
+        self.position += frames
+        samples = np.clip(self.signal(t), -1.0, 1.0) * 32767
+        return samples.astype(np.int16).tobytes()
+
+
+def sine_wave(frequency, amplitude=0.5):
+    """Return a signal for a GeneratorSource with a pure tone"""
+    return lambda t: amplitude * np.sin(2 * np.pi * frequency * t)
+
+
+def white_noise(amplitude=0.5, seed=None):
+    """Return a signal for a GeneratorSource with uniform white noise"""
+    rng = np.random.RandomState(seed)
+    return lambda t: rng.uniform(-amplitude, amplitude, len(t))
+
+
+class RawSource(AudioSource):
+    """Raw 16-bit little-endian PCM read from a binary stream, the standard input by default"""
+
+    def __init__(self, stream=None, rate=44100, channels=1, realtime=False):
+        super().__init__(rate=rate, channels=channels, realtime=realtime)
+        self.stream = sys.stdin.buffer if stream is None else stream
+
+    def describe(self):
+        return "standard input" if self.stream is sys.stdin.buffer else getattr(self.stream, 'name', "stream")
+
+    def read(self, frames):
+        size = frames * self.channels * self.sample_width
+        chunks = []
+        while size > 0:
+            chunk = self.stream.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        data = b''.join(chunks)
+        # Drop an incomplete trailing frame
+        return data[:len(data) - len(data) % (self.channels * self.sample_width)]
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Spectral analysis of blocks of audio"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+
+def get_window(name, size):
+    """Return a window of the given size by its name (hann, hamming, blackman or boxcar)"""
+    if name == 'hann':
+        return np.hanning(size)
+    if name == 'hamming':
+        return np.hamming(size)
+    if name == 'blackman':
+        return np.blackman(size)
+    if name in ('boxcar', 'rectangular', None):
+        return np.ones(size)
+    raise ValueError("Unknown window: %s" % name)
+
+
+class SpectrumAnalyzer:
+    """
+    Short-time Fourier analysis of blocks of samples.
+
+    A block is split in frames of fft_size samples, separated by hop samples. Each frame is windowed and transformed,
+    and the power of the frames is averaged (Welch's method). The window, the frequency axis and the scale factors are
+    computed once, when the analyzer is created.
+
+    A block of several channels, given as an array of shape (samples, channels), is analyzed in a single call, giving a
+    spectrum per channel.
+    """
+
+    def __init__(self, rate, fft_size=4096, window='hann', hop=None, output='magnitude'):
+        """
+        Args:
+            rate (float): Sampling rate in Hz.
+            fft_size (int): Samples in each frame. Must be a power of two.
+            window (str): Name of the window applied to each frame, see get_window.
+            hop (int): Samples between the starts of consecutive frames. None for half of fft_size.
+            output (str): Scale of the result:
+
+                - 'magnitude': amplitude of the sinusoids, in the units of the samples.
+                - 'psd': power spectral density, in squared units per Hz.
+                - 'db': the amplitudes in decibels, relative to a unit amplitude.
+        """
+        if fft_size <= 0 or fft_size & (fft_size - 1):
+            raise ValueError("The FFT size must be a power of two")
+        if output not in ('magnitude', 'psd', 'db'):
+            raise ValueError("Unknown output: %s" % output)
+        self.rate = rate
+        self.fft_size = fft_size
+        self.hop = fft_size // 2 if hop is None else hop
+        self.output = output
+
+        self.window = get_window(window, fft_size)
+        self.freqs = np.fft.rfftfreq(fft_size, d=1. / rate)
+        # Scale factors for the averaged squared modulus of the transform
+        # One-sided spectra count the energy of the negative frequencies twice, except for the DC and Nyquist terms
+        one_sided = np.full(len(self.freqs), 2.0)
+        one_sided[0] = 1.0
+        one_sided[-1] = 1.0
+        self._psd_scale = one_sided / (rate * np.sum(self.window ** 2))
+        self._amplitude_scale = one_sided / np.sum(self.window)
+        self._frames = np.empty((1, fft_size))  # Reused between blocks of the same size
+
+    def frame_count(self, n):
+        """Number of frames in a block of n samples"""
+        return 1 if n <= self.fft_size else (n - self.fft_size) // self.hop + 1
+
+    def _windowed_frames(self, samples):
+        """Return the windowed frames, of shape (frames, fft_size), or (channels, frames, fft_size) for 2-D blocks"""
+        n = len(samples)
+        count = self.frame_count(n)
+        # Channels first, as a view
+        channels = samples.T if samples.ndim == 2 else samples[np.newaxis]
+        shape = (len(channels), count, self.fft_size)
+        if self._frames.shape != shape:
+            self._frames = np.empty(shape)
+        if n < self.fft_size:
+            self._frames[:, 0, :n] = channels
+            self._frames[:, 0, n:] = 0
+        else:
+            channel_stride, stride = channels.strides
+            frames = as_strided(channels, shape=shape, strides=(channel_stride, self.hop * stride, stride),
+                                writeable=False)
+            np.copyto(self._frames, frames)
+        self._frames *= self.window
+        return self._frames if samples.ndim == 2 else self._frames[0]
+
+    def power(self, samples):
+        """Return the squared modulus of the transform, averaged over the frames"""
+        transform = np.fft.rfft(self._windowed_frames(samples), axis=-1)
+        power = transform.real ** 2
+        power += transform.imag ** 2
+        return power.mean(axis=-2)
+
+    def __call__(self, samples):
+        """Return the spectrum of a block of samples, in the scale given by output"""
+        power = self.power(samples)
+        if self.output == 'psd':
+            return power * self._psd_scale
+        if self.output == 'magnitude':
+            return np.sqrt(power) * self._amplitude_scale
+        power *= self._amplitude_scale ** 2
+        return 10 * np.log10(power + 1e-20)
+
+
+class ToneAnalyzer:
+    """
+    Amplitudes of a few target frequencies, without computing the whole spectrum.
+
+    Each amplitude is the Fourier transform of the windowed block at the exact target frequency, the value the Goertzel
+    algorithm gives. Instead of running its recursion sample by sample, the windowed sines and cosines of the targets
+    are computed once for each block size, and all the targets (and channels) are evaluated with a single matrix
+    product. For a few targets this costs much less than a full FFT, and the targets need not be on any bin.
+    """
+
+    def __init__(self, rate, freqs, window='hann', output='magnitude'):
+        """
+        Args:
+            rate (float): Sampling rate in Hz.
+            freqs: Target frequencies in Hz.
+            window (str): Name of the window applied to the block, see get_window.
+            output (str): 'magnitude' for the amplitude of the sinusoids, in the units of the samples, or 'db' for
+                          the amplitudes in decibels, relative to a unit amplitude.
+        """
+        if output not in ('magnitude', 'db'):
+            raise ValueError("Unknown output: %s" % output)
+        self.rate = rate
+        self.freqs = np.asarray(freqs, dtype=float)
+        self.window_name = window
+        self.output = output
+        self._size = None  # Block size of the basis
+        self._basis = None  # Windowed cosines and sines of the targets, in rows
+        self._scale = None
+
+    def _prepare(self, n):
+        window = get_window(self.window_name, n)
+        phase = (2 * np.pi / self.rate) * np.outer(self.freqs, np.arange(n))
+        self._basis = np.vstack((np.cos(phase), np.sin(phase))) * window
+        self._scale = 2. / np.sum(window)
+        self._size = n
+
+    def __call__(self, samples):
+        """Return the amplitudes of the targets in a block, with shape (channels, targets) for 2-D blocks"""
+        if len(samples) != self._size:
+            self._prepare(len(samples))
+        projections = self._basis.dot(samples)
+        count = len(self.freqs)
+        amplitudes = np.hypot(projections[:count], projections[count:]) * self._scale
+        if amplitudes.ndim == 2:
+            amplitudes = amplitudes.T
+        if self.output == 'db':
+            return 20 * np.log10(amplitudes + 1e-10)
+        return amplitudes
+
+
+def interpolate_peak(levels, freqs):
+    """
+    Return the frequency and the level of the highest peak of a spectrum in dB, refined between its bins.
+
+    A parabola is fitted to the highest bin and its neighbours, which locates a windowed sinusoid within a small
+    fraction of a bin. The DC and Nyquist bins are not considered.
+
+    Args:
+        levels: Spectrum in dB, or spectra in the last axis of an array.
+        freqs: Equally spaced frequencies of the bins.
+
+    Returns:
+        (float, float): Frequency and level of the peak, or arrays of them for several spectra.
+
+    """
+    levels = np.asarray(levels)
+    k = np.argmax(levels[..., 1:-1], axis=-1)[..., np.newaxis] + 1
+    left, center, right = (np.take_along_axis(levels, k + i, axis=-1)[..., 0] for i in (-1, 0, 1))
+    curvature = left - 2 * center + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0.)
+    frequency = freqs[0] + (k[..., 0] + offset) * (freqs[1] - freqs[0])
+    return frequency, center - 0.25 * (left - right) * offset
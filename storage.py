@@ -0,0 +1,292 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Persistence of the measured data"""
+
+import bisect
+import csv
+import datetime
+import json
+import os
+import queue
+import time
+from threading import Thread
+
+import numpy as np
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+
+class StreakWriter:
+    """
+    Append-only writer of timestamped points.
+
+    Points are written as rows of a csv file with columns time (seconds since the epoch) and value. They are buffered
+    and written in batches, each batch being flushed to disk, so a crash loses at most the last batch. Files are
+    rotated when they exceed a size or a duration. For each batch a line with its first timestamp and its byte offset
+    is added to an index file (the csv name plus ".idx"), which read_streak uses to find a time range without parsing
+    the whole file. With background, the batches are written by a thread of their own, so write never waits for the
+    disk.
+    """
+
+    def __init__(self, prefix='data', directory='.', batch_size=50, batch_seconds=5.0, max_bytes=None,
+                 max_seconds=None, index=True, background=False):
+        """
+        Args:
+            prefix (str): Start of the names of the files. The date and time of creation is appended.
+            directory (str): Directory where the files are written.
+            batch_size (int): Number of points buffered before writing them.
+            batch_seconds (float): Maximum time a point is buffered before writing it.
+            max_bytes (int): Size after which a new file is started. None for no limit.
+            max_seconds (float): Duration after which a new file is started. None for no limit.
+            index (bool): Whether to write the index files.
+            background (bool): Whether to write the batches, rotate the files and sync them in a background thread.
+        """
+        self.prefix = prefix
+        self.directory = directory
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.index = index
+
+        self.files = []  # Names of the files written
+        self._file = None
+        self._index_file = None
+        self._writer = None
+        self._file_start = None
+        self._buffer = []
+        self._buffer_start = None
+        self._queue = None  # Batches waiting for the background thread, if any
+        self._thread = None
+        if background:
+            self._queue = queue.Queue()
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _open(self, timestamp):
+        t = datetime.datetime.fromtimestamp(timestamp).strftime("%y%m%d%H%M%S")
+        file_name = os.path.join(self.directory, '%s%s.csv' % (self.prefix, t))
+        n = 1
+        while os.path.exists(file_name):
+            file_name = os.path.join(self.directory, '%s%s_%d.csv' % (self.prefix, t, n))
+            n += 1
+        self._file = open(file_name, 'w', newline='')
+        self._writer = csv.writer(self._file, delimiter=',')
+        self._writer.writerow(["time", "value"])
+        if self.index:
+            self._index_file = open(file_name + '.idx', 'w')
+        self._file_start = timestamp
+        self.files.append(file_name)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._writer = None
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+
+    def _needs_rotation(self, timestamp):
+        if self.max_bytes is not None and self._file.tell() >= self.max_bytes:
+            return True
+        if self.max_seconds is not None and timestamp - self._file_start >= self.max_seconds:
+            return True
+        return False
+
+    def write(self, value, timestamp=None):
+        """Add a point, measured now unless a timestamp is given"""
+        if timestamp is None:
+            timestamp = time.time()
+        if not self._buffer:
+            self._buffer_start = time.monotonic()
+        self._buffer.append((timestamp, value))
+        if len(self._buffer) >= self.batch_size or time.monotonic() - self._buffer_start >= self.batch_seconds:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered points and make sure they reach the disk, in the background thread if there is one"""
+        if not self._buffer:
+            return
+        batch = self._buffer
+        self._buffer = []
+        if self._queue is not None:
+            self._queue.put(batch)
+        else:
+            self._write_batch(batch)
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            try:
+                self._write_batch(batch)
+            except OSError as e:
+                print("Error: cannot write the points: %s" % e)
+
+    def _write_batch(self, batch):
+        first_timestamp = batch[0][0]
+        if self._file is None:
+            self._open(first_timestamp)
+        elif self._needs_rotation(first_timestamp):
+            self._close_file()
+            self._open(first_timestamp)
+        self._file.flush()
+        offset = self._file.tell()
+        self._writer.writerows((repr(t), repr(float(v))) for t, v in batch)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self._index_file is not None:
+            self._index_file.write("%r,%d\n" % (first_timestamp, offset))
+            self._index_file.flush()
+
+    def close(self):
+        """Write the remaining points and close the files, waiting for the background thread if there is one"""
+        self.flush()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def write_level_summaries(file_name, summaries):
+    """
+    Write statistics of levels as a csv file.
+
+    Args:
+        file_name (str): Path to the csv file.
+        summaries: List of (name, summary) pairs, the summaries being dicts as given by LevelStatistics.summary.
+
+    """
+    columns = None
+    with open(file_name, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        for name, summary in summaries:
+            if columns is None:
+                columns = list(summary)
+                writer.writerow(["name"] + columns)
+            writer.writerow([name] + ["" if summary[c] is None else summary[c] for c in columns])
+
+
+def read_streak(file_name, start=None, end=None):
+    """
+    Read the points of a file written by a StreakWriter.
+
+    Args:
+        file_name (str): Path to the csv file.
+        start (float): Only points at this timestamp or later are returned. None for no limit.
+        end (float): Only points before this timestamp are returned. None for no limit.
+
+    Returns:
+        (np.ndarray, np.ndarray): The timestamps and the values of the points.
+
+    """
+    offset = None
+    if start is not None and os.path.exists(file_name + '.idx'):
+        with open(file_name + '.idx') as f:
+            entries = [line.split(',') for line in f if line.strip()]
+        timestamps = [float(t) for t, _ in entries]
+        i = bisect.bisect_right(timestamps, start) - 1
+        if i >= 0:
+            offset = int(entries[i][1])
+
+    times = []
+    values = []
+    with open(file_name, newline='') as f:
+        if offset is None:
+            f.readline()  # Header
+        else:
+            f.seek(offset)
+        for row in csv.reader(f):
+            if len(row) != 2:  # Last row might be incomplete after a crash
+                continue
+            try:
+                t, v = float(row[0]), float(row[1])
+            except ValueError:
+                continue
+            if start is not None and t < start:
+                continue
+            if end is not None and t >= end:
+                break
+            times.append(t)
+            values.append(v)
+    return np.array(times), np.array(values)
+
+
+def select_channel(measurement, channel):
+    """Return the measurement of one channel of a multichannel measurement. Others are returned unchanged."""
+    if np.ndim(measurement['intensity']) == 0:
+        return measurement
+    return {key: value[channel] if isinstance(value, np.ndarray) else value for key, value in measurement.items()}
+
+
+class MeasurementWriter:
+    """Writer of the measurements of blocks of audio to a text stream, as csv rows or as JSON lines"""
+    columns = ('time', 'intensity', 'A', 'C', 'Z')  # Columns in csv format
+    band_names = {1: 'octave', 3: 'third_octave'}  # Names of the band levels in JSON format
+
+    def __init__(self, stream, output_format='csv', channels=1, devices=False):
+        """
+        Args:
+            stream: Text stream where the measurements are written.
+            output_format (str): 'csv' for the columns in MeasurementWriter.columns, 'json' for an object with all the
+                                 measurements in each line.
+            channels (int): Number of channels of the measurements. In csv format, each channel is written in a row
+                            of its own, with a channel column. In JSON format, the values are lists with a value per
+                            channel.
+            devices (bool): Whether the measurements come from several devices, adding a device column in csv format.
+        """
+        if output_format not in ('csv', 'json'):
+            raise ValueError("Unknown format: %s" % output_format)
+        self.stream = stream
+        self.output_format = output_format
+        self.channels = channels
+        self._writer = None
+        if output_format == 'csv':
+            self.columns = (self.columns[:1] + (('device',) if devices else ()) +
+                            (('channel',) if channels > 1 else ()) + self.columns[1:])
+            self._writer = csv.writer(stream, delimiter=',')
+            self._writer.writerow(self.columns)
+
+    def write(self, measurement):
+        if self._writer is not None:
+            if np.ndim(measurement['intensity']) == 0:
+                self._writer.writerow([_to_text(measurement.get(c)) for c in self.columns])
+            else:
+                for channel in range(len(measurement['intensity'])):
+                    row = select_channel(measurement, channel)
+                    row['channel'] = channel
+                    self._writer.writerow([_to_text(row.get(c)) for c in self.columns])
+        else:
+            record = {}
+            for key, value in measurement.items():
+                if isinstance(value, np.ndarray) and isinstance(key, int):
+                    record[self.band_names.get(key, '1/%s_octave' % key)] = _to_json(value)
+                else:
+                    record[str(key)] = _to_json(value)
+            self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+
+def _to_text(value):
+    if value is None:
+        return ""
+    return str(value) if isinstance(value, (int, np.integer)) else repr(float(value))
+
+
+def _to_json(value):
+    """Convert a number, or an array of them, to types JSON can represent, non-finite numbers becoming null"""
+    if isinstance(value, np.ndarray):
+        return [_to_json(v) for v in value]
+    value = float(value)
+    return value if np.isfinite(value) else None
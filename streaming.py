@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Asynchronous interface to the measurements of a Listener, for asyncio applications"""
+
+import asyncio
+import concurrent.futures
+
+from levels import BandAnalyzer
+from pipeline import Pipeline, level_stages
+from spectral import SpectrumAnalyzer
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+
+class MeasurementStream:
+    """
+    Asynchronous iterator over the measurements of the audio of a Listener, used as an async context manager:
+
+        async with MeasurementStream(Listener(0.3)) as stream:
+            async for measurement in stream:
+                print(measurement['time'], measurement['A'])
+
+    The audio is analyzed in the thread of the listener and the measurements are handed to the event loop through a
+    bounded queue. When the consumer falls behind, the overflow policy decides what happens:
+
+    - 'drop_oldest': the oldest measurement waiting is discarded, so the consumer always gets the latest ones.
+    - 'drop_newest': the new measurement is discarded.
+    - 'block': the listener waits for room in the queue. With a live source the audio keeps being buffered in the
+      listener, which drops blocks if its own buffer fills up.
+
+    Discarded measurements are counted in dropped. With a non-live source the iteration ends with the source.
+    """
+
+    def __init__(self, listener, maxsize=64, overflow='drop_oldest', analyze=None, spectrum=False):
+        """
+        Args:
+            listener (Listener): The listener providing the audio. It is started when entering the context and stopped
+                                 when leaving it.
+            maxsize (int): Maximum number of measurements waiting to be consumed.
+            overflow (str): Policy when the queue is full, see OVERFLOW_POLICIES.
+            analyze (callable): Function turning a block of audio into a measurement, like a Pipeline. If None, a
+                                pipeline with the intensity and the weighted and band levels in dB relative to the
+                                full scale is used.
+            spectrum (bool): Whether to add the spectrum in dB to the default measurements.
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" % overflow)
+        if analyze is None:
+            band_analyzer = BandAnalyzer(listener.rate, reference=32768.)
+            spectrum_analyzer = SpectrumAnalyzer(listener.rate, 8192, output='db') if spectrum else None
+            analyze = Pipeline(level_stages(band_analyzer, spectrum_analyzer), channels=listener.channels)
+
+        self.listener = listener
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.analyze = analyze
+        self.dropped = 0  # Measurements discarded by the overflow policy
+
+        self._loop = None
+        self._queue = None
+        self._runner = None  # Future of the thread running a non-live source
+        self._finished = False  # Whether no more measurements will come
+        self._closed = False
+
+    async def __aenter__(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.maxsize)
+        self._finished = False
+        self._closed = False
+        if self.listener.source.live:
+            self.listener.start(self._callback)
+        else:
+            self._runner = self._loop.run_in_executor(None, self._run)
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.aclose()
+
+    async def aclose(self):
+        """Stop the listener. Measurements not yet consumed are discarded."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._runner is not None:
+            self.listener.source.stop()  # Ends the run of the listener
+            await self._runner
+            self._runner = None
+        else:
+            await self._loop.run_in_executor(None, self.listener.stop)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._finished and self._queue.empty():
+            raise StopAsyncIteration
+        measurement = await self._queue.get()
+        if measurement is None:  # Put by _finish to wake the consumer
+            raise StopAsyncIteration
+        return measurement
+
+    def _run(self):
+        """Feed a non-live source to the queue, in a thread of the executor"""
+        try:
+            self.listener.run(self._callback)
+        finally:
+            self._call_in_loop(self._finish)
+
+    def _call_in_loop(self, f, *args):
+        try:
+            self._loop.call_soon_threadsafe(f, *args)
+        except RuntimeError:  # The loop was closed
+            pass
+
+    def _finish(self):
+        self._finished = True
+        if self._queue.empty():
+            self._queue.put_nowait(None)
+
+    def _callback(self, in_data):
+        """Analyze a block and queue the measurement. It runs in the thread of the listener."""
+        if self._closed:
+            return
+        measurement = self.analyze(in_data)
+        if self.overflow == 'block':
+            future = asyncio.run_coroutine_threadsafe(self._queue.put(measurement), self._loop)
+            while True:
+                try:
+                    future.result(0.1)
+                    return
+                except concurrent.futures.TimeoutError:
+                    if self._closed:  # The consumer will not make room
+                        future.cancel()
+                        return
+        self._call_in_loop(self._put, measurement)
+
+    def _put(self, measurement):
+        """Queue a measurement applying the overflow policy. It runs in the event loop."""
+        if self._queue.full():
+            self.dropped += 1
+            self.listener.metrics.increment('stream_dropped_total')
+            if self.overflow == 'drop_newest':
+                return
+            self._queue.get_nowait()
+        self._queue.put_nowait(measurement)
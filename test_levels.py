@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Tests of the band levels, run with pytest"""
+
+import numpy as np
+import pytest
+
+from levels import BandAnalyzer
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+
+def _analyze(analyzer, samples, block):
+    """Return the last results of the analysis of the samples in blocks of the given size"""
+    results = None
+    for start in range(0, len(samples), block):
+        values = analyzer(samples[start:start + block])
+        if values is not None:
+            results = values
+    return results
+
+
+@pytest.mark.parametrize("rate", [44100, 48000])
+@pytest.mark.parametrize("fraction", [1, 3])
+def test_tone_at_band_centers(rate, fraction):
+    """A tone at the mid-band frequency of a band has its level in that band, the lowest bands included"""
+    analyzer = BandAnalyzer(rate, fft_size=4096, reference=1.)
+    t = np.arange(3 * rate) / rate
+    expected = 10 * np.log10(0.5)  # Mean square of a unit sine
+    for i, center in enumerate(analyzer.centers[fraction]):
+        analyzer.reset()
+        results = _analyze(analyzer, np.sin(2 * np.pi * center * t + 0.3), int(0.3 * rate))
+        assert results[fraction][i] == pytest.approx(expected, abs=0.2), "band of %.1f Hz" % center
+
+
+def test_noise_levels_are_finite():
+    """Every band has a level, also those narrower than a bin of the short spectrum"""
+    rate = 48000
+    analyzer = BandAnalyzer(rate, fft_size=4096, reference=1.)
+    noise = np.random.RandomState(0).normal(0, 0.1, (3 * rate, 2))
+    results = _analyze(analyzer, noise, int(0.3 * rate))
+    for fraction in analyzer.fractions:
+        assert results[fraction].shape == (2, len(analyzer.centers[fraction]))
+        assert np.all(np.isfinite(results[fraction]))
@@ -0,0 +1,999 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""Tk user interfaces of the sonometer and the frequency meter"""
+
+import datetime
+import os
+import time
+from threading import Lock, Thread
+
+import numpy as np
+import matplotlib
+
+matplotlib.use('TkAgg')
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.figure import Figure
+
+from tkinter import *
+from tkinter.ttk import *
+
+from archive import ArchivePlot, SpectrogramArchive
+from freqmeter import Spectrogram, TrendPlot
+from history import HistoryPlot, LevelHistory
+from levels import BandAnalyzer, LevelStatistics, RollingLevelStatistics
+from pipeline import BandStage, DominantStage, IntensityStage, PeakStage, Pipeline, SpectrumStage, ToneStage
+from sessions import ComparisonPlot
+from sonometer import Listener, Streak, IntensityPlot, controlled_execution
+from spectral import SpectrumAnalyzer, ToneAnalyzer
+from storage import StreakWriter, select_channel, write_level_summaries
+
+__author__ = 'Dih5'
+__version__ = "0.1.0"
+
+
+class RenderScheduler:
+    """
+    Decides when a widget is redrawn, decoupling the rate of the analysis from the rate of the display.
+
+    Other threads call notify when there is new data. The first notification wakes the Tk thread through a pipe, so
+    nothing runs while no data arrives, and a frame is rendered as soon as the frame budget allows. Everything arrived
+    in the meantime is rendered in that single frame. If a frame takes longer than the budget, the following ones are
+    delayed so that rendering takes at most max_load of the time of the Tk thread, skipping frames instead of leaving
+    the user interface unresponsive.
+
+    Where Tk cannot watch the pipe (on Windows), the notifications are polled at the frame rate, slowing down to
+    idle_period while no data arrives.
+    """
+
+    def __init__(self, widget, render, max_fps=20., max_load=0.5, idle_period=1.0, metrics=None):
+        """
+        Args:
+            widget: The Tk widget whose after method schedules the frames.
+            render (callable): Function rendering a frame. It runs in the Tk thread.
+            max_fps (float): Maximum number of frames per second.
+            max_load (float): Maximum fraction of the time spent rendering.
+            idle_period (float): Seconds between polls while no data arrives, when the pipe cannot be watched.
+            metrics (Metrics): Where the frames skipped are counted, or None.
+        """
+        self.widget = widget
+        self.render = render
+        self.max_fps = max_fps
+        self.max_load = max_load
+        self.idle_period = idle_period
+        self.metrics = metrics
+        self.skipped = 0  # Frames skipped because rendering took longer than the budget
+
+        self._notified = False  # Whether a notification is waiting for the Tk thread
+        self._next_time = 0.0  # perf_counter time before which no frame is rendered
+        self._frame_id = None
+        self._poll_id = None
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._write_fd, False)
+        try:
+            widget.tk.createfilehandler(self._read_fd, READABLE, self._on_wakeup)
+            self._watching = True
+        except (AttributeError, TclError):
+            self._watching = False
+            self._poll_id = widget.after(int(1000 / max_fps), self._poll)
+
+    def notify(self):
+        """Signal that there is new data to render. It can be called from any thread and never blocks."""
+        if self._notified:
+            return
+        self._notified = True
+        if self._watching:
+            try:
+                os.write(self._write_fd, b'x')
+            except BlockingIOError:
+                pass
+
+    def _on_wakeup(self, fd=None, mask=None):
+        # Cleared after draining the pipe: a notification arriving before this is rendered by the frame scheduled
+        # below, and one arriving after it writes again. Clearing first could drain the byte of a notification while
+        # leaving the flag set, which would silence all the following ones.
+        os.read(self._read_fd, 4096)
+        self._notified = False
+        self._schedule()
+
+    def _poll(self):
+        if self._notified:
+            self._notified = False
+            self._schedule()
+            period = 1. / self.max_fps
+        else:
+            period = self.idle_period
+        self._poll_id = self.widget.after(int(period * 1000), self._poll)
+
+    def _schedule(self):
+        """Render a frame when the budget allows, unless one is already scheduled"""
+        if self._frame_id is not None:
+            return
+        delay = max(0., self._next_time - time.perf_counter())
+        self._frame_id = self.widget.after(int(delay * 1000), self._frame)
+
+    def _frame(self):
+        self._frame_id = None
+        start = time.perf_counter()
+        self.render()
+        seconds = time.perf_counter() - start
+        budget = 1. / self.max_fps
+        period = max(budget, seconds / self.max_load)
+        self._next_time = start + period
+        if seconds > budget:
+            skipped = int(period / budget) - 1
+            self.skipped += skipped
+            if self.metrics is not None:
+                self.metrics.increment('frames_skipped_total', skipped)
+
+    def close(self):
+        for after_id in (self._frame_id, self._poll_id):
+            if after_id is not None:
+                self.widget.after_cancel(after_id)
+        self._frame_id = self._poll_id = None
+        if self._watching:
+            self.widget.tk.deletefilehandler(self._read_fd)
+            self._watching = False
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+
+class TkListener(Frame):
+    """
+    A window plotting the audio of a Listener.
+
+    Each window is processed by data_f in the thread of the listener, usually a Pipeline, and its results are plotted
+    by plot_f in the Tk thread, so the plot is just one more sink of the measurements. Frames are drawn by a
+    RenderScheduler, at most max_fps times per second and only when there is new data.
+    """
+    metrics_period = 1.0  # Seconds between updates of the metrics overlay
+
+    def __init__(self, plot_f, data_f=lambda x: x, interval=0.3, master=None, title="TkListener", source=None,
+                 show_metrics=False, max_fps=20.):
+        super().__init__(master=master)
+        self.master.title(title)
+        self.pack()
+        self.figure = Figure(figsize=(5, 4), dpi=100)
+        self.active_subplot = self.figure.add_subplot(111)
+        self.plot_f = plot_f
+        self.data_f = data_f
+        self.data = []  # (capture time, processed data) of the windows waiting to be plotted
+        self.lock = Lock()
+
+        # Create a tk.DrawingArea
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self)
+        self.canvas.draw()
+        self.canvas.get_tk_widget().pack(side=TOP, fill=BOTH, expand=1)
+
+        self.listener = Listener(interval, source=source)
+        self.scheduler = RenderScheduler(self, self.update_plot, max_fps, metrics=self.listener.metrics)
+        self.listener.start(self.callback)
+
+        # Metrics overlay, toggled with F2
+        self.varMetrics = StringVar()
+        self.lblMetrics = Label(master=self, textvariable=self.varMetrics, justify=LEFT, font="TkFixedFont")
+        self.show_metrics = False
+        self.metrics_id = None  # Periodic update of the overlay, only while shown
+        if show_metrics:
+            self.toggle_metrics()
+        self.master.bind("<F2>", self.toggle_metrics)
+
+    def toggle_metrics(self, event=None):
+        self.show_metrics = not self.show_metrics
+        if self.show_metrics:
+            self.lblMetrics.pack(side=TOP, fill=X, after=self.canvas.get_tk_widget())
+            self.update_metrics()
+        else:
+            self.lblMetrics.pack_forget()
+            if self.metrics_id is not None:
+                self.after_cancel(self.metrics_id)
+                self.metrics_id = None
+
+    def update_metrics(self):
+        self.varMetrics.set(self.listener.metrics.summary())
+        self.metrics_id = self.after(int(self.metrics_period * 1000), self.update_metrics)
+
+    def destroy(self):
+        self.scheduler.close()
+        if self.metrics_id is not None:
+            self.after_cancel(self.metrics_id)
+            self.metrics_id = None
+        super().destroy()
+
+    def callback(self, in_data):
+        new_data = self.data_f(in_data)
+        with self.lock:
+            self.data.append((self.listener.window_time, new_data))
+        self.scheduler.notify()
+
+    def plot_data(self, data):
+        """Add the processed data of the windows arrived since the last frame to the plot"""
+        for new_data in data:
+            self.plot_f(new_data, self.active_subplot)
+
+    def update_plot(self):
+        """Render a frame with all the data arrived since the last one. It is called by the scheduler."""
+        with self.lock:
+            data = self.data
+            self.data = []
+        if not data:
+            return
+        metrics = self.listener.metrics
+        metrics.set('pending_points', len(data))
+        self.plot_data([new_data for _, new_data in data])
+        start = time.perf_counter()
+        self.draw()
+        end = time.perf_counter()
+        metrics.observe('render_seconds', end - start)
+        # From the capture of the oldest window in the frame
+        metrics.observe('audio_to_pixel_seconds', end - data[0][0])
+        metrics.increment('frames_total')
+
+    def draw(self):
+        """Draw the plot once all the new data has been processed"""
+        self.canvas.draw()
+
+
+# Tooltip for tk (taken from https://github.com/Dih5/xpecgen)
+class CreateToolTip(object):
+    """
+    A tooltip for a given widget.
+    """
+
+    # Based on the content from this post:
+    # http://stackoverflow.com/questions/3221956/what-is-the-simplest-way-to-make-tooltips-in-tkinter
+
+    def __init__(self, widget, text, color="#ffe14c"):
+        """
+        Create a tooltip for an existent widget.
+        Args:
+            widget: The widget the tooltip is applied to.
+            text (str): The text of the tooltip.
+            color: The color of the tooltip.
+        """
+        self.waittime = 500  # miliseconds
+        self.wraplength = 180  # pixels
+        self.widget = widget
+        self.text = text
+        self.color = color
+        self.widget.bind("<Enter>", self.enter)
+        self.widget.bind("<Leave>", self.leave)
+        self.widget.bind("<ButtonPress>", self.leave)
+        self.id = None
+        self.tw = None
+
+    def enter(self, event=None):
+        self.schedule()
+
+    def leave(self, event=None):
+        self.unschedule()
+        self.hidetip()
+
+    def schedule(self):
+        self.unschedule()
+        self.id = self.widget.after(self.waittime, self.showtip)
+
+    def unschedule(self):
+        id = self.id
+        self.id = None
+        if id:
+            self.widget.after_cancel(id)
+
+    def showtip(self, event=None):
+        x, y, cx, cy = self.widget.bbox("insert")
+        x += self.widget.winfo_rootx() + 25
+        y += self.widget.winfo_rooty() + 20
+        # creates a toplevel window
+        self.tw = Toplevel(self.widget)
+        # Leaves only the label and removes the app window
+        self.tw.wm_overrideredirect(True)
+        self.tw.wm_geometry("+%d+%d" % (x, y))
+        label = Label(self.tw, text=self.text, justify='left',
+                      background=self.color, relief='solid', borderwidth=1,
+                      wraplength=self.wraplength)
+        label.pack(ipadx=1)
+
+    def hidetip(self):
+        tw = self.tw
+        self.tw = None
+        if tw:
+            tw.destroy()
+
+
+class HistoryWindow(Toplevel):
+    """A window with the history of the levels, which can be zoomed with the mouse wheel and panned by dragging"""
+    spans = [("1 min", 60), ("10 min", 600), ("1 h", 3600), ("6 h", 6 * 3600), ("24 h", 86400), ("7 d", 7 * 86400)]
+
+    def __init__(self, master, history, title="History", ylabel=None):
+        super().__init__(master=master)
+        self.title(title)
+        self.figure = Figure(figsize=(7, 3), dpi=100)
+        self.active_subplot = self.figure.add_subplot(111)
+        if ylabel is not None:
+            self.active_subplot.set_ylabel(ylabel)
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self)
+        self.canvas.get_tk_widget().pack(side=TOP, fill=BOTH, expand=1)
+        self.history_plot = HistoryPlot(self.active_subplot, self.canvas, history)
+
+        self.varStatus = StringVar()
+        self.lblStatus = Label(master=self, textvariable=self.varStatus)
+        self.lblStatus.pack(side=BOTTOM)
+
+        self.frmSpans = Frame(master=self)
+        self.frmSpans.pack(side=BOTTOM)
+        for text, span in self.spans:
+            Button(master=self.frmSpans, text=text, command=lambda span=span: self.set_span(span)).pack(side=LEFT)
+        self.buttonLive = Button(master=self.frmSpans, text='Live', command=self.follow)
+        self.buttonLive.pack(side=LEFT)
+        self.ttpLive = CreateToolTip(self.buttonLive, "Follow the last measurements again after panning.")
+
+        self.after_id = None
+        self.update_history()
+
+    def set_span(self, span):
+        self.history_plot.set_span(span)
+
+    def follow(self):
+        self.history_plot.follow()
+
+    def update_history(self):
+        """Redraw while following the last values. Zooming and panning redraw by themselves."""
+        if self.history_plot.end is None and not self.history_plot.dragging:
+            self.history_plot.draw()
+        resolution = self.history_plot.resolution
+        self.varStatus.set("%s | %s" % ("Live" if self.history_plot.end is None else "Paused",
+                                        "all points" if resolution is None else "%g s per point" % resolution))
+        self.after_id = self.after(1000, self.update_history)
+
+    def destroy(self):
+        if self.after_id is not None:
+            self.after_cancel(self.after_id)
+            self.after_id = None
+        super().destroy()
+
+
+class ComparisonWindow(Toplevel):
+    """A window comparing the A-weighted levels of the last streaks of a SessionStore, the newest one in red"""
+    counts = (10, 100, 500)  # Numbers of streaks that can be shown
+
+    def __init__(self, master, store, count=100, title="Streak comparison"):
+        super().__init__(master=master)
+        self.title(title)
+        self.store = store
+        self.count = count
+        self.figure = Figure(figsize=(7, 3), dpi=100)
+        self.active_subplot = self.figure.add_subplot(111)
+        self.active_subplot.set_ylabel("LA (dBFS)")
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self)
+        self.canvas.get_tk_widget().pack(side=TOP, fill=BOTH, expand=1)
+        self.comparison_plot = ComparisonPlot(self.active_subplot, self.canvas)
+
+        self.varStatus = StringVar()
+        self.lblStatus = Label(master=self, textvariable=self.varStatus)
+        self.lblStatus.pack(side=BOTTOM)
+
+        self.frmCounts = Frame(master=self)
+        self.frmCounts.pack(side=BOTTOM)
+        for n in self.counts:
+            Button(master=self.frmCounts, text="Last %d" % n, command=lambda n=n: self.show(n)).pack(side=LEFT)
+        self.buttonRefresh = Button(master=self.frmCounts, text='Refresh', command=self.show)
+        self.buttonRefresh.pack(side=LEFT)
+        self.ttpRefresh = CreateToolTip(self.buttonRefresh, "Add the streaks recorded since the window was opened.")
+
+        self.show()
+
+    def show(self, count=None):
+        """Read and draw the last count streaks, the same number as before if not given"""
+        if count is not None:
+            self.count = count
+        start = time.perf_counter()
+        self.store.flush()
+        streaks = self.store.streaks(last=self.count)
+        self.comparison_plot.set_streaks(self.store.streak_measurements(streaks, ('time', 'A')))
+        status = "%d streaks in %.0f ms" % (len(streaks), 1000 * (time.perf_counter() - start))
+        levels = [s['laeq'] for s in streaks if s['laeq'] is not None]
+        if streaks and streaks[-1]['laeq'] is not None:
+            status += " | LAeq of the newest %.1f dBFS" % streaks[-1]['laeq']
+            if len(levels) > 1:
+                status += ", median of the others %.1f dBFS" % np.median(levels[:-1])
+        self.varStatus.set(status)
+
+
+class ArchiveWindow(Toplevel):
+    """
+    A window scrolling through a spectrogram archive, which can be much longer than the history of the spectrogram.
+
+    Only the spectra of the span shown are read from the file, so any position is drawn at once. While following the
+    end, the spectra appended to the file are shown as they arrive.
+    """
+    spans = [("1 min", 60), ("10 min", 600), ("1 h", 3600), ("6 h", 6 * 3600), ("24 h", 86400), ("7 d", 7 * 86400)]
+    refresh_period = 2.0  # Seconds between checks of the spectra appended while following the end
+
+    def __init__(self, master, archive, span=600, title="Spectrogram archive"):
+        super().__init__(master=master)
+        self.title(title)
+        self.archive = archive
+        self.span = span
+        self.end = None  # Timestamp of the end of the span shown, None to follow the last spectra
+        self.figure = Figure(figsize=(7, 4), dpi=100)
+        self.active_subplot = self.figure.add_subplot(111)
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self)
+        self.canvas.get_tk_widget().pack(side=TOP, fill=BOTH, expand=1)
+        self.archive_plot = ArchivePlot(self.active_subplot, self.canvas, archive)
+
+        self.varStatus = StringVar()
+        self.lblStatus = Label(master=self, textvariable=self.varStatus)
+        self.lblStatus.pack(side=BOTTOM)
+
+        self.frmSpans = Frame(master=self)
+        self.frmSpans.pack(side=BOTTOM)
+        for text, span in self.spans:
+            Button(master=self.frmSpans, text=text, command=lambda span=span: self.set_span(span)).pack(side=LEFT)
+        self.buttonLive = Button(master=self.frmSpans, text='Live', command=self.follow)
+        self.buttonLive.pack(side=LEFT)
+        self.ttpLive = CreateToolTip(self.buttonLive, "Follow the last spectra again after scrolling.")
+
+        self.sldPosition = Scale(master=self, orient=HORIZONTAL, length=600, command=self.scroll)
+        self.sldPosition.pack(side=BOTTOM)
+        self.ttpPosition = CreateToolTip(self.sldPosition, "End of the span shown, from the first spectrum of the "
+                                                           "archive to the last one.")
+
+        self.draw_id = None  # Pending redraw, so moving the scale draws only the last position
+        self.after_id = None
+        self.update_archive()
+
+    def set_span(self, span):
+        self.span = span
+        self.request_draw()
+
+    def follow(self):
+        self.end = None
+        self.request_draw()
+
+    def scroll(self, value):
+        if len(self.archive):
+            self.end = float(value)
+            self.request_draw()
+
+    def request_draw(self):
+        if self.draw_id is None:
+            self.draw_id = self.after_idle(self.draw)
+
+    def draw(self):
+        self.draw_id = None
+        if not len(self.archive):
+            self.varStatus.set("The archive is empty")
+            return
+        end = self.archive.end if self.end is None else self.end
+        start = time.perf_counter()
+        self.archive_plot.show(end, self.span)
+        self.varStatus.set("%s | %d spectra from %s to %s | drawn in %.0f ms" %
+                           ("Live" if self.end is None else "Paused", len(self.archive),
+                            datetime.datetime.fromtimestamp(self.archive.start).strftime("%Y-%m-%d %H:%M"),
+                            datetime.datetime.fromtimestamp(self.archive.end).strftime("%Y-%m-%d %H:%M"),
+                            1000 * (time.perf_counter() - start)))
+
+    def update_archive(self):
+        """Map the spectra appended to the file, and show them while following the end"""
+        rows = len(self.archive)
+        if self.archive.refresh() != rows or rows == 0:
+            if len(self.archive):
+                self.sldPosition.configure(from_=self.archive.start, to=self.archive.end)
+                if self.end is None:
+                    self.sldPosition.set(self.archive.end)
+                    self.end = None  # Setting the scale scrolls to its value
+            if self.end is None:
+                self.request_draw()
+        self.after_id = self.after(int(self.refresh_period * 1000), self.update_archive)
+
+    def destroy(self):
+        for after_id in (self.after_id, self.draw_id):
+            if after_id is not None:
+                self.after_cancel(after_id)
+        self.after_id = self.draw_id = None
+        super().destroy()
+
+
+class IntensityListener(TkListener):
+    def __init__(self, master=None, points_max=80, interval=0.3, source=None, show_metrics=False, channel=0,
+                 max_fps=20., store=None):
+        # Levels relative to the full scale of 16-bit samples
+        self.band_analyzer = BandAnalyzer(source.rate if source is not None else 44100, reference=32768.)
+        self.channel = channel  # Channel plotted, if the source has several
+        self.levels = None  # Last weighted and band levels of the plotted channel
+        self.channel_levels = None  # Last A-weighted levels of all the channels, if the source has several
+        self.session_levels = LevelStatistics()  # Statistics of the A-weighted levels since the start
+        self.rolling_levels = [("1 min", RollingLevelStatistics(60)), ("15 min", RollingLevelStatistics(15 * 60)),
+                               ("1 h", RollingLevelStatistics(60 * 60))]
+        self.history = LevelHistory(decibels=True)  # All the A-weighted levels measured
+        self.history_window = None
+        # All the channels are analyzed at once. Sinks can be added to publish or record the measurements.
+        self.pipeline = Pipeline([IntensityStage(), PeakStage(), BandStage(self.band_analyzer)],
+                                 channels=source.channels if source is not None else 1)
+
+        super().__init__(plot_f=self.intensity_plot, data_f=self.pipeline, interval=interval, master=master,
+                         title="Sonometer", source=source, show_metrics=show_metrics, max_fps=max_fps)
+        self.points_max = points_max  # points kept in the plot
+
+        self.recording = False  # Whether a streak is being recorded
+
+        self.streaks = []  # Saved streaks of data
+        self.streak_writer = None  # Writer of the streak being recorded, if it is being saved
+
+        # The session, its streaks and its measurements are also kept in the SessionStore, if given
+        self.store = store
+        self.session = None
+        self.streak_id = None  # Id in the store of the streak being recorded
+        self.comparison_window = None
+        if store is not None:
+            self.session = store.start_session(self.listener.source.describe(), self.listener.rate,
+                                               self.listener.channels, self.listener.interval, self.listener.hop)
+            # Stored from the thread of the listener, so the user interface never waits for the database
+            self.pipeline.add_sink(self.store_measurement)
+
+        self.points_plot = IntensityPlot(self.active_subplot, self.canvas, self.points_max)
+
+        # Add specific controls
+
+        self.varStatus = StringVar()
+        self.varStatus.set("Sonometer started")
+        self.lblStatus = Label(master=self, textvariable=self.varStatus)
+        self.lblStatus.pack(side=BOTTOM)
+
+        self.varLevels = StringVar()
+        self.lblLevels = Label(master=self, textvariable=self.varLevels)
+        self.lblLevels.pack(side=BOTTOM)
+
+        self.frmOperations = Frame(master=self)
+        self.frmOperations.pack(side=BOTTOM)
+
+        self.buttonClearPoints = Button(master=self.frmOperations, text='Clear points', command=self.clear_points)
+        self.buttonClearPoints.pack(side=LEFT)
+
+        self.buttonClearStreaks = Button(master=self.frmOperations, text='Clear streaks', command=self.clear_streaks)
+        self.buttonClearStreaks.pack(side=LEFT)
+
+        self.buttonStartStreak = Button(master=self.frmOperations, text='Start streak', command=self.start_streak)
+        self.buttonStartStreak.pack(side=LEFT)
+
+        self.buttonStopStreak = Button(master=self.frmOperations, text='Stop streak', command=self.stop_streak,
+                                       state=DISABLED)
+        self.buttonStopStreak.pack(side=LEFT)
+
+        self.buttonCapture = Button(master=self.frmOperations, text='Plot capture', command=self.plot_capture)
+        self.buttonCapture.pack(side=LEFT)
+        self.ttpCapture = CreateToolTip(self.buttonCapture,
+                                        "Save the plot in pdf format.")
+
+        self.buttonExportLevels = Button(master=self.frmOperations, text='Export levels', command=self.export_levels)
+        self.buttonExportLevels.pack(side=LEFT)
+
+        self.buttonHistory = Button(master=self.frmOperations, text='History', command=self.show_history)
+        self.buttonHistory.pack(side=LEFT)
+        self.ttpHistory = CreateToolTip(self.buttonHistory,
+                                        "Show all the A-weighted levels measured since the start. Use the mouse wheel "
+                                        "to zoom and drag to pan.")
+        self.ttpExportLevels = CreateToolTip(self.buttonExportLevels,
+                                             "Save the statistics of the A-weighted levels of the session, the last "
+                                             "minutes and the streaks in csv format.")
+
+        if store is not None:
+            self.buttonCompare = Button(master=self.frmOperations, text='Compare streaks',
+                                        command=self.compare_streaks)
+            self.buttonCompare.pack(side=LEFT)
+            self.ttpCompare = CreateToolTip(self.buttonCompare,
+                                            "Plot the A-weighted levels of the last streaks in the store, also those "
+                                            "of previous sessions.")
+
+        self.frmConfig = Frame(master=self)
+        self.frmConfig.pack(side=BOTTOM)
+
+        self.frmInterval = LabelFrame(master=self.frmConfig, text="Sampling per point (s)")
+        self.frmInterval.pack(side=LEFT)
+        self.varInterval = DoubleVar()
+        self.varInterval.set(self.listener.interval)
+        self.txtInterval = Entry(master=self.frmInterval, textvariable=self.varInterval)
+        self.buttonInterval = Button(master=self.frmInterval, text='Update', command=self.change_interval)
+        self.txtInterval.pack(side=TOP)
+        self.buttonInterval.pack(side=TOP)
+        self.ttpInterval = CreateToolTip(self.buttonInterval,
+                                         "Change the sampling time per point and the step between points to the "
+                                         "numbers given.\nMust be > 0.1 s.")
+
+        self.frmHop = LabelFrame(master=self.frmConfig, text="Step between points (s)")
+        self.frmHop.pack(side=LEFT)
+        self.varHop = DoubleVar()
+        self.varHop.set(self.listener.hop or 0)
+        self.txtHop = Entry(master=self.frmHop, textvariable=self.varHop)
+        self.txtHop.pack(side=TOP)
+        self.ttpHop = CreateToolTip(self.txtHop,
+                                    "Time between the starts of consecutive points. If smaller than the sampling, "
+                                    "points overlap. 0 for no overlap.")
+
+        self.frmStreakLen = LabelFrame(master=self.frmConfig, text="Streak max points")
+        self.frmStreakLen.pack(side=LEFT)
+        self.varStreakLen = IntVar()
+        self.varStreakLen.set(0)
+        self.txtStreakLen = Entry(master=self.frmStreakLen, textvariable=self.varStreakLen)
+        self.txtStreakLen.pack(side=TOP)
+        self.ttpStreakLen = CreateToolTip(self.txtStreakLen,
+                                          "Stop the streak when this number of points is reached. 0 for no automatic stop.")
+
+        self.varStreakToCsv = BooleanVar()
+        self.varStreakToCsv.set(True)
+        self.chkStreakToCsv = Checkbutton(master=self.frmStreakLen, text="Save streaks", variable=self.varStreakToCsv)
+        self.chkStreakToCsv.pack(side=BOTTOM)
+        self.ttpStreakToCsv = CreateToolTip(self.chkStreakToCsv,
+                                            "If on, the streak will be saved as a csv while it is recorded.")
+
+    def change_interval(self):
+        new_interval = self.varInterval.get()
+        new_hop = self.varHop.get() or None
+        if new_interval == self.listener.interval and new_hop == self.listener.hop:
+            self.varStatus.set("Selected interval has not changed")
+            return False
+        if new_interval < 0.1:
+            self.varStatus.set("Too small sampling ignored (min. 0.1).")
+            self.varInterval.set(0.1)
+            return False
+        if new_hop is not None and new_hop < 0.1:
+            self.varStatus.set("Too small step ignored (min. 0.1).")
+            self.varHop.set(0)
+            return False
+        if new_hop is not None and new_hop > new_interval:
+            self.varStatus.set("The step can not be greater than the sampling.")
+            return False
+        # The device keeps running, so there is no gap in the audio
+        self.listener.set_interval(new_interval, new_hop)
+        if new_hop is None:
+            self.varStatus.set("Sampling interval set to %g" % new_interval)
+        else:
+            self.varStatus.set("Sampling interval set to %g with a step of %g" % (new_interval, new_hop))
+        return True
+
+    def clear_points(self):
+        with controlled_execution():
+            self.points_plot.clear()
+
+    def clear_streaks(self):
+        with controlled_execution():
+            self.streaks = []
+            self.points_plot.invalidate_streaks()
+
+    def start_streak(self):
+        with controlled_execution():
+            self.streaks.append(Streak(self.points_max, keep_data=False))
+            self.points_plot.invalidate_streaks()
+            if self.varStreakToCsv.get():
+                # The points are synced to disk by a thread of the writer, not by the user interface
+                self.streak_writer = StreakWriter(prefix='data', background=True)
+            if self.store is not None:
+                self.streak_id = self.store.start_streak(self.session, self.channel, self.listener.interval,
+                                                         self.listener.hop)
+            self.recording = True
+            self.buttonStopStreak["state"] = "normal"
+            self.buttonStartStreak["state"] = "disabled"
+            self.buttonClearPoints["state"] = "disabled"
+            self.buttonClearStreaks["state"] = "disabled"
+
+    def stop_streak(self):
+        with controlled_execution():
+            self.recording = False
+            self.buttonStartStreak["state"] = "normal"
+            self.buttonStopStreak["state"] = "disabled"
+            self.buttonClearPoints["state"] = "enabled"
+            self.buttonClearStreaks["state"] = "enabled"
+            if self.streak_writer is not None:
+                self.streak_writer.close()
+                if self.streak_writer.files:
+                    self.varStatus.set("Data saved as %s" % ", ".join(self.streak_writer.files))
+                self.streak_writer = None
+            if self.streak_id is not None:
+                self.store.end_streak(self.streak_id, self.streaks[-1])
+                self.streak_id = None
+            if self.streaks and self.streaks[-1].levels.count:
+                summary = self.streaks[-1].levels.summary()
+                self.varStatus.set(self.varStatus.get() + " | Streak LAeq %.1f L10 %.1f L50 %.1f L90 %.1f" %
+                                   (summary['Leq'], summary['L10'], summary['L50'], summary['L90']))
+
+    def level_summaries(self):
+        """Return a list of (name, summary) with the statistics of the A-weighted levels"""
+        summaries = [("session", self.session_levels.summary())]
+        for name, statistics in self.rolling_levels:
+            statistics.expire()
+            summaries.append(("last " + name, statistics.summary()))
+        for i, s in enumerate(self.streaks):
+            summaries.append(("streak %d" % (i + 1), s.levels.summary()))
+        return summaries
+
+    def export_levels(self):
+        with controlled_execution():
+            t = datetime.datetime.now().strftime("%y%m%d%H%M%S")
+            file_name = "levels%s.csv" % t
+            write_level_summaries(file_name, self.level_summaries())
+            self.varStatus.set("Levels saved as " + file_name)
+
+    def show_history(self):
+        if self.history_window is not None and self.history_window.winfo_exists():
+            self.history_window.lift()
+            return
+        self.history_window = HistoryWindow(self.master, self.history, title="Level history", ylabel="LA (dBFS)")
+
+    def compare_streaks(self):
+        if self.comparison_window is not None and self.comparison_window.winfo_exists():
+            self.comparison_window.show()
+            self.comparison_window.lift()
+            return
+        self.comparison_window = ComparisonWindow(self.master, self.store)
+
+    def plot_capture(self):
+        with controlled_execution():
+            t = datetime.datetime.now().strftime("%y%m%d%H%M%S")  # Sorted chronologically
+            file_name = "sound" + t + ".pdf"
+            self.points_plot.savefig(self.figure, file_name)
+            self.varStatus.set("Plot saved as " + file_name)
+
+    def store_measurement(self, measurement):
+        """Add a measurement to the store, with the streak being recorded. Run in the thread of the listener."""
+        self.store.write(measurement, self.session, self.streak_id)
+
+    def intensity_plot(self, measurement, plot):
+        """Add a new point of the plotted channel. The plot is drawn once per frame in draw."""
+        if np.ndim(measurement['intensity']) and 'A' in measurement:
+            self.channel_levels = measurement['A']
+        measurement = select_channel(measurement, self.channel)
+        value = measurement['intensity']
+        position = self.points_plot.add(value)
+        if 'A' in measurement:
+            self.levels = measurement
+            self.session_levels.add(measurement['A'])
+            self.history.add(measurement['A'], measurement['time'])
+            for _, statistics in self.rolling_levels:
+                statistics.add(measurement['A'], measurement['time'])
+        if self.recording:
+            if not self.streaks:
+                print("Error: tried to record with no streak object")
+            else:
+                if len(self.streaks[-1]) == 0:
+                    self.streaks[-1].add_first(position, value)
+                else:
+                    self.streaks[-1].add(value)
+                if 'A' in measurement:
+                    self.streaks[-1].add_level(measurement['A'])
+                if self.streak_writer is not None:
+                    self.streak_writer.write(value, measurement['time'])
+                if 0 < self.varStreakLen.get() < len(self.streaks[-1]):
+                    self.stop_streak()
+
+    def destroy(self):
+        if self.store is not None:
+            if self.streak_id is not None:
+                self.store.end_streak(self.streak_id, self.streaks[-1])
+                self.streak_id = None
+            self.store.end_session(self.session)
+        super().destroy()
+
+    def draw(self):
+        if self.levels is not None:
+            lines = ["LA %.1f dBFS   LC %.1f dBFS   LZ %.1f dBFS   Peak %.1f dBFS" %
+                     (self.levels['A'], self.levels['C'], self.levels['Z'], self.levels['peak'])]
+            channel_levels = self.channel_levels
+            if channel_levels is not None:
+                lines.append("LA by channel: " + "  ".join("%d: %.1f" % (i, level)
+                                                           for i, level in enumerate(channel_levels)))
+            for name, statistics in self.rolling_levels:
+                summary = statistics.summary()
+                if summary['count']:
+                    lines.append("%s: LAeq %.1f  L10 %.1f  L50 %.1f  L90 %.1f  Lmax %.1f  Lmin %.1f" %
+                                 (name, summary['Leq'], summary['L10'], summary['L50'], summary['L90'],
+                                  summary['Lmax'], summary['Lmin']))
+            self.varLevels.set("\n".join(lines))
+        self.points_plot.draw(self.streaks)
+
+
+class FrequencyListener(TkListener):
+    devices_period = 1.0  # Seconds between checks of the devices found by the registry
+
+    def __init__(self, master=None, interval=0.3, fft_size=8192, history_max=200, source=None, show_metrics=False,
+                 channel=0, max_fps=20., registry=None):
+        # The window and the frequency axis are computed once
+        self.analyzer = SpectrumAnalyzer(source.rate if source is not None else 44100, fft_size, window='hann',
+                                         output='db')
+        self.channel = channel  # Channel analyzed, if the source has several
+        self.pipeline = Pipeline([SpectrumStage(self.analyzer, channel)],
+                                 channels=source.channels if source is not None else 1)
+        super().__init__(plot_f=self.spectrum_plot, data_f=self.pipeline, interval=interval, master=master,
+                         title="Sound frequency listener", source=source, show_metrics=show_metrics,
+                         max_fps=max_fps)
+        self.spectrogram = Spectrogram(self.active_subplot, self.analyzer.freqs, history_max, interval)
+        self.shown_points = None  # Bins currently shown, to change the limits only when the scale is moved
+
+        self.frmOperations = Frame(master=self)
+        self.frmOperations.pack(side=BOTTOM)
+
+        self.buttonClearPoints = Button(master=self.frmOperations, text='Clear data', command=self.clear_data)
+        self.buttonClearPoints.pack(side=LEFT)
+
+        # The devices are enumerated by the registry in the background, so the window does not wait for them. Without
+        # a registry, those enumerated by the source are shown.
+        self.registry = registry
+        self.devices = []  # Input devices in the combobox
+        self.devices_version = None  # Version of the registry shown
+        self.devices_id = None
+        self.switch_thread = None  # Thread reopening the stream on the device selected, while it runs
+        self.switch_id = None
+        if registry is not None or self.listener.source.live:
+            self.cmbDevice = Combobox(master=self.frmOperations, state="readonly", width=40,
+                                      values=["Searching devices..."])
+            self.cmbDevice.current(0)
+            self.cmbDevice.bind("<<ComboboxSelected>>", self.change_device)
+            self.cmbDevice.pack(side=LEFT)
+            self.ttpDevice = CreateToolTip(self.cmbDevice, "Input device analyzed.")
+            if registry is not None:
+                self.update_devices()
+            else:
+                self.devices = self.listener.device_list()
+                self.cmbDevice["values"] = [device['name'] for device in self.devices]
+                self._show_device()
+
+        self.recorder = None  # SpectrogramRecorder of the spectra, if they are archived
+        self.archive_window = None
+
+        # in rfft n input points produce n/2+1 complex points
+        self.sldScale = Scale(master=self, to=fft_size / 2 + 1, orient=HORIZONTAL, length=600)
+        self.sldScale.set(600)
+        self.sldScale.pack(side=BOTTOM)
+
+    def add_recorder(self, recorder):
+        """Archive the spectra with a SpectrogramRecorder, which can be browsed with a new button"""
+        self.recorder = recorder
+        self.pipeline.add_sink(recorder)
+        self.buttonArchive = Button(master=self.frmOperations, text='Archive', command=self.show_archive)
+        self.buttonArchive.pack(side=LEFT)
+        self.ttpArchive = CreateToolTip(self.buttonArchive, "Browse all the spectra archived in %s. They are written "
+                                                            "in chunks, so the last ones appear with a delay."
+                                        % self.recorder.file_name)
+
+    def show_archive(self):
+        if self.archive_window is not None and self.archive_window.winfo_exists():
+            self.archive_window.lift()
+            return
+        self.archive_window = ArchiveWindow(self.master, SpectrogramArchive(self.recorder.file_name))
+
+    def update_devices(self):
+        """Show the devices found by the registry when they change"""
+        if self.registry.version != self.devices_version:
+            self.devices_version = self.registry.version
+            self.devices = self.registry.devices or []
+            self.cmbDevice["values"] = [device['name'] for device in self.devices]
+            self._show_device()
+        self.devices_id = self.after(int(self.devices_period * 1000), self.update_devices)
+
+    def _show_device(self):
+        """Select the device in use in the combobox"""
+        names = [d['name'] for d in self.devices]
+        name = self.listener.source.describe()
+        if name in names:
+            self.cmbDevice.current(names.index(name))
+
+    def change_device(self, event=None):
+        """
+        Capture from the device selected in the combobox.
+
+        Reopening the stream initializes PortAudio again, which can take a while, so it is done in another thread and
+        the combobox is disabled until it finishes. Devices are reopened by name, as their indexes in the registry,
+        which enumerates them in another process, might not be those of the source.
+        """
+        name = self.devices[self.cmbDevice.current()]['name']
+        previous = self.listener.source.describe()
+        if name == previous or self.switch_thread is not None:
+            return
+        self.cmbDevice.state(['disabled'])
+        self.switch_thread = Thread(target=self._switch_device, args=(name, previous), daemon=True)
+        self.switch_thread.start()
+        self.switch_id = self.after(100, self._wait_switch)
+
+    def _switch_device(self, name, previous):
+        """Reopen the stream on a device, or on the previous one if it fails. Run in a thread of its own."""
+        try:
+            if self.listener.reopen(name):
+                return
+            print("Error: %s is not available" % name)
+        except OSError as e:  # The device does not support the format
+            print("Error: cannot capture from %s: %s" % (name, e))
+        try:
+            self.listener.reopen(previous)
+        except OSError as e:
+            print("Error: cannot capture from %s again: %s" % (previous, e))
+
+    def _wait_switch(self):
+        """Enable the combobox again, showing the device in use, when the stream has been reopened"""
+        if self.switch_thread.is_alive():
+            self.switch_id = self.after(100, self._wait_switch)
+            return
+        self.switch_thread = None
+        self.switch_id = None
+        self.cmbDevice.state(['!disabled'])
+        self._show_device()
+
+    def destroy(self):
+        if self.devices_id is not None:
+            self.after_cancel(self.devices_id)
+            self.devices_id = None
+        if self.switch_id is not None:
+            self.after_cancel(self.switch_id)
+            self.switch_id = None
+        super().destroy()
+
+    def spectrum_plot(self, measurement, plot):
+        self.spectrogram.add(measurement['spectrum'])
+
+    def plot_data(self, data):
+        # A backlog is written to the spectrogram in a single step
+        self.spectrogram.add_many([measurement['spectrum'] for measurement in data])
+
+    def clear_data(self):
+        self.spectrogram.clear()
+
+    def draw(self):
+        points_in_x = int(self.sldScale.get())
+        if points_in_x != self.shown_points:
+            self.shown_points = points_in_x
+            self.spectrogram.set_max_bin(points_in_x)
+        self.canvas.draw()
+
+
+class ToneListener(TkListener):
+    """
+    Levels of a few target frequencies and the frequency of the dominant peak, plotted as lines over time.
+
+    The targets are evaluated directly (see ToneAnalyzer) instead of with the whole spectrum, and the peak is found with
+    a smaller FFT interpolated between bins, so this is much lighter than the spectrogram.
+    """
+
+    def __init__(self, master=None, freqs=(1000.,), interval=0.3, fft_size=4096, history_max=200, source=None,
+                 show_metrics=False, channel=0, max_fps=20.):
+        rate = source.rate if source is not None else 44100
+        self.tone_analyzer = ToneAnalyzer(rate, freqs, output='db')
+        self.peak_analyzer = SpectrumAnalyzer(rate, fft_size, output='db')
+        self.channel = channel  # Channel analyzed, if the source has several
+        self.pipeline = Pipeline([ToneStage(self.tone_analyzer, channel), DominantStage(self.peak_analyzer, channel)],
+                                 channels=source.channels if source is not None else 1)
+        super().__init__(plot_f=self.tone_plot, data_f=self.pipeline, interval=interval, master=master,
+                         title="Tone tracker", source=source, show_metrics=show_metrics, max_fps=max_fps)
+        self.figure.clear()
+        self.active_subplot = self.figure.add_subplot(211)
+        self.peak_subplot = self.figure.add_subplot(212, sharex=self.active_subplot)
+        self.tones = TrendPlot(self.active_subplot, ["%g Hz" % f for f in freqs], history_max, interval,
+                               ylabel="level (dB)")
+        self.peaks = TrendPlot(self.peak_subplot, ["dominant"], history_max, interval, ylabel="frequency (Hz)")
+
+        self.frmOperations = Frame(master=self)
+        self.frmOperations.pack(side=BOTTOM)
+
+        self.buttonClearPoints = Button(master=self.frmOperations, text='Clear data', command=self.clear_data)
+        self.buttonClearPoints.pack(side=LEFT)
+
+        self.varPeak = StringVar()
+        self.lblPeak = Label(master=self.frmOperations, textvariable=self.varPeak, font="TkFixedFont")
+        self.lblPeak.pack(side=LEFT)
+        self.ttpPeak = CreateToolTip(self.lblPeak, "Frequency and level of the highest peak of the last point.")
+
+    def tone_plot(self, measurement, plot):
+        self.tones.add(measurement['tones'])
+        self.peaks.add(measurement['dominant_frequency'])
+
+    def plot_data(self, data):
+        # A backlog is added to the lines in a single step
+        self.tones.add_many([measurement['tones'] for measurement in data])
+        self.peaks.add_many([measurement['dominant_frequency'] for measurement in data])
+        self.varPeak.set("Dominant: %.1f Hz, %.1f dB" % (data[-1]['dominant_frequency'], data[-1]['dominant_level']))
+
+    def clear_data(self):
+        self.tones.clear()
+        self.peaks.clear()
+
+    def draw(self):
+        self.tones.draw()
+        self.peaks.draw()
+        self.canvas.draw()